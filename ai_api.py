@@ -1,41 +1,505 @@
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
 import openai
+from openai import api_requestor
+import metrics
+from mock import MockBackend
+from ai_cache import ResponseCache, get_response_cache
 from ai_config import AIConfig
 from ai_prompt import BasePrompt
+from backends import CHAT_MODE, COMPLETION_MODE, MOCK_MODE, Backend, get_backend
+from hedging import HedgePolicy, ahedge
+from ledger import get_usage_ledger
+from ranking import rank_candidates
+from rate_limit import get_upstream_scheduler
+from similarity_cache import SimilarityCache, get_similarity_cache
+from singleflight import get_single_flight
+from token_budget import count_tokens, get_token_budget
+from utils import LyricStreamParser, join_lyrics, split_lyrics
 
 
 class BaseAPI:
     '''
     Initializes an OpenAI API engine with the given configuration
     To adopt different backbone engines in AIGenerator, wrap the backone with BaseAPI
-    and implement the `generate` method
+    and implement the `_get_prompts`, `_request` and `_get_content` methods
 
     Args:
         cfg (AIConfig): An object that stores the API key, engine, and max tokens to use.
         prompt (BasePrompt): An object that generates prompts.
+        engine (str): The engine name, the configured engine if not given.
+        backend (Backend): The server of the engine, looked up by the engine name if not given.
     '''
 
-    def __init__(self, cfg: AIConfig, prompt: BasePrompt, lang="en") -> None:
-        self.api_key = cfg.get_openai_api_key()
-        self.engine = cfg.get_openai_api_engine()
+    def __init__(self, cfg: AIConfig, prompt: BasePrompt, lang="en", engine: Optional[str] = None,
+                 backend: Optional[Backend] = None) -> None:
+        self.engine = engine or cfg.get_openai_api_engine()
+        self.backend = backend or get_backend(cfg, self.engine)
+        self.model = self.backend.model
+        if self.backend.is_openai:
+            self.api_key = self.backend.api_key or cfg.get_openai_api_key()
+            self.organization = cfg.get_organization_id()
+        else:
+            # The OpenAI credentials are never sent to other servers. The openai client refuses to send requests
+            # without a key, which self-hosted servers usually ignore, and the organization only applies to OpenAI
+            self.api_key = self.backend.api_key or "none"
+            self.organization = None
         self.max_tokens = cfg.get_openai_max_tokens()
+        self.budget = get_token_budget(cfg)
+        self.stream = cfg.get_openai_stream()
         self.prompt = prompt
         self.lang = lang
-        openai.api_key = self.api_key
+        self.cache = get_response_cache(cfg)
+        self.similarity_cache = get_similarity_cache(cfg)
+        self.similarity_context_lines = cfg.get_similarity_context_lines()
+        self.flight = get_single_flight()
+        self.scheduler = get_upstream_scheduler(cfg, self.backend)
+        self.ledger = get_usage_ledger(cfg)
+        self.hedge = HedgePolicy(cfg.get_hedge_percentile(), cfg.get_hedge_min_delay())
+        # The engine that hedges slow async calls, this engine itself if not set, see `EngineRegistry`
+        self.hedge_engine: Optional["BaseAPI"] = None
+        # Returns the pooled requests session for blocking requests, see `EngineRegistry`
+        self.session_factory = None
+        # Returns a pooled aiohttp session for async requests, see `EngineRegistry`
+        self.aiosession_factory = None
 
     def _get_content(self):
         ''' Get the text contents from the response package. '''
         raise NotImplementedError
 
+    def _get_contents(self, response) -> List[str]:
+        ''' Get the text contents of all choices in the response package, skipping invalid ones. '''
+        raise NotImplementedError
+
     def _get_prompts(self):
         ''' Generate engine-specific prompts that consist of system, assistant, and user prompts. '''
         raise NotImplementedError
 
-    def generate(self) -> str:
+    def _get_delta(self, chunk) -> str:
+        ''' Get the text delta from a chunk of the streamed response. '''
+        raise NotImplementedError
+
+    def _request(self, prompts, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
         '''
-        Generate text based on given parameters (such as prompts, temperature, etc.)
+        Send the engine-specific prompts to the backbone and return the raw response package,
+        or an iterator over the response chunks if `stream` is set. `n` is the number of choices to generate.
         '''
         raise NotImplementedError
 
+    async def _arequest(self, prompts, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
+        ''' Asynchronous version of `_request` built on the async OpenAI client. '''
+        raise NotImplementedError
+
+    def _credentials(self):
+        '''
+        Per-instance credentials, server and timeouts passed to each request rather than set on the global `openai` module
+        '''
+        return {
+            "api_key": self.api_key,
+            "organization": self.organization,
+            "api_base": self.backend.api_base,
+            "request_timeout": self.backend.request_timeout,
+        }
+
+    def _estimate_tokens(self, prompts, max_tokens: int, n: int = 1) -> int:
+        '''
+        Estimate the tokens a request counts against the tokens-per-minute quota:
+        the prompt tokens plus `max_tokens` of every choice, as the API reserves them upfront.
+        '''
+        if not isinstance(prompts, str):
+            prompts = "\n".join(message["content"] for message in prompts)
+        return count_tokens(prompts) + max_tokens * n
+
+    def _send(self, prompts, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
+        ''' Send a request through the upstream scheduler, which enforces the quotas and retries transient failures '''
+        return self.scheduler.call(
+            lambda: self._request(prompts, temperature, max_tokens, stream=stream, n=n),
+            self._estimate_tokens(prompts, max_tokens, n),
+        )
+
+    async def _asend(self, prompts, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
+        ''' Coroutine version of `_send` '''
+        return await self.scheduler.acall(
+            lambda: self._arequest(prompts, temperature, max_tokens, stream=stream, n=n),
+            self._estimate_tokens(prompts, max_tokens, n),
+        )
+
+    def _bind_session(self) -> None:
+        '''
+        Hand the pooled session to the blocking request on this thread.
+        The openai client keeps a session per thread and closes it once it is `MAX_SESSION_LIFETIME_SECS` old,
+        which would close the connections of the session shared by all engines, so it is bound with a fresh age
+        for each request rather than set as the global `openai.requestssession`.
+        '''
+        if self.session_factory is not None:
+            api_requestor._thread_context.session = self.session_factory()
+            api_requestor._thread_context.session_create_time = time.time()
+
+    def _bind_aiosession(self) -> None:
+        if self.aiosession_factory is not None:
+            openai.aiosession.set(self.aiosession_factory())
+
+    def _prepare(self, user_demands: str, temperature: float, **kwargs):
+        '''
+        Validate the sampling parameters, render the engine-specific prompts
+        and size `max_tokens` from the number of requested lines.
+        '''
+        kwargs.pop("reuse_similar", None)
+        if temperature < 0 or temperature > 1:
+            raise ValueError(f"Invalid temperature value: {temperature}")
+        max_tokens = self.budget.estimate(kwargs.get("num_lines", 4), self.prompt.lang)
+        with metrics.span("prompt_render", engine=self.engine):
+            prompts = self._get_prompts(user_demands, **kwargs)
+        return prompts, max_tokens
+
+    def _lookup(self, prompts, temperature: float, **extra):
+        '''
+        Look up the response cache.
+        Returns the cache key and the cached content, the key is None if the cache is disabled or bypassed.
+        The key uses the configured max tokens rather than the per-request budget,
+        so that updates of the tokens-per-line history do not invalidate cached responses.
+        '''
+        if self.cache is None:
+            return None, None
+        if self.cache.should_bypass(temperature):
+            self.cache.record_bypass()
+            return None, None
+        key = ResponseCache.make_key(self.engine, prompts, temperature, self.max_tokens, **extra)
+        return key, self.cache.get(key)
+
+    def _lookup_similar(self, content: Optional[str], user_demands: str, temperature: float, reuse_similar: bool = False,
+                        context_before: str = "", **fields):
+        '''
+        Look up the similarity cache on a miss of the response cache, if the plugin of the request opted in with `reuse_similar`.
+        The user demands and the trailing lines of `context_before` only need to be similar,
+        the other request fields must match exactly.
+        Returns the query to store the fresh response under and the content, the query is None if not looked up.
+        '''
+        if content is not None or self.similarity_cache is None or not reuse_similar:
+            return None, content
+        if self.similarity_cache.should_bypass(temperature):
+            self.similarity_cache.record_bypass()
+            return None, None
+        trailing_context = context_before.split("\n")[-self.similarity_context_lines:] if self.similarity_context_lines > 0 else []
+        partition = SimilarityCache.make_partition(self.engine, lang=self.prompt.lang, **fields)
+        return self.similarity_cache.lookup(partition, "\n".join([user_demands or ""] + trailing_context))
+
+    def _record_budget(self, content: str, response=None) -> List[str]:
+        ''' Update the tokens-per-line history of the token budget with a fresh response, returns the parsed lines. '''
+        try:
+            lines = split_lyrics(content)
+        except ValueError:
+            return []
+        usage = getattr(response, "usage", None)
+        self.budget.record(lines, self.prompt.lang, usage.completion_tokens if usage else None)
+        return lines
+
+    def _record_usage(self, response=None, prompts=None, lines: Optional[List[str]] = None) -> Dict[str, int]:
+        '''
+        Count the prompt and completion tokens of a response in the token counters of the engine,
+        and account them with the number of generated lines in the usage ledger.
+        Streamed responses carry no usage, so their tokens are counted locally from the prompts and the parsed lines.
+        '''
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens = self._estimate_tokens(prompts, 0) if prompts is not None else 0
+            completion_tokens = count_tokens(join_lyrics(lines)) if lines else 0
+        metrics.increment("prompt_tokens_total", prompt_tokens, engine=self.engine)
+        metrics.increment("completion_tokens_total", completion_tokens, engine=self.engine)
+        if self.ledger is not None:
+            self.ledger.record(self.engine, prompt_tokens, completion_tokens, len(lines or []))
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+
+    def _observe_upstream(self, phase: str, start_time: float) -> None:
+        ''' Observe the upstream latency since the request was sent, including the waits for the quotas '''
+        metrics.observe(f"upstream_{phase}_seconds", time.perf_counter() - start_time, engine=self.engine)
+
+    @staticmethod
+    def _parse_or_skip(content: str) -> List[str]:
+        try:
+            return split_lyrics(content)
+        except ValueError:
+            return []
+
+    def _record_hedge_spend(self, prompts) -> None:
+        '''
+        Account the prompt tokens of a cancelled hedged call as hedging spend.
+        The tokens it generated before the cancellation are unknown and not counted.
+        '''
+        prompt_tokens = self._estimate_tokens(prompts, 0)
+        metrics.increment("hedge_prompt_tokens_total", prompt_tokens, engine=self.engine)
+        if self.ledger is not None:
+            self.ledger.record(self.engine, prompt_tokens, 0, 0, hedge=True)
+
+    async def _ahedged(self, kind: str, fetch: Callable[["BaseAPI", Any, int], Awaitable[Any]],
+                       prompts, max_tokens: int, user_demands: str, temperature: float, **kwargs) -> Any:
+        '''
+        Run `fetch(engine, prompts, max_tokens)` on this engine, and if it is still running
+        at the latency percentile deadline of its kind, on the hedge engine as well.
+        The first to succeed wins and the other is cancelled.
+        '''
+        kind = (kind, kwargs.get("num_lines"))
+        backup_api = self.hedge_engine or self
+        backup_prompts = prompts
+
+        async def backup():
+            nonlocal backup_prompts
+            if backup_api is self:
+                return await fetch(self, prompts, max_tokens)
+            backup_prompts, backup_max_tokens = backup_api._prepare(user_demands, temperature, **kwargs)
+            return await fetch(backup_api, backup_prompts, backup_max_tokens)
+
+        outcome = await ahedge(lambda: fetch(self, prompts, max_tokens), backup, self.hedge.deadline(kind))
+        # The latency of a call cancelled by the winner is cut short, so only completed calls are observed
+        for seconds in outcome.latencies:
+            self.hedge.observe(kind, seconds)
+        if outcome.hedged:
+            metrics.increment("hedged_requests_total", engine=self.engine)
+            if outcome.backup_won:
+                metrics.increment("hedge_wins_total", engine=backup_api.engine)
+                self._record_hedge_spend(prompts)
+            else:
+                backup_api._record_hedge_spend(backup_prompts)
+        return outcome.result
+
+    def _split(self, content: str) -> List[str]:
+        with metrics.span("parse", engine=self.engine):
+            return split_lyrics(content)
+
+    def _store(self, key, content: str, query=None) -> None:
+        if key is not None:
+            self.cache.set(key, content)
+        if query is not None:
+            self.similarity_cache.set(query, content)
+
+    def _flight_key(self, kind: str, prompts, temperature: float, max_tokens: int, **extra) -> str:
+        ''' Key of an upstream call in the single-flight table, concurrent calls of the same key are coalesced '''
+        return ResponseCache.make_key(self.engine, prompts, temperature, max_tokens, kind=kind, **extra)
+
+    def _fetch_content(self, prompts, temperature: float, max_tokens: int) -> str:
+        start_time = time.perf_counter()
+        response = self._send(prompts, temperature, max_tokens)
+        self._observe_upstream("total", start_time)
+        content = self._get_content(response)
+        self._record_usage(response, lines=self._record_budget(content, response))
+        return content
+
+    async def _afetch_content(self, prompts, temperature: float, max_tokens: int) -> str:
+        start_time = time.perf_counter()
+        response = await self._asend(prompts, temperature, max_tokens)
+        self._observe_upstream("total", start_time)
+        content = self._get_content(response)
+        self._record_usage(response, lines=self._record_budget(content, response))
+        return content
+
+    def generate(self, user_demands: str, temperature: float, **kwargs) -> str:
+        '''
+        Generate text based on given parameters (such as prompts, temperature, etc.)
+        Identical requests are served from the response cache unless the temperature exceeds its bypass threshold,
+        near-duplicate requests of plugins that opted in with `reuse_similar` from the similarity cache,
+        and concurrent identical requests share one upstream call.
+        '''
+        prompts, max_tokens = self._prepare(user_demands, temperature, **kwargs)
+        key, content = self._lookup(prompts, temperature)
+        query, content = self._lookup_similar(content, user_demands, temperature, **kwargs)
+        if content is None:
+            content = self.flight.do(
+                self._flight_key("content", prompts, temperature, max_tokens),
+                lambda: self._fetch_content(prompts, temperature, max_tokens),
+            )
+            self._store(key, content, query)
+        return content
+
+    async def agenerate(self, user_demands: str, temperature: float, **kwargs) -> str:
+        '''
+        Coroutine version of `generate` that does not hold a worker thread while waiting on the engine.
+        '''
+        prompts, max_tokens = self._prepare(user_demands, temperature, **kwargs)
+        key, content = self._lookup(prompts, temperature)
+        query, content = self._lookup_similar(content, user_demands, temperature, **kwargs)
+        if content is None:
+            content = await self.flight.ado(
+                self._flight_key("content", prompts, temperature, max_tokens),
+                lambda: self._ahedged(
+                    "content", lambda api, prompts, max_tokens: api._afetch_content(prompts, temperature, max_tokens),
+                    prompts, max_tokens, user_demands, temperature, **kwargs),
+            )
+            self._store(key, content, query)
+        return content
+
+    def _feed(self, parser: LyricStreamParser, chunk, start_time: float, first: bool) -> None:
+        ''' Feed a response chunk to the parser and report the times to the first chunk and the first complete line. '''
+        if first:
+            self._observe_upstream("first_byte", start_time)
+        had_lines = len(parser.lines) > 0
+        if parser.feed(self._get_delta(chunk)) and not had_lines:
+            metrics.observe("time_to_first_line_seconds", time.perf_counter() - start_time, engine=self.engine)
+
+    def _fetch_lines(self, prompts, temperature: float, max_tokens: int, num_lines: int) -> List[str]:
+        parser = LyricStreamParser(num_lines)
+        start_time = time.perf_counter()
+        chunks = self._send(prompts, temperature, max_tokens, stream=True)
+        try:
+            for i, chunk in enumerate(chunks):
+                self._feed(parser, chunk, start_time, i == 0)
+                if parser.done:
+                    break
+        finally:
+            # Closing the stream drops the connection, which stops the upstream generation
+            chunks.close()
+        self._observe_upstream("total", start_time)
+        with metrics.span("parse", engine=self.engine):
+            lines = parser.close()
+        self._record_usage(prompts=prompts, lines=lines)
+        self.budget.record(lines, self.prompt.lang)
+        return lines
+
+    async def _afetch_lines(self, prompts, temperature: float, max_tokens: int, num_lines: int) -> List[str]:
+        parser = LyricStreamParser(num_lines)
+        start_time = time.perf_counter()
+        chunks = await self._asend(prompts, temperature, max_tokens, stream=True)
+        first = True
+        try:
+            async for chunk in chunks:
+                self._feed(parser, chunk, start_time, first)
+                first = False
+                if parser.done:
+                    break
+        finally:
+            await chunks.aclose()
+        self._observe_upstream("total", start_time)
+        with metrics.span("parse", engine=self.engine):
+            lines = parser.close()
+        self._record_usage(prompts=prompts, lines=lines)
+        self.budget.record(lines, self.prompt.lang)
+        return lines
+
+    def generate_lines(self, user_demands: str, temperature: float, num_lines: int = 4, **kwargs) -> List[str]:
+        '''
+        Generate lyrics and split them into lines.
+        In the streaming mode, the response is parsed incrementally and the upstream request is cancelled
+        as soon as the [end] token appears or `num_lines` complete lines have arrived.
+        '''
+        if not self.stream:
+            return self._split(self.generate(user_demands, temperature, num_lines=num_lines, **kwargs))
+        prompts, max_tokens = self._prepare(user_demands, temperature, num_lines=num_lines, **kwargs)
+        key, content = self._lookup(prompts, temperature)
+        query, content = self._lookup_similar(content, user_demands, temperature, num_lines=num_lines, **kwargs)
+        if content is not None:
+            return self._split(content)
+        lines = self.flight.do(
+            self._flight_key("lines", prompts, temperature, max_tokens),
+            lambda: self._fetch_lines(prompts, temperature, max_tokens, num_lines),
+        )
+        self._store(key, join_lyrics(lines), query)
+        return lines
+
+    async def agenerate_lines(self, user_demands: str, temperature: float, num_lines: int = 4, **kwargs) -> List[str]:
+        ''' Coroutine version of `generate_lines` '''
+        if not self.stream:
+            return self._split(await self.agenerate(user_demands, temperature, num_lines=num_lines, **kwargs))
+        prompts, max_tokens = self._prepare(user_demands, temperature, num_lines=num_lines, **kwargs)
+        key, content = self._lookup(prompts, temperature)
+        query, content = self._lookup_similar(content, user_demands, temperature, num_lines=num_lines, **kwargs)
+        if content is not None:
+            return self._split(content)
+        lines = await self.flight.ado(
+            self._flight_key("lines", prompts, temperature, max_tokens),
+            lambda: self._ahedged(
+                "lines", lambda api, prompts, max_tokens: api._afetch_lines(prompts, temperature, max_tokens, num_lines),
+                prompts, max_tokens, user_demands, temperature, num_lines=num_lines, **kwargs),
+        )
+        self._store(key, join_lyrics(lines), query)
+        return lines
+
+    def _fetch_candidates(self, prompts, temperature: float, max_tokens: int, n: int) -> List[str]:
+        start_time = time.perf_counter()
+        response = self._send(prompts, temperature, max_tokens, n=n)
+        self._observe_upstream("total", start_time)
+        contents = self._get_contents(response)
+        self._record_budget(contents[0])
+        self._record_usage(response, lines=[line for content in contents for line in self._parse_or_skip(content)])
+        return contents
+
+    async def _afetch_candidates(self, prompts, temperature: float, max_tokens: int, n: int) -> List[str]:
+        start_time = time.perf_counter()
+        response = await self._asend(prompts, temperature, max_tokens, n=n)
+        self._observe_upstream("total", start_time)
+        contents = self._get_contents(response)
+        self._record_budget(contents[0])
+        self._record_usage(response, lines=[line for content in contents for line in self._parse_or_skip(content)])
+        return contents
+
+    def generate_candidates(self, user_demands: str, temperature: float, n: int, **kwargs) -> List[str]:
+        '''
+        Generate `n` candidates in a single request, sharing the prompt tokens among them.
+        '''
+        prompts, max_tokens = self._prepare(user_demands, temperature, **kwargs)
+        key, content = self._lookup(prompts, temperature, n=n)
+        query, content = self._lookup_similar(content, user_demands, temperature, n=n, **kwargs)
+        if content is not None:
+            return json.loads(content)
+        contents = self.flight.do(
+            self._flight_key("candidates", prompts, temperature, max_tokens, n=n),
+            lambda: self._fetch_candidates(prompts, temperature, max_tokens, n),
+        )
+        self._store(key, json.dumps(contents, ensure_ascii=False), query)
+        return contents
+
+    async def agenerate_candidates(self, user_demands: str, temperature: float, n: int, **kwargs) -> List[str]:
+        ''' Coroutine version of `generate_candidates` '''
+        prompts, max_tokens = self._prepare(user_demands, temperature, **kwargs)
+        key, content = self._lookup(prompts, temperature, n=n)
+        query, content = self._lookup_similar(content, user_demands, temperature, n=n, **kwargs)
+        if content is not None:
+            return json.loads(content)
+        contents = await self.flight.ado(
+            self._flight_key("candidates", prompts, temperature, max_tokens, n=n),
+            lambda: self._ahedged(
+                "candidates", lambda api, prompts, max_tokens: api._afetch_candidates(prompts, temperature, max_tokens, n),
+                prompts, max_tokens, user_demands, temperature, **kwargs),
+        )
+        self._store(key, json.dumps(contents, ensure_ascii=False), query)
+        return contents
+
+    def _rank(self, contents: List[str], num_lines: int, tick_span: Optional[float]) -> List[Tuple[float, List[str]]]:
+        candidates = []
+        for content in contents:
+            try:
+                lines = self._split(content)
+            except ValueError:
+                continue
+            if lines:
+                candidates.append(lines)
+        if not candidates:
+            raise ValueError('Lyrics generation failed')
+        return rank_candidates(candidates, num_lines, tick_span)
+
+    def generate_ranked_lines(self, user_demands: str, temperature: float, num_lines: int = 4, n: int = 1,
+                              tick_span: Optional[float] = None, **kwargs) -> List[Tuple[float, List[str]]]:
+        '''
+        Generate `n` candidates and rank their lines locally from the best to the worst,
+        based on the line count, how line lengths fit `tick_span`, and the duplicate-line rate.
+        A single candidate is generated through the streaming `generate_lines`.
+        '''
+        if n <= 1:
+            contents = [join_lyrics(self.generate_lines(user_demands, temperature, num_lines=num_lines, **kwargs))]
+        else:
+            contents = self.generate_candidates(user_demands, temperature, n, num_lines=num_lines, **kwargs)
+        return self._rank(contents, num_lines, tick_span)
+
+    async def agenerate_ranked_lines(self, user_demands: str, temperature: float, num_lines: int = 4, n: int = 1,
+                                     tick_span: Optional[float] = None, **kwargs) -> List[Tuple[float, List[str]]]:
+        ''' Coroutine version of `generate_ranked_lines` '''
+        if n <= 1:
+            contents = [join_lyrics(await self.agenerate_lines(user_demands, temperature, num_lines=num_lines, **kwargs))]
+        else:
+            contents = await self.agenerate_candidates(user_demands, temperature, n, num_lines=num_lines, **kwargs)
+        return self._rank(contents, num_lines, tick_span)
 
 class TextDavinci(BaseAPI):
     '''
@@ -63,16 +527,41 @@ class TextDavinci(BaseAPI):
             raise TypeError(f"Invalid response of type {type(text)} and value {text}")
         return text.strip()
 
-    def generate(self, user_demands: str, temperature: float, **kwargs) -> str:
-        if temperature < 0 or temperature > 1:
-            raise ValueError(f"Invalid temperature value: {temperature}")
-        response = openai.Completion.create(
-            engine=self.engine,
-            prompt=self._get_prompts(user_demands, **kwargs),
-            max_tokens=self.max_tokens,
+    def _get_contents(self, response) -> List[str]:
+        contents = [
+            choice.text.strip() for choice in getattr(response, "choices", None) or []
+            if isinstance(getattr(choice, "text", None), str) and choice.text.strip()
+        ]
+        if not contents:
+            raise ValueError(f"Incomplete response choices: {response}")
+        return contents
+
+    def _get_delta(self, chunk) -> str:
+        return chunk.choices[0].text if chunk.choices else ""
+
+    def _request(self, prompts: str, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
+        self._bind_session()
+        return openai.Completion.create(
+            **self._credentials(),
+            model=self.model,
+            prompt=prompts,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=stream,
+            n=n,
+        )
+
+    async def _arequest(self, prompts: str, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
+        self._bind_aiosession()
+        return await openai.Completion.acreate(
+            **self._credentials(),
+            model=self.model,
+            prompt=prompts,
+            max_tokens=max_tokens,
             temperature=temperature,
+            stream=stream,
+            n=n,
         )
-        return self._get_content(response)
 
 
 class ChatGPT(BaseAPI):
@@ -101,27 +590,80 @@ class ChatGPT(BaseAPI):
             raise TypeError(f"Invalid response of type {type(text)} and value {text}")
         return text.strip()
 
-    def generate(self, user_demands: str, temperature: float, **kwargs) -> str:
-        if temperature < 0 or temperature > 1:
-            raise ValueError(f"Invalid temperature value: {temperature}")
-        response = openai.ChatCompletion.create(
-            model=self.engine,
-            messages=self._get_prompts(user_demands, **kwargs),
-            max_tokens=self.max_tokens,
+    def _get_contents(self, response) -> List[str]:
+        contents = [
+            choice.message.content.strip() for choice in getattr(response, "choices", None) or []
+            if isinstance(getattr(getattr(choice, "message", None), "content", None), str) and choice.message.content.strip()
+        ]
+        if not contents:
+            raise ValueError(f"Incomplete response choices: {response}")
+        return contents
+
+    def _get_delta(self, chunk) -> str:
+        return chunk.choices[0].delta.get("content", "") if chunk.choices else ""
+
+    def _request(self, prompts: list, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
+        self._bind_session()
+        return openai.ChatCompletion.create(
+            **self._credentials(),
+            model=self.model,
+            messages=prompts,
+            max_tokens=max_tokens,
             temperature=temperature,
+            stream=stream,
+            n=n,
+        )
+
+    async def _arequest(self, prompts: list, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
+        self._bind_aiosession()
+        return await openai.ChatCompletion.acreate(
+            **self._credentials(),
+            model=self.model,
+            messages=prompts,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=stream,
+            n=n,
         )
-        return self._get_content(response)
 
 
-def get_engine_api(cfg: AIConfig, prompt: BasePrompt):
+class MockEngine(ChatGPT):
     '''
-    Map the OpenAI language engine name to the corresponding API class
-    Supported engines: `text-davinci-003` and `gpt-3.5-turbo`
+    An offline engine that speaks the Chat API format without network or API key, see `mock.MockBackend`.
+    Used to load-test and benchmark the plugins and the plugin service.
     '''
-    engine_apis = {
-        "text-davinci-003": TextDavinci,
-        "gpt-3.5-turbo": ChatGPT,
-    }
-    if cfg.get_openai_api_engine() not in engine_apis:
-        raise NotImplementedError
-    return engine_apis[cfg.get_openai_api_engine()](cfg, prompt)
+
+    def __init__(self, cfg: AIConfig, prompt: BasePrompt, lang="en", engine: Optional[str] = None,
+                 backend: Optional[Backend] = None) -> None:
+        super().__init__(cfg, prompt, lang, engine, backend)
+        self.mock = MockBackend(
+            latency=cfg.get_mock_latency(),
+            distribution=cfg.get_mock_latency_distribution(),
+            error_rate=cfg.get_mock_error_rate(),
+            chunk_size=cfg.get_mock_chunk_size(),
+            chunk_interval=cfg.get_mock_chunk_interval(),
+        )
+
+    def _request(self, prompts: list, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
+        return self.mock.request(prompts, stream=stream, n=n)
+
+    async def _arequest(self, prompts: list, temperature: float, max_tokens: int, stream: bool = False, n: int = 1):
+        return await self.mock.arequest(prompts, stream=stream, n=n)
+
+
+# API classes of the request formats of the backends
+ENGINE_APIS = {
+    COMPLETION_MODE: TextDavinci,
+    CHAT_MODE: ChatGPT,
+    MOCK_MODE: MockEngine,
+}
+
+
+def get_engine_api(cfg: AIConfig, prompt: BasePrompt, engine: Optional[str] = None):
+    '''
+    Map the language engine name, the configured engine if not given, to the API class of the format of its backend
+    Supported engines: `text-davinci-003`, `gpt-3.5-turbo`, the offline `mock`
+    and the OpenAI-compatible servers configured in `OPENAI_API_BACKENDS`, see `backends`
+    '''
+    backend = get_backend(cfg, engine or cfg.get_openai_api_engine())
+    return ENGINE_APIS[backend.mode](cfg, prompt, engine=backend.name, backend=backend)
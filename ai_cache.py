@@ -0,0 +1,149 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class ResponseCache:
+    '''
+    An in-process LRU cache of engine responses with an optional SQLite tier.
+    Entries are keyed on the engine, the fully rendered prompt and the sampling parameters,
+    so identical deterministic requests (e.g., undo/redo in TuneFlow at temperature 0) are served without an API round trip.
+
+    Args:
+        max_size (int): The maximum number of entries kept in memory. 0 disables the memory tier.
+        ttl (float): Seconds before an entry expires. 0 or negative values keep entries forever.
+        max_temperature (float): Requests with a higher temperature bypass the cache, only deterministic ones are cached by default.
+        sqlite_path (str): Optional path of a SQLite file used as the second cache tier.
+    '''
+
+    def __init__(self, max_size: int = 256, ttl: float = 600, max_temperature: float = 0.0, sqlite_path: Optional[str] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+            self._db.commit()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(engine: str, prompt: Any, temperature: float, max_tokens: int, **extra) -> str:
+        ''' Hash the rendered prompt (a string or a list of chat messages) and sampling parameters into a key. '''
+        payload = json.dumps(
+            [engine, prompt, round(float(temperature), 4), max_tokens, extra],
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def should_bypass(self, temperature: float) -> bool:
+        return temperature > self.max_temperature
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, created = row
+                    if not self._expired(created):
+                        self._put(key, value, created)
+                        self.disk_hits += 1
+                        return value
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+            self.misses += 1
+            return None
+
+    def _put(self, key: str, value: str, created: float) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (value, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, key: str, value: str) -> None:
+        created = time.time()
+        with self._lock:
+            self._put(key, value, created)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)", (key, value, created))
+                self._db.commit()
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypasses += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        ''' Hit/miss counters used to size the cache. '''
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
+
+
+_RESPONSE_CACHE: Optional[ResponseCache] = None
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+
+def get_response_cache(cfg) -> Optional[ResponseCache]:
+    '''
+    Return the process-wide response cache configured by `cfg` (an AIConfig),
+    or None if caching is disabled.
+    '''
+    global _RESPONSE_CACHE
+    if not cfg.get_cache_enabled():
+        return None
+    with _RESPONSE_CACHE_LOCK:
+        if _RESPONSE_CACHE is None:
+            _RESPONSE_CACHE = ResponseCache(
+                max_size=cfg.get_cache_max_size(),
+                ttl=cfg.get_cache_ttl(),
+                max_temperature=cfg.get_cache_max_temperature(),
+                sqlite_path=cfg.get_cache_path(),
+            )
+        return _RESPONSE_CACHE
+
+
+def get_response_cache_stats() -> Dict[str, int]:
+    ''' Counters of the process-wide response cache, empty if it has not been created. '''
+    return _RESPONSE_CACHE.stats() if _RESPONSE_CACHE is not None else {}
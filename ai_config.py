@@ -1,6 +1,8 @@
+import json
 import os
 from dotenv import load_dotenv
-import os
+
+from backends import BUILTIN_BACKENDS, MOCK_MODE
 
 load_dotenv(verbose=True)
 
@@ -8,6 +10,69 @@ DEFAULT_OPENAI_API_MAX_TOKENS = 1024
 # gpt-3.5-turbo performs at a similar capability to text-davinci-003
 # but is at 10% the price per token
 DEFAULT_OPENAI_API_ENGINE = 'gpt-3.5-turbo'
+# Response cache in front of the engine APIs
+DEFAULT_CACHE_MAX_SIZE = 256
+DEFAULT_CACHE_TTL = 600
+# Sampled requests are expected to differ, e.g. on regenerate, so only deterministic ones are cached by default
+DEFAULT_CACHE_MAX_TEMPERATURE = 0.0
+# Number of keep-alive connections pooled per engine session
+DEFAULT_OPENAI_API_POOL_SIZE = 16
+# Seconds to wait for a response and for a connection
+DEFAULT_OPENAI_API_TIMEOUT = 60
+DEFAULT_OPENAI_API_CONNECT_TIMEOUT = 5
+# Prompt-token budget of the lyric context and the number of nearest lines kept verbatim
+DEFAULT_CONTEXT_MAX_TOKENS = 1024
+DEFAULT_CONTEXT_KEEP_LINES = 16
+# Number of songs whose lyric contexts are kept between plugin runs
+DEFAULT_CONTEXT_CACHE_SIZE = 64
+# Quotas of requests and tokens per minute (0 for no limit), retries of transient failures
+# and the circuit breaker tripped by consecutive failures
+DEFAULT_RATE_LIMIT_RPM = 3500
+DEFAULT_RATE_LIMIT_TPM = 90000
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 30
+# Plugin jobs running at once in the plugin service, in total and per user
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_MAX_CONCURRENCY_PER_USER = 4
+# Mean latency (in seconds) and its distribution, error rate and streaming of the mock engine
+DEFAULT_MOCK_LATENCY = 0.5
+DEFAULT_MOCK_LATENCY_DISTRIBUTION = 'constant'
+DEFAULT_MOCK_ERROR_RATE = 0.0
+DEFAULT_MOCK_CHUNK_SIZE = 4
+DEFAULT_MOCK_CHUNK_INTERVAL = 0.01
+# Latency percentile after which slow async engine calls are hedged (0 disables hedging),
+# and the minimum seconds to wait before hedging
+DEFAULT_HEDGE_PERCENTILE = 0
+DEFAULT_HEDGE_MIN_DELAY = 1.0
+# Seconds between the batched writes of the usage ledger
+DEFAULT_LEDGER_FLUSH_INTERVAL = 5.0
+# Near-duplicate cache of the opted-in plugins: the minimum n-gram similarity of the requests,
+# the highest temperature served from it, its size and the number of trailing context lines compared
+DEFAULT_SIMILARITY_THRESHOLD = 0.8
+DEFAULT_SIMILARITY_MAX_TEMPERATURE = 0.3
+DEFAULT_SIMILARITY_MAX_SIZE = 1024
+DEFAULT_SIMILARITY_CONTEXT_LINES = 2
+
+
+def _getenv_number(name: str, default, cast=int):
+  try:
+    return cast(os.getenv(name, default=default))
+  except ValueError:
+    return default
+
+
+def _getenv_json(name: str) -> dict:
+  value = os.getenv(name)
+  if not value:
+    return {}
+  try:
+    parsed = json.loads(value)
+  except ValueError:
+    raise Exception(f"{name} is not valid JSON")
+  if not isinstance(parsed, dict):
+    raise Exception(f"{name} is not a JSON object")
+  return parsed
 
 
 class AIConfig:
@@ -17,16 +82,26 @@ class AIConfig:
     """
 
     def __init__(self) -> None:
+      self.openai_api_engine = os.getenv("OPENAI_API_ENGINE", DEFAULT_OPENAI_API_ENGINE)
+      # OpenAI-compatible servers by engine name, e.g. {"local": {"api_base": "http://127.0.0.1:8000/v1", "model": "llama", "mode": "chat"}}
+      self.backends = _getenv_json("OPENAI_API_BACKENDS")
+      # Engines of specific plugins, e.g. {"gpt-lyrics-line": "local"}
+      self.plugin_engines = _getenv_json("OPENAI_API_PLUGIN_ENGINES")
+      # Engine of the hedging requests, the configured engine if not set
+      self.hedge_engine = os.getenv("OPENAI_API_HEDGE_ENGINE") or None
+      # The mock engine and self-hosted backends run without OpenAI, so the credentials are only required
+      # if the configured engine, the engine of a plugin or the hedge engine is served by OpenAI
+      engines = {self.openai_api_engine, self.hedge_engine, *self.plugin_engines.values()} - {None}
+      requires_credentials = any(self.is_openai_engine(engine) for engine in engines)
+
       self.openai_api_key = os.getenv("OPENAI_API_KEY")
-      if not self.openai_api_key:
+      if not self.openai_api_key and requires_credentials:
         raise Exception("OPENAI_API_KEY is not set")
       
       self.openai_api_organization_id = os.getenv("OPENAI_API_ORGANIZATION_ID")
-      if not self.openai_api_organization_id:
+      if not self.openai_api_organization_id and requires_credentials:
         raise Exception("OPENAI_API_ORGANIZATION_ID is not set")
       
-      self.openai_api_engine = os.getenv("OPENAI_API_ENGINE", DEFAULT_OPENAI_API_ENGINE)
-      
       try:
         self.openai_api_max_tokens = int(os.getenv(
           "OPENAI_API_MAX_TOKENS",
@@ -35,14 +110,170 @@ class AIConfig:
       except ValueError:
         self.openai_api_max_tokens = DEFAULT_OPENAI_API_MAX_TOKENS
 
+      self.cache_enabled = os.getenv("OPENAI_API_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+      self.cache_max_size = _getenv_number("OPENAI_API_CACHE_MAX_SIZE", DEFAULT_CACHE_MAX_SIZE)
+      self.cache_ttl = _getenv_number("OPENAI_API_CACHE_TTL", DEFAULT_CACHE_TTL, float)
+      self.cache_max_temperature = _getenv_number("OPENAI_API_CACHE_MAX_TEMPERATURE", DEFAULT_CACHE_MAX_TEMPERATURE, float)
+      self.cache_path = os.getenv("OPENAI_API_CACHE_PATH") or None
+      self.openai_api_stream = os.getenv("OPENAI_API_STREAM", "true").lower() not in ("0", "false", "no")
+      self.openai_api_pool_size = _getenv_number("OPENAI_API_POOL_SIZE", DEFAULT_OPENAI_API_POOL_SIZE)
+      self.openai_api_timeout = _getenv_number("OPENAI_API_TIMEOUT", DEFAULT_OPENAI_API_TIMEOUT, float)
+      self.openai_api_connect_timeout = _getenv_number("OPENAI_API_CONNECT_TIMEOUT", DEFAULT_OPENAI_API_CONNECT_TIMEOUT, float)
+      self.context_max_tokens = _getenv_number("OPENAI_API_CONTEXT_MAX_TOKENS", DEFAULT_CONTEXT_MAX_TOKENS)
+      self.context_keep_lines = _getenv_number("OPENAI_API_CONTEXT_KEEP_LINES", DEFAULT_CONTEXT_KEEP_LINES)
+      self.context_cache_size = _getenv_number("OPENAI_API_CONTEXT_CACHE_SIZE", DEFAULT_CONTEXT_CACHE_SIZE)
+      self.rate_limit_rpm = _getenv_number("OPENAI_API_RPM", DEFAULT_RATE_LIMIT_RPM)
+      self.rate_limit_tpm = _getenv_number("OPENAI_API_TPM", DEFAULT_RATE_LIMIT_TPM)
+      self.max_retries = _getenv_number("OPENAI_API_MAX_RETRIES", DEFAULT_MAX_RETRIES)
+      self.breaker_threshold = _getenv_number("OPENAI_API_BREAKER_THRESHOLD", DEFAULT_BREAKER_THRESHOLD)
+      self.breaker_cooldown = _getenv_number("OPENAI_API_BREAKER_COOLDOWN", DEFAULT_BREAKER_COOLDOWN, float)
+      self.max_concurrency = _getenv_number("OPENAI_API_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)
+      self.max_concurrency_per_user = _getenv_number("OPENAI_API_MAX_CONCURRENCY_PER_USER", DEFAULT_MAX_CONCURRENCY_PER_USER)
+      self.mock_latency = _getenv_number("OPENAI_API_MOCK_LATENCY", DEFAULT_MOCK_LATENCY, float)
+      self.mock_latency_distribution = os.getenv("OPENAI_API_MOCK_LATENCY_DISTRIBUTION", DEFAULT_MOCK_LATENCY_DISTRIBUTION)
+      self.mock_error_rate = _getenv_number("OPENAI_API_MOCK_ERROR_RATE", DEFAULT_MOCK_ERROR_RATE, float)
+      self.mock_chunk_size = _getenv_number("OPENAI_API_MOCK_CHUNK_SIZE", DEFAULT_MOCK_CHUNK_SIZE)
+      self.mock_chunk_interval = _getenv_number("OPENAI_API_MOCK_CHUNK_INTERVAL", DEFAULT_MOCK_CHUNK_INTERVAL, float)
+      self.hedge_percentile = _getenv_number("OPENAI_API_HEDGE_PERCENTILE", DEFAULT_HEDGE_PERCENTILE, float)
+      self.hedge_min_delay = _getenv_number("OPENAI_API_HEDGE_MIN_DELAY", DEFAULT_HEDGE_MIN_DELAY, float)
+      self.ledger_path = os.getenv("OPENAI_API_LEDGER_PATH") or None
+      self.ledger_flush_interval = _getenv_number("OPENAI_API_LEDGER_FLUSH_INTERVAL", DEFAULT_LEDGER_FLUSH_INTERVAL, float)
+      # Plugins served from the near-duplicate cache, e.g. "gpt-lyrics-generate,gpt-lyrics-structure"
+      self.similarity_plugins = [
+        plugin_id.strip() for plugin_id in os.getenv("OPENAI_API_SIMILARITY_PLUGINS", "").split(",") if plugin_id.strip()]
+      self.similarity_threshold = _getenv_number("OPENAI_API_SIMILARITY_THRESHOLD", DEFAULT_SIMILARITY_THRESHOLD, float)
+      self.similarity_max_temperature = _getenv_number(
+        "OPENAI_API_SIMILARITY_MAX_TEMPERATURE", DEFAULT_SIMILARITY_MAX_TEMPERATURE, float)
+      self.similarity_max_size = _getenv_number("OPENAI_API_SIMILARITY_MAX_SIZE", DEFAULT_SIMILARITY_MAX_SIZE)
+      self.similarity_context_lines = _getenv_number("OPENAI_API_SIMILARITY_CONTEXT_LINES", DEFAULT_SIMILARITY_CONTEXT_LINES)
+
     def get_openai_api_key(self) -> str:
       return self.openai_api_key
 
     def get_organization_id(self) -> str:
-      return self.organization_id
+      return self.openai_api_organization_id
 
     def get_openai_api_engine(self) -> str:
       return self.openai_api_engine
 
     def get_openai_max_tokens(self) -> int:
       return self.openai_api_max_tokens
+
+    def get_openai_stream(self) -> bool:
+      return self.openai_api_stream
+
+    def get_openai_pool_size(self) -> int:
+      return self.openai_api_pool_size
+
+    def get_openai_timeout(self) -> float:
+      return self.openai_api_timeout
+
+    def get_openai_connect_timeout(self) -> float:
+      return self.openai_api_connect_timeout
+
+    def get_backends(self) -> dict:
+      return self.backends
+
+    def get_plugin_engines(self) -> dict:
+      return self.plugin_engines
+
+    def get_plugin_engine(self, plugin_id: str):
+      return self.plugin_engines.get(plugin_id)
+
+    def is_openai_engine(self, engine: str) -> bool:
+      ''' Whether requests of `engine` go to the OpenAI API, see `Backend.is_openai` '''
+      backend = self.backends.get(engine, BUILTIN_BACKENDS.get(engine, {}))
+      return not backend.get("api_base") and backend.get("mode") != MOCK_MODE
+
+    def get_context_max_tokens(self) -> int:
+      return self.context_max_tokens
+
+    def get_context_keep_lines(self) -> int:
+      return self.context_keep_lines
+
+    def get_context_cache_size(self) -> int:
+      return self.context_cache_size
+
+    def get_rate_limit_rpm(self) -> int:
+      return self.rate_limit_rpm
+
+    def get_rate_limit_tpm(self) -> int:
+      return self.rate_limit_tpm
+
+    def get_max_retries(self) -> int:
+      return self.max_retries
+
+    def get_breaker_threshold(self) -> int:
+      return self.breaker_threshold
+
+    def get_breaker_cooldown(self) -> float:
+      return self.breaker_cooldown
+
+    def get_max_concurrency(self) -> int:
+      return self.max_concurrency
+
+    def get_max_concurrency_per_user(self) -> int:
+      return self.max_concurrency_per_user
+
+    def get_mock_latency(self) -> float:
+      return self.mock_latency
+
+    def get_mock_latency_distribution(self) -> str:
+      return self.mock_latency_distribution
+
+    def get_mock_error_rate(self) -> float:
+      return self.mock_error_rate
+
+    def get_mock_chunk_size(self) -> int:
+      return self.mock_chunk_size
+
+    def get_mock_chunk_interval(self) -> float:
+      return self.mock_chunk_interval
+
+    def get_hedge_percentile(self) -> float:
+      return self.hedge_percentile
+
+    def get_hedge_min_delay(self) -> float:
+      return self.hedge_min_delay
+
+    def get_hedge_engine(self):
+      return self.hedge_engine
+
+    def get_ledger_path(self):
+      return self.ledger_path
+
+    def get_ledger_flush_interval(self) -> float:
+      return self.ledger_flush_interval
+
+    def get_similarity_plugins(self) -> list:
+      return self.similarity_plugins
+
+    def get_similarity_enabled(self, plugin_id: str) -> bool:
+      return plugin_id in self.similarity_plugins
+
+    def get_similarity_threshold(self) -> float:
+      return self.similarity_threshold
+
+    def get_similarity_max_temperature(self) -> float:
+      return self.similarity_max_temperature
+
+    def get_similarity_max_size(self) -> int:
+      return self.similarity_max_size
+
+    def get_similarity_context_lines(self) -> int:
+      return self.similarity_context_lines
+
+    def get_cache_enabled(self) -> bool:
+      return self.cache_enabled
+
+    def get_cache_max_size(self) -> int:
+      return self.cache_max_size
+
+    def get_cache_ttl(self) -> float:
+      return self.cache_ttl
+
+    def get_cache_max_temperature(self) -> float:
+      return self.cache_max_temperature
+
+    def get_cache_path(self):
+      return self.cache_path
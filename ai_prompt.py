@@ -1,3 +1,6 @@
+import string
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
 from utils import DEFAULT_ERROR_MESSAGE
 
 
@@ -38,7 +41,69 @@ class LyricPrompt(BasePrompt):
     LyricPrompt generates Chat or Completion API prompts for lyric writing or continuing.
     The prompts consist of system, assistant, and user prompts.
     The expected output is a string that begins with the specified [start] token and concludes with the [end] token.
+    User prompt templates are compiled once per language and combination of context clauses, then reused.
     '''
+    # Description of the lyric writer
+    SYSTEM_PROMPTS = {
+        "zh": "你是一个专业、才华横溢的音乐人，并且严格遵循用户需求提供作词服务。",
+        "en": "You are a professional and talented musician who provides songwriting services and strictly adheres to user requirements."
+    }
+    # General requirements for lyric generation
+    REQUIREMENTS = {
+        "zh": [
+            "我会为你提供一个要求列表，你需要严格遵循每一条要求生成歌词。列表中的每一条要求都以(R)开头。"
+            "(R) 请遵循如下歌词创作风格、内容的用户要求：{user_demands}。",
+            "(R) 使用中文创作歌词。",
+            "(R) 不要包含任何音乐段落和结构名，例如chorus或verse",
+            "(R) 仅输出新生成歌词的正文，每句歌词独立成行。",
+            "(R) 在新生成的歌词开始之前输出[start]，歌词结束后输出[end]。其中不要包含之前已有的歌词上下文。",
+            "(R) 歌词行数在{num_lines}行左右。",
+            "(R) 如果将要生成的歌词或用户要求中包含恐怖、色情、暴力、政治话题，请输出{error_message}。",
+        ],
+        "en": [
+            "I will provide you with a list of requirements, and you need to strictly generate lyrics according to each requirement. Each item on the list starts with (R).",
+            "(R) Follow the following user requirements regarding lyric contents or styles: {user_demands}.",
+            "(R) Write lyrics in English.",
+            "(R) Do not mention or use any music structure names such as intro, chorus, verse.",
+            "(R) Just write the generated lines with each line being separate and distinct.",
+            "(R) Output [start] before the newly generated lyrics begin and [end] after the lyrics end. Do not include previous lyrics if there are any.",
+            "(R) Please provide around {num_lines} lines of new lyrics.",
+            "(R) If the lyrics to be generated or user requests contain topics of horror, pornography, violence, or politics, please output {error_message}.",
+        ]
+    }
+    # General requirements for rewriting selected lines of the lyrics in one request
+    REWRITE_REQUIREMENTS = {
+        "zh": [
+            "我会为你提供一个要求列表，你需要严格遵循每一条要求改写歌词。列表中的每一条要求都以(R)开头。",
+            "(R) 请遵循如下歌词创作风格、内容的用户要求：{user_demands}。",
+            "(R) 使用中文创作歌词。",
+            "(R) 不要包含任何音乐段落和结构名，例如chorus或verse",
+            "(R) 以下歌词的每一行之前都有方括号括起的行号，请改写所有标有(*)的行，其余行仅作为上下文：\n{rewrite_lines}",
+            "(R) 在改写的歌词开始之前输出[start]，歌词结束后输出[end]。仅输出改写后的行，每行一句，并以原行号开头，例如[3]。",
+            "(R) 如果将要生成的歌词或用户要求中包含恐怖、色情、暴力、政治话题，请输出{error_message}。",
+        ],
+        "en": [
+            "I will provide you with a list of requirements, and you need to strictly rewrite lyrics according to each requirement. Each item on the list starts with (R).",
+            "(R) Follow the following user requirements regarding lyric contents or styles: {user_demands}.",
+            "(R) Write lyrics in English.",
+            "(R) Do not mention or use any music structure names such as intro, chorus, verse.",
+            "(R) Each of the following lyric lines begins with its index in brackets. Rewrite every line marked with (*), the other lines are context only:\n{rewrite_lines}",
+            "(R) Output [start] before the rewritten lyrics begin and [end] after the lyrics end. Only output the rewritten lines, one per line, each beginning with its original index in brackets, such as [3].",
+            "(R) If the lyrics to be generated or user requests contain topics of horror, pornography, violence, or politics, please output {error_message}.",
+        ]
+    }
+    # Requirements for lyric continuation
+    CONTINUATION_REQUIREMENTS = {
+        "zh": "(R) 新生成的歌词需要衔接上文，歌词上文如下：{context_before}。",
+        "en": "(R) The newly generated lyrics need to seamlessly connect to the previous lyrics. Previous lyrics are as follows: {context_before}.",
+    }
+    # Requirements for lyric insertion
+    INSERTION_REQUIREMENTS = {
+        "zh": "(R) 新生成的歌词需要衔接下文，歌词下文如下：{context_after}。",
+        "en": "(R) The newly generated lyrics need to seamlessly connect to the previous lyrics. Previous lyrics are as follows: {context_after}.",
+    }
+    # Compiled user prompt templates keyed by language, continuation, insertion and rewriting
+    _user_templates: Dict[Tuple[str, bool, bool, bool], Tuple[Tuple[str, Optional[str]], ...]] = {}
 
     def __init__(self, lang="en", error_message=DEFAULT_ERROR_MESSAGE):
         '''
@@ -49,63 +114,67 @@ class LyricPrompt(BasePrompt):
         super().__init__(lang)
         self.error_message = error_message
 
+    @classmethod
+    def compile_user_template(cls, lang: str, continuation: bool, insertion: bool, rewrite: bool = False) -> Tuple[Tuple[str, Optional[str]], ...]:
+        '''
+        Join the requirements of the language and context clauses into a template, once per combination.
+        The template is pre-parsed into pairs of literal text and the name of the field that follows it,
+        which renders several times faster than `str.format` on the joined requirements.
+        '''
+        key = (lang, continuation, insertion, rewrite)
+        template = cls._user_templates.get(key)
+        if template is None:
+            requirements = list(cls.REWRITE_REQUIREMENTS[lang] if rewrite else cls.REQUIREMENTS[lang])
+            if continuation:
+                requirements.append(cls.CONTINUATION_REQUIREMENTS[lang])
+            if insertion:
+                requirements.append(cls.INSERTION_REQUIREMENTS[lang])
+            template = cls._user_templates[key] = tuple(
+                (literal, field) for literal, field, _, _ in string.Formatter().parse("\n".join(requirements))
+            )
+        return template
+
+    @staticmethod
+    def render_template(template: Tuple[Tuple[str, Optional[str]], ...], values: Dict[str, Any]) -> str:
+        return "".join([
+            literal if field is None else literal + str(values[field])
+            for literal, field in template
+        ])
+
     def get_system_prompt(self):
         ''' Description of the lyric writer '''
-        content = {
-            "zh": "你是一个专业、才华横溢的音乐人，并且严格遵循用户需求提供作词服务。",
-            "en": "You are a professional and talented musician who provides songwriting services and strictly adheres to user requirements."
-        }
         return {
             "role": "system",
-            "content": content[self.lang]
+            "content": LyricPrompt.SYSTEM_PROMPTS[self.lang]
         }
 
-    def get_user_prompt(self, user_demands: str, context_before: str = "", context_after: str = "", num_lines: int = 4):
-        ''' Encode additional user demands for the lyrics '''
-        # General requirements for lyric generation
-        requirements = {
-            "zh": [
-                "我会为你提供一个要求列表，你需要严格遵循每一条要求生成歌词。列表中的每一条要求都以(R)开头。"
-                "(R) 请遵循如下歌词创作风格、内容的用户要求：{user_demands}。",
-                "(R) 使用中文创作歌词。",
-                "(R) 不要包含任何音乐段落和结构名，例如chorus或verse",
-                "(R) 仅输出新生成歌词的正文，每句歌词独立成行。",
-                "(R) 在新生成的歌词开始之前输出[start]，歌词结束后输出[end]。其中不要包含之前已有的歌词上下文。",
-                "(R) 歌词行数在{num_lines}行左右。",
-                "(R) 如果将要生成的歌词或用户要求中包含恐怖、色情、暴力、政治话题，请输出{error_message}。",
-            ],
-            "en": [
-                "I will provide you with a list of requirements, and you need to strictly generate lyrics according to each requirement. Each item on the list starts with (R).",
-                "(R) Follow the following user requirements regarding lyric contents or styles: {user_demands}.",
-                "(R) Write lyrics in English.",
-                "(R) Do not mention or use any music structure names such as intro, chorus, verse.",
-                "(R) Just write the generated lines with each line being separate and distinct.",
-                "(R) Output [start] before the newly generated lyrics begin and [end] after the lyrics end. Do not include previous lyrics if there are any.",
-                "(R) Please provide around {num_lines} lines of new lyrics.",
-                "(R) If the lyrics to be generated or user requests contain topics of horror, pornography, violence, or politics, please output {error_message}.",
-            ]
-        }
-        # Requirements for lyric continuation
-        if context_before.strip() != "":
-            requirements["zh"] += ["(R) 新生成的歌词需要衔接上文，歌词上文如下：{context_before}。"]
-            requirements["en"] += ["(R) The newly generated lyrics need to seamlessly connect to the previous lyrics. Previous lyrics are as follows: {context_before}."]
-        # Requirements for lyric insertion
-        if context_after.strip() != "":
-            requirements["zh"] += ["(R) 新生成的歌词需要衔接下文，歌词下文如下：{context_after}。"]
-            requirements["en"] += ["(R) The newly generated lyrics need to seamlessly connect to the previous lyrics. Previous lyrics are as follows: {context_after}."]
-        content = {
-            "zh": "\n".join(requirements["zh"]),
-            "en": "\n".join(requirements["en"]),
-        }
+    @staticmethod
+    def format_rewrite_lines(rewrite_lines: List[Tuple[int, str, bool]]) -> str:
+        ''' List (index, sentence, selected) lyric lines with their indices, marking the selected ones with (*) '''
+        return "\n".join(
+            f"[{index}] (*) {sentence}" if selected else f"[{index}] {sentence}"
+            for index, sentence, selected in rewrite_lines
+        )
+
+    def get_user_prompt(self, user_demands: str, context_before: str = "", context_after: str = "", num_lines: int = 4,
+                        rewrite_lines: Optional[List[Tuple[int, str, bool]]] = None):
+        '''
+        Encode additional user demands for the lyrics.
+        If `rewrite_lines` are given, the prompt asks to rewrite the selected ones in one request,
+        answering with the indices of the lines, see `utils.split_indexed_lyrics`.
+        '''
+        template = LyricPrompt.compile_user_template(
+            self.lang, context_before.strip() != "", context_after.strip() != "", rewrite_lines is not None)
         return {
             "role": "user",
-            "content": content[self.lang].format(
-                user_demands=user_demands,
-                error_message=self.error_message,
-                num_lines=num_lines,
-                context_before=context_before,
-                context_after=context_after,
-            )
+            "content": LyricPrompt.render_template(template, {
+                "user_demands": user_demands,
+                "error_message": self.error_message,
+                "num_lines": num_lines,
+                "context_before": context_before,
+                "context_after": context_after,
+                "rewrite_lines": LyricPrompt.format_rewrite_lines(rewrite_lines) if rewrite_lines is not None else "",
+            })
         }
 
     def get_completion_prompt(self, user_demands: str, **kwargs):
@@ -123,3 +192,14 @@ class LyricPrompt(BasePrompt):
             self.get_system_prompt(),
             self.get_user_prompt(**kwargs),
         ]
+
+    def render_chat_prompts(self, requests: Iterable[Dict[str, Any]]) -> List[List[Dict[str, str]]]:
+        '''
+        Render Chat API prompts of many requests in bulk, such as batch and multi-section jobs.
+        Each request holds the keyword arguments of `get_user_prompt`.
+        '''
+        system_prompt = self.get_system_prompt()
+        return [
+            [dict(system_prompt), self.get_user_prompt(**request)]
+            for request in requests
+        ]
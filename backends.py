@@ -0,0 +1,82 @@
+from typing import Any, Dict, Optional, Tuple
+
+# Request formats of the backends: the Chat API, the Completion API, or the offline mock engine
+CHAT_MODE = 'chat'
+COMPLETION_MODE = 'completion'
+MOCK_MODE = 'mock'
+BACKEND_MODES = (CHAT_MODE, COMPLETION_MODE, MOCK_MODE)
+
+# The engines served by the OpenAI API and the offline mock engine
+BUILTIN_BACKENDS = {
+    "text-davinci-003": {"mode": COMPLETION_MODE},
+    "gpt-3.5-turbo": {"mode": CHAT_MODE},
+    "mock": {"mode": MOCK_MODE},
+}
+
+
+class Backend:
+    '''
+    An OpenAI-compatible HTTP server that engines send their requests to.
+
+    Args:
+        name (str): The engine name the backend is selected by, e.g. in `OPENAI_API_ENGINE`.
+        model (str): The model name sent in requests, the engine name if not given.
+        mode (str): `chat` for the Chat API format, `completion` for the Completion API format, or `mock`.
+        api_base (str): The base URL of the server, the OpenAI API if not given.
+        api_key (str): The API key of the server, `OPENAI_API_KEY` if not given.
+        pool_size (int): The number of pooled keep-alive connections to the server.
+        timeout (float): Seconds to wait for a response.
+        connect_timeout (float): Seconds to wait for a connection.
+        rpm (int): Requests per minute allowed by the server, 0 for no limit.
+        tpm (int): Tokens per minute allowed by the server, 0 for no limit.
+    '''
+
+    def __init__(self, name: str, model: Optional[str] = None, mode: str = CHAT_MODE, api_base: Optional[str] = None,
+                 api_key: Optional[str] = None, pool_size: int = 16, timeout: float = 60, connect_timeout: float = 5,
+                 rpm: int = 0, tpm: int = 0) -> None:
+        if mode not in BACKEND_MODES:
+            raise ValueError(f"Invalid mode of backend {name}: {mode}, expected one of {BACKEND_MODES}")
+        self.name = name
+        self.model = model or name
+        self.mode = mode
+        self.api_base = api_base.rstrip('/') if api_base else None
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.rpm = rpm
+        self.tpm = tpm
+
+    @property
+    def is_openai(self) -> bool:
+        '''
+        Whether requests go to the OpenAI API, which enforces the quotas of the organization.
+        '''
+        return self.api_base is None and self.mode != MOCK_MODE
+
+    @property
+    def request_timeout(self) -> Tuple[float, float]:
+        return self.connect_timeout, self.timeout
+
+
+def get_backends(cfg) -> Dict[str, Backend]:
+    '''
+    The builtin backends and the OpenAI-compatible servers of `OPENAI_API_BACKENDS` configured by `cfg` (an AIConfig).
+    Configured backends override the builtin ones of the same name.
+    '''
+    defaults: Dict[str, Any] = {
+        "pool_size": cfg.get_openai_pool_size(),
+        "timeout": cfg.get_openai_timeout(),
+        "connect_timeout": cfg.get_openai_connect_timeout(),
+    }
+    settings = {name: dict(defaults, **backend) for name, backend in BUILTIN_BACKENDS.items()}
+    for name, backend in cfg.get_backends().items():
+        settings[name] = dict(defaults, **backend)
+    return {name: Backend(name, **backend) for name, backend in settings.items()}
+
+
+def get_backend(cfg, name: str) -> Backend:
+    backends = get_backends(cfg)
+    if name not in backends:
+        raise NotImplementedError(f"Unknown engine: {name}")
+    return backends[name]
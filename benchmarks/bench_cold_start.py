@@ -0,0 +1,112 @@
+'''
+Benchmark of the cold start of the plugin service, as seen after a scale-to-zero.
+Each sample runs in a fresh interpreter and measures:
+  - import: importing `test_app`, which builds the FastAPI app
+  - startup: the startup events of the app
+  - first_params: the first `init-plugin-params` request of a plugin
+  - first_job: the first `jobs` request of a plugin against the offline mock engine
+  - second_job: the same request again, once everything is loaded
+Results are written as JSON, with the modules of the OpenAI stack loaded after the import.
+
+Usage: python benchmarks/bench_cold_start.py [--repeat 5] [--plugin gpt-lyrics-line] [--output results.json]
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["openai", "aiohttp", "requests", "dotenv", "uvicorn", "ai_api"]
+
+# Run in a fresh interpreter per sample, printing the timings as JSON on the last line
+SAMPLE = '''
+import json, sys, time
+start = time.perf_counter()
+import test_app
+timings = {"import": time.perf_counter() - start}
+loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+
+from msgpack import packb, unpackb
+from starlette.testclient import TestClient
+sys.path.insert(0, BENCHMARKS)
+from synthetic import make_song
+
+song = make_song(64).serialize_to_bytestring()
+params = {
+    "prompt": "a pop song about dreams and hope", "temperature": 0.5, "numCandidates": 1, "numLines": 8,
+    "language": "en", "userLanguage": "en-US", "empty": False,
+    "trigger": {"type": "lyrics-line", "entities": [{"lyricsLineIndex": 32}]},
+}
+start = time.perf_counter()
+with TestClient(test_app.app) as client:
+    timings["startup"] = time.perf_counter() - start
+    body = {"providerId": "andantei", "pluginId": PLUGIN, "song": song}
+    start = time.perf_counter()
+    response = client.post(test_app.PATH_PREFIX + "/init-plugin-params", content=packb(body))
+    timings["first_params"] = time.perf_counter() - start
+    assert unpackb(response.content)["status"] == "OK"
+    for name in ("first_job", "second_job"):
+        start = time.perf_counter()
+        response = client.post(test_app.PATH_PREFIX + "/jobs", content=packb(dict(body, params=params)))
+        timings[name] = time.perf_counter() - start
+        assert unpackb(response.content)["status"] == "OK"
+print(json.dumps({"timings": timings, "loaded": loaded}))
+'''
+
+
+def run_sample(plugin: str) -> Dict[str, Any]:
+    env = dict(
+        os.environ,
+        OPENAI_API_ENGINE="mock",
+        OPENAI_API_MOCK_LATENCY="0",
+        OPENAI_API_MOCK_CHUNK_INTERVAL="0",
+        OPENAI_API_CACHE_ENABLED="false",
+        PYTHONPATH=ROOT,
+    )
+    code = f"HEAVY_MODULES = {HEAVY_MODULES!r}\nBENCHMARKS = {os.path.join(ROOT, 'benchmarks')!r}\nPLUGIN = {plugin!r}\n" + SAMPLE
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    return {
+        "min_seconds": min(samples),
+        "median_seconds": statistics.median(samples),
+        "mean_seconds": statistics.mean(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="number of fresh interpreters to sample")
+    parser.add_argument("--plugin", default="gpt-lyrics-line", help="id of the plugin to request")
+    parser.add_argument("--output", help="path of the JSON results, printed to stdout if not given")
+    args = parser.parse_args()
+
+    samples = [run_sample(args.plugin) for _ in range(args.repeat)]
+    results = []
+    for phase in samples[0]["timings"]:
+        timing = summarize([sample["timings"][phase] for sample in samples])
+        results.append(dict(benchmark=phase, plugin=args.plugin, **timing))
+        print(f"{phase:<14} {timing['median_seconds'] * 1e3:10.1f} ms", file=sys.stderr)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "loaded_after_import": samples[0]["loaded"],
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
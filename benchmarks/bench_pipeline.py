@@ -0,0 +1,182 @@
+'''
+Benchmark of the per-request CPU overhead of the plugin pipeline on synthetic songs.
+Measures separately, for each plugin and song size:
+  - prompt: LyricPrompt rendering of the request
+  - split: utils.split_lyrics parsing of the engine response
+  - context: context building in `_prepare` of the plugin
+  - edit: context building in `_prepare` of the plugin after one lyric line changed since the previous run,
+    as in an interactive editing session
+  - placement: placing the generated lines into tuneflow_py.Lyrics in `_apply` of the plugin
+  - run: the whole `run` of the plugin end-to-end against the offline mock engine
+Results are written as JSON, one record per benchmark, plugin and song size.
+
+Usage: python benchmarks/bench_pipeline.py [--sizes 10 100 1000 10000] [--repeat 5] [--output results.json]
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+from typing import Any, Callable, Dict, List, Optional
+
+# Run the plugins against the offline engine without delays, caching or quotas,
+# so that only the local CPU overhead is measured
+os.environ.update({
+    "OPENAI_API_ENGINE": "mock",
+    "OPENAI_API_MOCK_LATENCY": "0",
+    "OPENAI_API_MOCK_CHUNK_INTERVAL": "0",
+    "OPENAI_API_MOCK_ERROR_RATE": "0",
+    "OPENAI_API_CACHE_ENABLED": "false",
+    "OPENAI_API_RPM": "0",
+    "OPENAI_API_TPM": "0",
+})
+
+from synthetic import clone_song, make_response, make_song  # noqa: E402
+
+from engine_registry import get_engine_registry  # noqa: E402
+from lyric_generation import LyricGenerationPlugin  # noqa: E402
+from lyric_line_completion import LyricLineCompletionPlugin  # noqa: E402
+from lyric_structure_completion import LyricStructureCompletionPlugin  # noqa: E402
+from utils import split_lyrics  # noqa: E402
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+NUM_LINES = 8
+
+
+def make_params(plugin, song, lang: str) -> Dict[str, Any]:
+    ''' Parameters of a run on the middle of the song '''
+    params = {
+        "prompt": "a pop song about dreams and hope",
+        "temperature": 0.5,
+        "numCandidates": 1,
+        "language": lang,
+        "userLanguage": "en-US",
+    }
+    if plugin is LyricGenerationPlugin:
+        return dict(params, numLines=NUM_LINES, empty=False, trigger={"type": "lyrics-generate"})
+    if plugin is LyricLineCompletionPlugin:
+        num_lines = len(list(song._proto.lyrics.lines))
+        return dict(params, trigger={"type": "lyrics-line", "entities": [{"lyricsLineIndex": num_lines // 2}]})
+    num_structures = len(song.get_structures())
+    return dict(params, numLines=NUM_LINES, trigger={"type": "lyrics-structure", "entities": [{"lyricsStructureIndex": num_structures // 2}]})
+
+
+def edited_song(song, index: int):
+    ''' A copy of the song with the lyric line at `index` rewritten '''
+    edited = clone_song(song)
+    words = edited._proto.lyrics.lines[index % len(edited._proto.lyrics.lines)].words
+    words[0].word = f"edited{index}"
+    return edited
+
+
+def generated_lines(plugin, job: Dict[str, Any], lang: str):
+    ''' Generated lines in the shape `_apply` of the plugin takes '''
+    lines = split_lyrics(make_response(job["request"]["num_lines"], lang))
+    if plugin is LyricLineCompletionPlugin:
+        return dict(zip(job["slots"], lines))
+    return lines
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    return {
+        "min_seconds": min(samples),
+        "median_seconds": statistics.median(samples),
+        "mean_seconds": statistics.mean(samples),
+    }
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    ''' Time a side-effect free call, looping it enough times per sample for a stable reading '''
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    samples = [seconds / number for seconds in timer.repeat(repeat=repeat, number=number)]
+    return summarize(samples)
+
+
+def measure_with_setup(fn: Callable[[Any], Any], setup: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    ''' Time a call that mutates its input, with a fresh input from `setup` excluded from each sample '''
+    samples = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        fn(state)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def run_benchmarks(sizes: List[int], repeat: int, lang: str, selected: Optional[List[str]] = None):
+    plugins = [LyricGenerationPlugin, LyricLineCompletionPlugin, LyricStructureCompletionPlugin]
+    prompt = get_engine_registry().get_prompt(lang)
+    results = []
+
+    def want(benchmark: str) -> bool:
+        return selected is None or benchmark in selected
+
+    def record(benchmark: str, plugin, num_lines: int, timing: Dict[str, float]):
+        result = dict(benchmark=benchmark, plugin=plugin.plugin_id(), num_lines=num_lines, lang=lang, **timing)
+        results.append(result)
+        print(f"{benchmark:<10} {result['plugin']:<24} {num_lines:>6} lines {timing['median_seconds'] * 1e6:12.1f} us", file=sys.stderr)
+
+    for num_lines in sizes:
+        song = make_song(num_lines, lang=lang)
+        for plugin in plugins:
+            params = make_params(plugin, song, lang)
+            job = plugin._prepare(song, params)
+            if want("prompt"):
+                prompt_kwargs = {key: value for key, value in job["request"].items() if key != "temperature"}
+                record("prompt", plugin, num_lines, measure(lambda: prompt.get_chat_prompt(**prompt_kwargs), repeat))
+            if want("split"):
+                response = make_response(job["request"]["num_lines"], lang)
+                record("split", plugin, num_lines, measure(lambda: split_lyrics(response), repeat))
+            if want("context"):
+                record("context", plugin, num_lines, measure(lambda: plugin._prepare(song, params), repeat))
+            if want("edit") and num_lines > 0:
+                edits = iter(range(10 ** 6))
+                record("edit", plugin, num_lines, measure_with_setup(
+                    lambda edited: plugin._prepare(edited, params),
+                    lambda: edited_song(song, next(edits) * 7),
+                    repeat,
+                ))
+            if want("placement"):
+                lines = generated_lines(plugin, job, lang)
+                record("placement", plugin, num_lines, measure_with_setup(
+                    lambda fresh_job: plugin._apply(fresh_job, lines),
+                    lambda: plugin._prepare(clone_song(song), params),
+                    repeat,
+                ))
+            if want("run"):
+                record("run", plugin, num_lines, measure_with_setup(
+                    lambda fresh_song: plugin.run(fresh_song, params),
+                    lambda: clone_song(song),
+                    repeat,
+                ))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="numbers of lyric lines of the synthetic songs")
+    parser.add_argument("--repeat", type=int, default=5, help="number of samples per measurement")
+    parser.add_argument("--lang", choices=["en", "zh"], default="en", help="writing language of the synthetic songs")
+    parser.add_argument("--only", nargs="+", choices=["prompt", "split", "context", "edit", "placement", "run"], help="benchmarks to run, all by default")
+    parser.add_argument("--output", help="path of the JSON results, printed to stdout if not given")
+    args = parser.parse_args()
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "results": run_benchmarks(args.sizes, args.repeat, args.lang, args.only),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
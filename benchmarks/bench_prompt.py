@@ -0,0 +1,80 @@
+'''
+Micro-benchmark of the per-prompt render cost of LyricPrompt.
+Compares the legacy renderer, which rebuilt the requirement lists of both languages on every call,
+with the precompiled templates and the bulk render API.
+
+Usage: python benchmarks/bench_prompt.py [--number N]
+'''
+import argparse
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ai_prompt import LyricPrompt  # noqa: E402
+
+
+def legacy_user_prompt(prompt: LyricPrompt, user_demands: str, context_before: str = "", context_after: str = "", num_lines: int = 4):
+    ''' The renderer before templates were precompiled, kept as the baseline '''
+    requirements = {
+        "zh": list(LyricPrompt.REQUIREMENTS["zh"]),
+        "en": list(LyricPrompt.REQUIREMENTS["en"]),
+    }
+    if context_before.strip() != "":
+        requirements["zh"] += [LyricPrompt.CONTINUATION_REQUIREMENTS["zh"]]
+        requirements["en"] += [LyricPrompt.CONTINUATION_REQUIREMENTS["en"]]
+    if context_after.strip() != "":
+        requirements["zh"] += [LyricPrompt.INSERTION_REQUIREMENTS["zh"]]
+        requirements["en"] += [LyricPrompt.INSERTION_REQUIREMENTS["en"]]
+    content = {
+        "zh": "\n".join(requirements["zh"]),
+        "en": "\n".join(requirements["en"]),
+    }
+    return {
+        "role": "user",
+        "content": content[prompt.lang].format(
+            user_demands=user_demands,
+            error_message=prompt.error_message,
+            num_lines=num_lines,
+            context_before=context_before,
+            context_after=context_after,
+        )
+    }
+
+
+def make_requests(count: int):
+    return [
+        {
+            "user_demands": f"a pop song about dreams and hope #{i}",
+            "context_before": "\n".join(f"previous line {j}" for j in range(i % 16)),
+            "context_after": "following line" if i % 3 == 0 else "",
+            "num_lines": 1 + i % 8,
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="number of prompts rendered per measurement")
+    args = parser.parse_args()
+
+    requests = make_requests(args.number)
+    for lang in LyricPrompt.SUPPORT_LANGUAGES:
+        prompt = LyricPrompt(lang=lang)
+        # Render once so that the templates are compiled before measuring
+        prompt.render_chat_prompts(requests[:8])
+        timings = {
+            "legacy get_user_prompt": lambda: [legacy_user_prompt(prompt, **request) for request in requests],
+            "get_user_prompt": lambda: [prompt.get_user_prompt(**request) for request in requests],
+            "get_chat_prompt": lambda: [prompt.get_chat_prompt(**request) for request in requests],
+            "render_chat_prompts": lambda: prompt.render_chat_prompts(requests),
+        }
+        for name, fn in timings.items():
+            seconds = min(timeit.repeat(fn, number=1, repeat=5))
+            print(f"{lang}  {name:<24} {seconds / len(requests) * 1e6:8.2f} us/prompt")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''
+Synthetic songs and engine responses shared by the benchmarks.
+'''
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from tuneflow_py import Lyrics, LyricLine, Song, StructureType, TrackType  # noqa: E402
+
+from utils import LYRICS_END_TOKEN, LYRICS_START_TOKEN  # noqa: E402
+
+# Ticks of a synthetic lyric line and the gap to the next one
+LINE_TICKS = 1800
+LINE_GAP_TICKS = 200
+STRUCTURE_TYPES = [
+    StructureType.INTRO, StructureType.VERSE, StructureType.PRE_CHORUS,
+    StructureType.CHORUS, StructureType.BRIDGE, StructureType.OUTRO,
+]
+WORDS = {
+    "en": "dreams hope light fading away love stars night river burning heart sunset".split(),
+    "zh": list("梦想希望光芒消失爱星夜河燃烧心日落"),
+}
+
+
+def make_sentence(index: int, lang: str = "en") -> str:
+    words = WORDS[lang]
+    sentence = [words[(index * 7 + i) % len(words)] for i in range(4 + index % 5)]
+    return (" " if lang == "en" else "").join(sentence)
+
+
+def make_song(num_lines: int, lines_per_structure: int = 8, lang: str = "en") -> Song:
+    '''
+    A song of `num_lines` lyric lines with a structure every `lines_per_structure` lines,
+    and a MIDI clip spanning the song so that the last structure ends at the last tick.
+    Lines are appended to the protos in tick order, as `Lyrics.create_line_from_string`
+    sorts all lines on every insert and would dominate the setup of large songs.
+    '''
+    song = Song()
+    lyrics = Lyrics(song)
+    for i in range(num_lines):
+        start_tick = i * (LINE_TICKS + LINE_GAP_TICKS)
+        line = LyricLine(lyrics=lyrics, start_tick=start_tick, proto=lyrics._proto.lines.add())
+        tokens = LyricLine.default_lyric_tokenizer(make_sentence(i, lang))
+        ticks_per_word = LINE_TICKS // len(tokens)
+        del line._proto.words[:]
+        for j, word in enumerate(tokens):
+            line._proto.words.add(
+                word=word, start_tick=start_tick + j * ticks_per_word, end_tick=start_tick + (j + 1) * ticks_per_word)
+    for i in range(0, max(num_lines, 1), lines_per_structure):
+        song.create_structure(i * (LINE_TICKS + LINE_GAP_TICKS), STRUCTURE_TYPES[(i // lines_per_structure) % len(STRUCTURE_TYPES)])
+    track = song.create_track(type=TrackType.MIDI_TRACK)
+    last_tick = max(num_lines, 1) * (LINE_TICKS + LINE_GAP_TICKS)
+    clip = track.create_midi_clip(clip_start_tick=0, clip_end_tick=last_tick)
+    clip.create_note(pitch=60, velocity=80, start_tick=0, end_tick=last_tick)
+    return song
+
+
+def clone_song(song: Song) -> Song:
+    clone = Song()
+    clone._proto.CopyFrom(song._proto)
+    return clone
+
+
+def make_response(num_lines: int, lang: str = "en") -> str:
+    ''' An engine response of `num_lines` lyric lines '''
+    lines = [make_sentence(i, lang) for i in range(num_lines)]
+    return "\n".join([LYRICS_START_TOKEN] + lines + [LYRICS_END_TOKEN])
@@ -0,0 +1,163 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from tuneflow_py import LyricWord, Song
+
+from context_compaction import ContextCompactor
+
+
+def read_sentences(song: Song) -> List[str]:
+    '''
+    The sentences of the lyric lines of a song, like `LyricLine.get_sentence`,
+    read from the line protos without wrapping every line.
+    '''
+    sentences = []
+    for proto in song._proto.lyrics.lines:
+        sentence = "".join([word.word for word in proto.words])
+        # An empty line only holds its placeholder word
+        sentences.append("" if sentence == LyricWord.PLACEHOLDER_WORD and len(proto.words) == 1 else sentence)
+    return sentences
+
+
+def content_hash(sentences: List[str]) -> str:
+    return hashlib.blake2b("\n".join(sentences).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class LyricContext:
+    '''
+    The lyric lines of a song, with the compacted context before and after each line index built on demand and kept.
+    The contexts are only rebuilt for the indices an edit reaches:
+    the context before index `i` depends on the lines before `i`, and the context after it on the lines from `i` on.
+
+    Args:
+        compactor (ContextCompactor): Fits the contexts into the token budget.
+        sentences (List[str]): The sentences of the lyric lines.
+    '''
+
+    def __init__(self, compactor: ContextCompactor, sentences: List[str], digest: Optional[str] = None) -> None:
+        self.compactor = compactor
+        self.sentences = sentences
+        self.digest = digest or content_hash(sentences)
+        # (end index, budget) -> context before, (start index, budget) -> context after and its tokens
+        self._before: Dict[Tuple[int, int], str] = {}
+        self._after: Dict[Tuple[int, int], Tuple[str, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.sentences)
+
+    def context_before(self, end: int, budget: int) -> str:
+        ''' The compacted context of the lines before index `end` '''
+        key = (end, budget)
+        if key not in self._before:
+            self._before[key] = self.compactor.compact_before(self.sentences[:end], budget) if end > 0 else ""
+        return self._before[key]
+
+    def context_after(self, start: int, budget: int) -> Tuple[str, int]:
+        ''' The compacted context of the lines from index `start` on, and its number of tokens '''
+        key = (start, budget)
+        if key not in self._after:
+            context = self.compactor.compact_after(self.sentences[start:], budget) if start < len(self.sentences) else ""
+            self._after[key] = (context, self.compactor.count_context_tokens(context))
+        return self._after[key]
+
+    def context(self, before_end: int, after_start: int) -> Tuple[str, str]:
+        '''
+        The context before index `before_end` and after index `after_start` (inclusive), compacted into the token budget.
+        The budget is shared evenly when both sides are present, and the unused part of the context after
+        is left to the context before, which matters more to continuation.
+        '''
+        budget = self.compactor.after_budget(before_end > 0)
+        context_after, after_tokens = self.context_after(after_start, budget)
+        return self.context_before(before_end, self.compactor.max_tokens - after_tokens), context_after
+
+    def splice(self, start: int, end: int, sentences: List[str], digest: Optional[str] = None) -> "LyricContext":
+        '''
+        A context of the lines where lines [start, end) are replaced with `sentences`, which covers
+        inserted (`start == end`), removed (no `sentences`) and replaced lines.
+        The contexts before the edit and after it are carried over, the latter shifted to the new indices.
+        '''
+        spliced = LyricContext(self.compactor, self.sentences[:start] + sentences + self.sentences[end:], digest)
+        shift = len(sentences) - (end - start)
+        spliced._before = {key: value for key, value in self._before.items() if key[0] <= start}
+        spliced._after = {(index + shift, budget): value for (index, budget), value in self._after.items() if index >= end}
+        return spliced
+
+    def update(self, sentences: List[str], digest: Optional[str] = None) -> "LyricContext":
+        ''' A context of the lines `sentences`, spliced from this one over the lines they differ in '''
+        limit = min(len(self.sentences), len(sentences))
+        start = 0
+        while start < limit and self.sentences[start] == sentences[start]:
+            start += 1
+        suffix = 0
+        while suffix < limit - start and self.sentences[-1 - suffix] == sentences[-1 - suffix]:
+            suffix += 1
+        return self.splice(start, len(self.sentences) - suffix, sentences[start:len(sentences) - suffix], digest)
+
+
+class ContextCache:
+    '''
+    An LRU cache of the lyric contexts of the songs being edited, keyed by the song id and the content hash of the lines.
+    Songs arrive deserialized from scratch on every plugin run, so the lines are read once per run,
+    but the contexts of a song are spliced incrementally from its previous version over the lines that changed,
+    rather than rebuilding the prefix and suffix of every edited position.
+
+    Args:
+        compactor (ContextCompactor): Fits the contexts into the token budget.
+        max_songs (int): The maximum number of songs kept. 0 disables the cache.
+    '''
+
+    def __init__(self, compactor: ContextCompactor, max_songs: int = 64) -> None:
+        self.compactor = compactor
+        self.max_songs = max_songs
+        self._songs: "OrderedDict[str, LyricContext]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.updates = 0
+        self.misses = 0
+
+    @staticmethod
+    def song_id(song: Song, digest: str) -> str:
+        '''
+        The ids of the tracks of a song, which persist through the edits of the song.
+        Songs of the same id are still told apart by their content hash `digest`.
+        Songs carry no id of their own, so a song without tracks is identified by its content hash,
+        rather than sharing one entry with every other song without tracks.
+        '''
+        track_ids = ",".join(track.uuid for track in song._proto.tracks)
+        return f"tracks:{track_ids}" if track_ids else f"content:{digest}"
+
+    def get(self, song: Song) -> LyricContext:
+        ''' The lyric context of the current lines of `song` '''
+        sentences = read_sentences(song)
+        digest = content_hash(sentences)
+        song_id = self.song_id(song, digest)
+        with self._lock:
+            cached = self._songs.get(song_id)
+            if cached is not None and cached.digest == digest:
+                self._songs.move_to_end(song_id)
+                self.hits += 1
+                return cached
+            if cached is None:
+                self.misses += 1
+                context = LyricContext(self.compactor, sentences, digest)
+            else:
+                self.updates += 1
+                context = cached.update(sentences, digest)
+            if self.max_songs > 0:
+                self._songs[song_id] = context
+                self._songs.move_to_end(song_id)
+                while len(self._songs) > self.max_songs:
+                    self._songs.popitem(last=False)
+            return context
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "updates": self.updates,
+                "misses": self.misses,
+                "size": len(self._songs),
+                "max_size": self.max_songs,
+            }
@@ -0,0 +1,93 @@
+import functools
+from typing import List, Tuple
+
+from token_budget import count_tokens
+
+# Marker of a digest line that stands for a collapsed section of distant lyrics
+DIGEST_PREFIX = "..."
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_line_tokens(line: str) -> int:
+    # One more token for the line break
+    return count_tokens(line) + 1
+
+
+@functools.lru_cache(maxsize=4096)
+def digest_section(section: Tuple[str, ...]) -> str:
+    '''
+    Collapse a section of lyric lines into a compact one-line digest made of its first and last lines.
+    Digests are cached, so sections far from the edited position are only digested once.
+    '''
+    if len(section) == 1:
+        return f"{DIGEST_PREFIX} {section[0]}"
+    return f"{DIGEST_PREFIX} {section[0]} / {section[-1]}"
+
+
+class ContextCompactor:
+    '''
+    Fits the lyric context of a request into a prompt-token budget.
+    The nearest lines are kept verbatim, and distant lines are collapsed into section digests,
+    so that the prompt size grows with the budget rather than with the song length.
+
+    Args:
+        max_tokens (int): The token budget of the context before and after the generated lyrics together.
+        keep_lines (int): The maximum number of nearest lines kept verbatim on each side.
+        section_lines (int): The number of distant lines collapsed into one digest.
+    '''
+
+    def __init__(self, max_tokens: int = 1024, keep_lines: int = 16, section_lines: int = 8) -> None:
+        self.max_tokens = max_tokens
+        self.keep_lines = keep_lines
+        self.section_lines = max(section_lines, 1)
+
+    def _sections(self, lines: List[str]) -> List[Tuple[str, ...]]:
+        # Sections are aligned to the first line, so the digests stay stable while lyrics are appended
+        return [tuple(lines[i:i + self.section_lines]) for i in range(0, len(lines), self.section_lines)]
+
+    def _fit(self, nearest_first: List[str], distant_sections: List[Tuple[str, ...]], budget: int) -> Tuple[List[str], List[str]]:
+        ''' Select the verbatim lines and digests, both ordered from the nearest, that fit into the budget '''
+        verbatim, digests = [], []
+        for line in nearest_first:
+            cost = _count_line_tokens(line)
+            if cost > budget:
+                return verbatim, digests
+            verbatim.append(line)
+            budget -= cost
+        for section in distant_sections:
+            digest = digest_section(section)
+            cost = _count_line_tokens(digest)
+            if cost > budget:
+                break
+            digests.append(digest)
+            budget -= cost
+        return verbatim, digests
+
+    def compact_before(self, lines: List[str], budget: int) -> str:
+        ''' Compact the lyrics before the generated part, where the nearest lines are the last ones '''
+        split = max(len(lines) - self.keep_lines, 0)
+        verbatim, digests = self._fit(
+            list(reversed(lines[split:])),
+            list(reversed(self._sections(lines[:split]))),
+            budget,
+        )
+        if len(verbatim) < len(lines) - split:
+            # The budget is used up by the nearest lines, skip the digests
+            digests = []
+        return "\n".join(list(reversed(digests)) + list(reversed(verbatim)))
+
+    def compact_after(self, lines: List[str], budget: int) -> str:
+        ''' Compact the lyrics after the generated part, where the nearest lines are the first ones '''
+        split = min(self.keep_lines, len(lines))
+        verbatim, digests = self._fit(lines[:split], self._sections(lines[split:]), budget)
+        if len(verbatim) < split:
+            digests = []
+        return "\n".join(verbatim + digests)
+
+    def after_budget(self, has_before: bool) -> int:
+        ''' The budget of the context after, shared evenly with the context before if there is one '''
+        return self.max_tokens // 2 if has_before else self.max_tokens
+
+    @staticmethod
+    def count_context_tokens(context: str) -> int:
+        return sum(_count_line_tokens(line) for line in context.split("\n")) if context else 0
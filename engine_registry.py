@@ -0,0 +1,215 @@
+import asyncio
+import functools
+import threading
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+import metrics
+from ai_prompt import LyricPrompt
+from backends import MOCK_MODE, Backend
+from context_cache import ContextCache
+from context_compaction import ContextCompactor
+
+if TYPE_CHECKING:
+    import aiohttp
+    import requests
+
+    from ai_api import BaseAPI
+    from ai_config import AIConfig
+
+
+class EngineRegistry:
+    '''
+    A process-wide registry of engine APIs.
+    The configuration, prompts and engines are built once and reused by every plugin run,
+    and the engines share pooled keep-alive HTTP sessions instead of opening a new connection per request,
+    with a connection pool sized for each backend server.
+    The OpenAI client and the HTTP stack are only imported when the first engine is built,
+    so that the plugin service starts without loading them.
+
+    Args:
+        cfg (AIConfig): The configuration to build engines with. Read from the environment if not given.
+    '''
+
+    def __init__(self, cfg: Optional["AIConfig"] = None) -> None:
+        self._cfg = cfg
+        self._prompts: Dict[str, LyricPrompt] = {}
+        self._engines: Dict[Tuple[str, str], "BaseAPI"] = {}
+        self._compactor: Optional[ContextCompactor] = None
+        self._context_cache: Optional[ContextCache] = None
+        self._session: Optional["requests.Session"] = None
+        self._mounted: Dict[str, int] = {}
+        self._aiosessions: Dict[Tuple[asyncio.AbstractEventLoop, str], "aiohttp.ClientSession"] = {}
+        self._lock = threading.RLock()
+
+    def get_config(self) -> "AIConfig":
+        with self._lock:
+            if self._cfg is None:
+                with metrics.span("config_setup"):
+                    from ai_config import AIConfig
+                    self._cfg = AIConfig()
+            return self._cfg
+
+    def get_prompt(self, lang: str) -> LyricPrompt:
+        with self._lock:
+            if lang not in self._prompts:
+                self._prompts[lang] = LyricPrompt(lang=lang)
+            return self._prompts[lang]
+
+    def get_engine(self, lang: str, engine_name: Optional[str] = None) -> "BaseAPI":
+        '''
+        Return the engine API that writes lyrics in `lang`, of the configured engine if `engine_name` is not given.
+        Slow async calls of the configured engine are hedged with the configured hedge engine.
+        Engines are built outside the lock, which is only taken to publish them, so that building the first engine,
+        which imports the OpenAI client, e.g. in `awarm_up`, does not block the callers of engines already built.
+        '''
+        cfg = self.get_config()
+        key = (engine_name or cfg.get_openai_api_engine(), lang)
+        with self._lock:
+            engine = self._engines.get(key)
+        if engine is not None:
+            return engine
+        with metrics.span("engine_setup", engine=key[0]):
+            from ai_api import get_engine_api
+            engine = get_engine_api(cfg=cfg, prompt=self.get_prompt(lang), engine=key[0])
+        hedge_engine = cfg.get_hedge_engine()
+        if hedge_engine and hedge_engine != key[0]:
+            engine.hedge_engine = self.get_engine(lang, hedge_engine)
+        with self._lock:
+            if key in self._engines:
+                # Another caller built the engine first
+                return self._engines[key]
+            self._mount(engine.backend)
+            engine.session_factory = self.get_session
+            engine.aiosession_factory = functools.partial(self.get_aiosession, engine.backend)
+            self._engines[key] = engine
+            return engine
+
+    def get_plugin_engine(self, plugin_id: str, lang: str) -> "BaseAPI":
+        ''' Return the engine API of a plugin, configured in `OPENAI_API_PLUGIN_ENGINES`, that writes lyrics in `lang`. '''
+        return self.get_engine(lang, self.get_config().get_plugin_engine(plugin_id))
+
+    def get_context_compactor(self) -> ContextCompactor:
+        with self._lock:
+            if self._compactor is None:
+                cfg = self.get_config()
+                self._compactor = ContextCompactor(
+                    max_tokens=cfg.get_context_max_tokens(),
+                    keep_lines=cfg.get_context_keep_lines(),
+                )
+            return self._compactor
+
+    def get_context_cache(self) -> ContextCache:
+        ''' The lyric contexts of the songs being edited, shared by the plugin runs '''
+        with self._lock:
+            if self._context_cache is None:
+                self._context_cache = ContextCache(
+                    self.get_context_compactor(), max_songs=self.get_config().get_context_cache_size())
+            return self._context_cache
+
+    def get_session(self) -> "requests.Session":
+        '''
+        The keep-alive session shared by blocking requests of all engines.
+        It lives as long as the registry: engines bind it to each request, see `BaseAPI._bind_session`.
+        '''
+        with self._lock:
+            if self._session is None:
+                import requests
+                pool_size = self.get_config().get_openai_pool_size()
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def _mount(self, backend: Backend) -> None:
+        ''' Give a self-hosted backend a connection pool of its own size in the shared session '''
+        import requests
+        session = self.get_session()
+        if backend.api_base is None or backend.api_base in self._mounted:
+            return
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=backend.pool_size, max_retries=2)
+        # Requests picks the adapter of the longest matching prefix
+        session.mount(backend.api_base + "/", adapter)
+        self._mounted[backend.api_base] = backend.pool_size
+
+    def get_aiosession(self, backend: Optional[Backend] = None) -> "aiohttp.ClientSession":
+        ''' The keep-alive session of a backend shared by coroutines on the running event loop. '''
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        key = (loop, backend.api_base or "") if backend is not None else (loop, "")
+        with self._lock:
+            for closed_key in [key for key in self._aiosessions if key[0].is_closed()]:
+                del self._aiosessions[closed_key]
+            session = self._aiosessions.get(key)
+            if session is None or session.closed:
+                if backend is not None and backend.api_base is not None:
+                    pool_size = backend.pool_size
+                else:
+                    pool_size = self.get_config().get_openai_pool_size()
+                session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size))
+                self._aiosessions[key] = session
+            return session
+
+    def _api_bases(self) -> List[str]:
+        ''' The servers of the engines built so far '''
+        import openai
+        with self._lock:
+            return sorted({engine.backend.api_base or openai.api_base for engine in self._engines.values()
+                           if engine.backend.mode != MOCK_MODE})
+
+    def warm_up(self, langs: Iterable[str] = LyricPrompt.SUPPORT_LANGUAGES) -> None:
+        '''
+        Build the engines and open a connection to the API server ahead of the first request,
+        so that cold requests do not pay for config parsing and the TLS handshake.
+        '''
+        cfg = self.get_config()
+        # The configured engine and the engines of specific plugins
+        engine_names = {None, *cfg.get_plugin_engines().values()}
+        for lang in langs:
+            for engine_name in engine_names:
+                self.get_engine(lang, engine_name)
+        import requests
+        for api_base in self._api_bases():
+            try:
+                self.get_session().head(api_base, timeout=5)
+            except requests.RequestException:
+                pass
+
+    async def awarm_up(self, langs: Iterable[str] = LyricPrompt.SUPPORT_LANGUAGES) -> None:
+        ''' Coroutine version of `warm_up` that also opens the connection pool of the event loop. '''
+        await asyncio.get_running_loop().run_in_executor(None, self.warm_up, tuple(langs))
+        import aiohttp
+        import openai
+        backends = {engine.backend.api_base: engine.backend for engine in list(self._engines.values())
+                    if engine.backend.mode != MOCK_MODE}
+        for api_base, backend in backends.items():
+            try:
+                async with self.get_aiosession(backend).head(
+                        api_base or openai.api_base, timeout=aiohttp.ClientTimeout(total=5)):
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+
+    async def aclose(self) -> None:
+        ''' Close the sessions of the running event loop. '''
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            sessions = [self._aiosessions.pop(key) for key in list(self._aiosessions) if key[0] is loop]
+        for session in sessions:
+            await session.close()
+
+
+_ENGINE_REGISTRY: Optional[EngineRegistry] = None
+_ENGINE_REGISTRY_LOCK = threading.Lock()
+
+
+def get_engine_registry() -> EngineRegistry:
+    ''' Return the process-wide engine registry '''
+    global _ENGINE_REGISTRY
+    with _ENGINE_REGISTRY_LOCK:
+        if _ENGINE_REGISTRY is None:
+            _ENGINE_REGISTRY = EngineRegistry()
+        return _ENGINE_REGISTRY
@@ -0,0 +1,155 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+# Weights of the priority classes of plugin jobs.
+# A class of twice the weight is served twice as often under contention,
+# so quick line completions go ahead of structure completions and full generations.
+PRIORITY_WEIGHTS = {
+    "line": 4.0,
+    "structure": 2.0,
+    "generate": 1.0,
+}
+DEFAULT_PRIORITY_CLASS = "generate"
+
+
+class _Waiter:
+    def __init__(self, user: str, priority_class: str, start: float, finish: float, future: Optional[asyncio.Future]) -> None:
+        self.user = user
+        self.priority_class = priority_class
+        self.start = start
+        self.finish = finish
+        self.future = future
+        self.granted = False
+        self.cancelled = False
+
+
+class FairScheduler:
+    '''
+    Admits plugin jobs with start-time weighted fair queueing across users.
+    Each job is tagged with a virtual finish time that grows with the queued work of its user,
+    divided by the weight of its priority class, and free slots go to the smallest tag.
+    So a user bulk-generating songs only delays others by their fair share,
+    and no user runs more than `max_per_user` jobs at once.
+
+    Args:
+        capacity (int): The maximum number of jobs running at once.
+        max_per_user (int): The maximum number of jobs of one user running at once.
+    '''
+
+    def __init__(self, capacity: int = 16, max_per_user: int = 4) -> None:
+        self.capacity = max(capacity, 1)
+        self.max_per_user = max(max_per_user, 1)
+        self.running = 0
+        self.running_per_user: Dict[str, int] = {}
+        self.virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self._queue: List = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _waiter(self, user: str, priority_class: str, future: Optional[asyncio.Future]) -> _Waiter:
+        ''' Tag a job with its virtual start and finish times '''
+        weight = PRIORITY_WEIGHTS.get(priority_class, PRIORITY_WEIGHTS[DEFAULT_PRIORITY_CLASS])
+        start = max(self.virtual_time, self._last_finish.get(user, 0.0))
+        finish = self._last_finish[user] = start + 1.0 / weight
+        return _Waiter(user, priority_class, start, finish, future)
+
+    def _grant(self, waiter: _Waiter) -> None:
+        waiter.granted = True
+        self.running += 1
+        self.running_per_user[waiter.user] = self.running_per_user.get(waiter.user, 0) + 1
+        # The virtual clock follows the start tag of the job in service
+        self.virtual_time = max(self.virtual_time, waiter.start)
+
+    def _dispatch(self) -> None:
+        ''' Grant free slots to the queued jobs of the smallest tags whose users are under the cap '''
+        deferred = []
+        while self._queue and self.running < self.capacity:
+            entry = heapq.heappop(self._queue)
+            waiter = entry[2]
+            if waiter.cancelled:
+                continue
+            if self.running_per_user.get(waiter.user, 0) >= self.max_per_user:
+                deferred.append(entry)
+                continue
+            self._grant(waiter)
+            waiter.future.get_loop().call_soon_threadsafe(_resolve, waiter.future)
+        for entry in deferred:
+            heapq.heappush(self._queue, entry)
+
+    async def acquire(self, user: str, priority_class: str = DEFAULT_PRIORITY_CLASS) -> None:
+        ''' Wait for a slot of the user, see `slot` '''
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._queue and self.running < self.capacity and self.running_per_user.get(user, 0) < self.max_per_user:
+                self._grant(self._waiter(user, priority_class, None))
+                return
+            waiter = self._waiter(user, priority_class, loop.create_future())
+            heapq.heappush(self._queue, (waiter.finish, next(self._counter), waiter))
+            self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                # A job granted a slot right before its cancellation gives the slot back
+                granted = waiter.granted
+                waiter.cancelled = True
+            if granted:
+                self.release(user)
+            raise
+
+    def release(self, user: str) -> None:
+        with self._lock:
+            self.running -= 1
+            self.running_per_user[user] -= 1
+            if self.running_per_user[user] <= 0:
+                del self.running_per_user[user]
+            if not self.running_per_user and not self._queue:
+                # Idle, restart the virtual clock so that tags do not grow without bound
+                self.virtual_time = 0.0
+                self._last_finish.clear()
+            self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user: str, priority_class: str = DEFAULT_PRIORITY_CLASS):
+        ''' Hold a slot of the user for the duration of a job '''
+        await self.acquire(user, priority_class)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            queued: Dict[str, int] = defaultdict(int)
+            for _, _, waiter in self._queue:
+                if not waiter.cancelled:
+                    queued[waiter.priority_class] += 1
+            return {
+                "running": self.running,
+                "queued": dict(queued),
+                "running_per_user": dict(self.running_per_user),
+            }
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+_FAIR_SCHEDULER: Optional[FairScheduler] = None
+_FAIR_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_fair_scheduler(cfg) -> FairScheduler:
+    ''' Return the process-wide fair scheduler of plugin jobs sized by `cfg` (an AIConfig) '''
+    global _FAIR_SCHEDULER
+    with _FAIR_SCHEDULER_LOCK:
+        if _FAIR_SCHEDULER is None:
+            _FAIR_SCHEDULER = FairScheduler(cfg.get_max_concurrency(), cfg.get_max_concurrency_per_user())
+        return _FAIR_SCHEDULER
@@ -0,0 +1,114 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+# Latencies kept per kind of call to estimate the hedging deadline,
+# and the number of them needed before any call is hedged
+HEDGE_HISTORY_SIZE = 256
+HEDGE_MIN_SAMPLES = 20
+
+
+class HedgePolicy:
+    '''
+    Decides when a slow engine call is hedged with a second request.
+    The deadline is the `percentile` of the recent latencies of the same kind of call
+    (e.g. full-song generation or a single line), but not less than `min_delay`,
+    so that only calls in the slow tail are duplicated.
+    No call is hedged until enough latencies are known.
+
+    Args:
+        percentile (float): The latency percentile after which a call is hedged, 0 disables hedging.
+        min_delay (float): The minimum seconds to wait before hedging.
+    '''
+
+    def __init__(self, percentile: float = 95, min_delay: float = 1.0) -> None:
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self._latencies: Dict[Hashable, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return 0 < self.percentile < 100
+
+    def observe(self, kind: Hashable, latency: float) -> None:
+        with self._lock:
+            if kind not in self._latencies:
+                self._latencies[kind] = deque(maxlen=HEDGE_HISTORY_SIZE)
+            self._latencies[kind].append(latency)
+
+    def deadline(self, kind: Hashable) -> Optional[float]:
+        ''' Seconds to wait on a call of `kind` before hedging it, None if it is not hedged '''
+        if not self.enabled:
+            return None
+        with self._lock:
+            latencies = sorted(self._latencies.get(kind, ()))
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(math.ceil(len(latencies) * self.percentile / 100) - 1, len(latencies) - 1)
+        return max(latencies[max(index, 0)], self.min_delay)
+
+
+class HedgeOutcome:
+    '''
+    The result of a hedged call, whether the backup was started and won,
+    and the seconds each call took to succeed, None for a call that failed, was cancelled or was not started.
+    Only those latencies are real completion times, a cancelled call was cut short.
+    '''
+
+    def __init__(self, result: Any, hedged: bool, backup_won: bool, primary_seconds: Optional[float],
+                 backup_seconds: Optional[float] = None) -> None:
+        self.result = result
+        self.hedged = hedged
+        self.backup_won = backup_won
+        self.primary_seconds = primary_seconds
+        self.backup_seconds = backup_seconds
+
+    @property
+    def latencies(self) -> List[float]:
+        ''' The latencies of the calls that completed '''
+        return [seconds for seconds in (self.primary_seconds, self.backup_seconds) if seconds is not None]
+
+
+async def ahedge(primary: Callable[[], Awaitable[Any]], backup: Callable[[], Awaitable[Any]],
+                 delay: Optional[float]) -> HedgeOutcome:
+    '''
+    Await `primary`, and if it has not finished within `delay` seconds, start `backup` as well.
+    The first call to succeed wins and the other one is cancelled.
+    If one of them fails while the other is still running, the other one is awaited instead,
+    and if both fail the error of the primary is raised.
+    '''
+    start_time = time.perf_counter()
+    primary_task = asyncio.ensure_future(primary())
+    try:
+        done, _ = await asyncio.wait({primary_task}, timeout=delay)
+    except asyncio.CancelledError:
+        primary_task.cancel()
+        raise
+    if done:
+        return HedgeOutcome(primary_task.result(), False, False, time.perf_counter() - start_time)
+
+    backup_start_time = time.perf_counter()
+    backup_task = asyncio.ensure_future(backup())
+    pending = {primary_task, backup_task}
+    seconds: Dict[asyncio.Future, float] = {}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    seconds[task] = time.perf_counter() - (backup_start_time if task is backup_task else start_time)
+            # The primary goes first when both finish at once
+            for task in sorted(done, key=lambda task: task is backup_task):
+                if task.exception() is None:
+                    return HedgeOutcome(
+                        task.result(), True, task is backup_task, seconds.get(primary_task), seconds.get(backup_task))
+        return HedgeOutcome(primary_task.result(), True, False, None)
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
@@ -0,0 +1,202 @@
+import atexit
+import contextlib
+import contextvars
+import functools
+import inspect
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Prices in USD per 1K prompt and completion tokens of each engine
+ENGINE_PRICES = {
+    "text-davinci-003": (0.02, 0.02),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "mock": (0.0, 0.0),
+}
+# Columns the usage can be grouped by in queries
+GROUP_COLUMNS = ("plugin", "engine", "user")
+
+# The plugin and user the engine calls of the current plugin run are accounted to
+_USAGE_SCOPE: contextvars.ContextVar = contextvars.ContextVar("usage_scope", default={})
+
+
+@contextlib.contextmanager
+def usage_scope(**labels):
+    ''' Account the engine calls within the block to `labels` (`plugin` and/or `user`), nested scopes are merged '''
+    token = _USAGE_SCOPE.set({**_USAGE_SCOPE.get(), **labels})
+    try:
+        yield
+    finally:
+        _USAGE_SCOPE.reset(token)
+
+
+def scoped(**labels) -> Callable:
+    ''' Decorate a function or coroutine function to run within `usage_scope(**labels)` '''
+    def decorator(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with usage_scope(**labels):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with usage_scope(**labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def estimate_cost(engine: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = ENGINE_PRICES.get(engine, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class UsageLedger:
+    '''
+    An append-only SQLite ledger of the tokens and estimated cost of every engine call,
+    accounted to the plugin, engine and user of the call.
+    Records are buffered in memory and written in batches by a background thread,
+    so that requests never wait on the disk.
+
+    Args:
+        path (str): Path of the SQLite file.
+        flush_interval (float): Seconds between the writes of buffered records.
+        batch_size (int): Number of buffered records that triggers a write before the interval elapses.
+    '''
+
+    def __init__(self, path: str, flush_interval: float = 5.0, batch_size: int = 256) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = max(batch_size, 1)
+        self._buffer: List[Tuple] = []
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            "created REAL NOT NULL, plugin TEXT NOT NULL, engine TEXT NOT NULL, user TEXT NOT NULL, "
+            "prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, lines INTEGER NOT NULL, cost REAL NOT NULL, "
+            "hedge INTEGER NOT NULL DEFAULT 0)")
+        self._db.commit()
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def record(self, engine: str, prompt_tokens: int, completion_tokens: int, lines: int = 0,
+               plugin: Optional[str] = None, user: Optional[str] = None, hedge: bool = False) -> None:
+        '''
+        Buffer the usage of an engine call. The plugin and user default to those of the current `usage_scope`.
+        `hedge` marks the spend of hedged calls that lost to another call, see `hedging`.
+        '''
+        scope = _USAGE_SCOPE.get()
+        row = (
+            time.time(),
+            plugin or scope.get("plugin", "unknown"),
+            engine,
+            user or scope.get("user", "unknown"),
+            prompt_tokens,
+            completion_tokens,
+            lines,
+            estimate_cost(engine, prompt_tokens, completion_tokens),
+            int(hedge),
+        )
+        with self._lock:
+            self._buffer.append(row)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def flush(self) -> None:
+        ''' Write the buffered records in one transaction '''
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return
+        with self._db_lock:
+            self._db.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+
+    def _query(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        self.flush()
+        with self._db_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _check_group(by: str) -> None:
+        if by not in GROUP_COLUMNS:
+            raise ValueError(f"Invalid group column: {by}, expected one of {GROUP_COLUMNS}")
+
+    def top_spenders(self, by: str = "user", limit: int = 10, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        ''' The users, plugins or engines of the highest estimated cost since the `since` timestamp, the highest first '''
+        self._check_group(by)
+        rows = self._query(
+            f"SELECT {by}, SUM(cost), SUM(prompt_tokens), SUM(completion_tokens), COUNT(*) FROM usage "
+            f"WHERE created >= ? GROUP BY {by} ORDER BY SUM(cost) DESC LIMIT ?",
+            (since or 0, limit),
+        )
+        return [
+            {by: key, "cost": cost, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "calls": calls}
+            for key, cost, prompt_tokens, completion_tokens, calls in rows
+        ]
+
+    def tokens_per_line(self, by: str = "plugin", since: Optional[float] = None) -> Dict[str, Dict[str, float]]:
+        '''
+        Prompt and completion tokens per generated line of each plugin, engine or user since the `since` timestamp.
+        Calls that produced no lines are left out.
+        '''
+        self._check_group(by)
+        rows = self._query(
+            f"SELECT {by}, SUM(prompt_tokens), SUM(completion_tokens), SUM(lines) FROM usage "
+            f"WHERE created >= ? AND lines > 0 GROUP BY {by}",
+            (since or 0,),
+        )
+        return {
+            key: {"prompt_tokens": prompt_tokens / lines, "completion_tokens": completion_tokens / lines, "lines": lines}
+            for key, prompt_tokens, completion_tokens, lines in rows
+        }
+
+    def hedge_spend(self, by: str = "engine", since: Optional[float] = None) -> Dict[str, Dict[str, float]]:
+        ''' The extra tokens and cost of hedging of each plugin, engine or user since the `since` timestamp '''
+        self._check_group(by)
+        rows = self._query(
+            f"SELECT {by}, SUM(prompt_tokens), SUM(cost), COUNT(*) FROM usage WHERE created >= ? AND hedge = 1 GROUP BY {by}",
+            (since or 0,),
+        )
+        return {key: {"prompt_tokens": prompt_tokens, "cost": cost, "calls": calls} for key, prompt_tokens, cost, calls in rows}
+
+
+_USAGE_LEDGER: Optional[UsageLedger] = None
+_USAGE_LEDGER_LOCK = threading.Lock()
+
+
+def get_usage_ledger(cfg) -> Optional[UsageLedger]:
+    '''
+    Return the process-wide usage ledger configured by `cfg` (an AIConfig),
+    or None if no ledger path is configured.
+    '''
+    global _USAGE_LEDGER
+    if not cfg.get_ledger_path():
+        return None
+    with _USAGE_LEDGER_LOCK:
+        if _USAGE_LEDGER is None:
+            _USAGE_LEDGER = UsageLedger(cfg.get_ledger_path(), flush_interval=cfg.get_ledger_flush_interval())
+        return _USAGE_LEDGER
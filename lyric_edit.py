@@ -0,0 +1,49 @@
+from typing import Iterable, List, Tuple
+
+from tuneflow_py import LyricLine, Lyrics
+
+
+def _runs(indices: List[int]) -> List[Tuple[int, int]]:
+    ''' Group sorted indices into [start, end) runs of consecutive indices '''
+    runs = []
+    for index in indices:
+        if runs and runs[-1][1] == index:
+            runs[-1] = (runs[-1][0], index + 1)
+        else:
+            runs.append((index, index + 1))
+    return runs
+
+
+def _fill_line(lyrics: Lyrics, sentence: str, start_tick: int, end_tick: int) -> None:
+    '''
+    Append a line of words spread evenly over [start_tick, end_tick], like `Lyrics.create_line_from_string`,
+    without re-sorting all lines of the song after every word.
+    '''
+    line = LyricLine(lyrics=lyrics, start_tick=start_tick, proto=lyrics._proto.lines.add())
+    tokens = LyricLine.default_lyric_tokenizer(sentence) if sentence else []
+    if len(tokens) == 0:
+        # An empty line keeps its placeholder word
+        return
+    tick_per_word = (end_tick - start_tick) // len(tokens)
+    words = line._proto.words
+    del words[:]
+    for i, word in enumerate(tokens):
+        # The last word ends at the end tick of the line
+        end = start_tick + (i + 1) * tick_per_word if i < len(tokens) - 1 else end_tick
+        words.add(word=word, start_tick=start_tick + i * tick_per_word, end_tick=end)
+
+
+def replace_lines(lyrics: Lyrics, indices: Iterable[int], new_lines: Iterable[Tuple[str, int, int]]) -> None:
+    '''
+    Replace the lyric lines at `indices` with `new_lines` of (sentence, start tick, end tick) in one edit.
+    Removed lines are deleted by runs of consecutive indices, new lines are appended,
+    and the lines are sorted once at the end, rather than shifting and re-sorting the lines on every change.
+    '''
+    for start, end in reversed(_runs(sorted(set(indices)))):
+        del lyrics._proto.lines[start:end]
+    added = False
+    for sentence, start_tick, end_tick in new_lines:
+        _fill_line(lyrics, sentence, start_tick, end_tick)
+        added = True
+    if added:
+        lyrics.sort_lines()
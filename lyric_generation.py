@@ -1,13 +1,79 @@
-from tuneflow_py import TuneflowPlugin, ParamDescriptor, Song, Lyrics, WidgetType, TuneflowPluginTriggerData, InjectSource
+from tuneflow_py import TuneflowPlugin, ParamDescriptor, Song, Lyrics, WidgetType, TuneflowPluginTriggerData
 
 import math
-from typing import Dict, Any
+from typing import Dict, Any, List
 
-from ai_config import AIConfig
-from ai_api import get_engine_api
-from ai_prompt import LyricPrompt
+import ledger
+import metrics
+from engine_registry import get_engine_registry
+from lyric_edit import replace_lines
+from plugin_params import LANGUAGE_PARAM, NUM_CANDIDATES_PARAM, TEMPERATURE_PARAM, USER_LANGUAGE_PARAM
+from tick_index import TickIndex
 from utils import DEFAULT_WORD_TICKS
-from utils import get_writing_language, split_lyrics
+from utils import get_writing_language
+
+
+# Parameter descriptors of the plugin, built once rather than on every `params` call
+_PARAMS: Dict[str, ParamDescriptor] = {
+    "prompt": {
+        "displayName": {
+            "en": "Prompt",
+            "zh": "提示词"
+        },
+        "description": {
+            "en": "Describe the styles, topics, and contents of lyrics you want to generate",
+            "zh": "简短的描述你想要生成歌词的风格、主题、内容等"
+        },
+        "defaultValue": None,
+        "widget": {
+            "type": WidgetType.TextArea.value,
+            "config": {
+                "placeholder": {
+                    "zh": "样例：有关梦想和希望的流行歌曲",
+                    "en": "e.g. a pop song about dreams and hope"
+                },
+                "maxLength": 300
+            }
+        }
+    },
+    "temperature": TEMPERATURE_PARAM,
+    "numLines": {
+        "displayName": {
+            "en": "Max Nubmer of Lines",
+            "zh": "乐句最大数量"
+        },
+        "defaultValue": 8,
+        "description": {
+            "en": "The max number of lines to generate or continue",
+            "zh": "生成或续写乐句的最大数量"
+        },
+        "widget": {
+            "type": WidgetType.Slider.value,
+            "config": {
+                "minValue": 1,
+                "maxValue": 64,
+                "step": 1,
+            }
+        }
+    },
+    "numCandidates": NUM_CANDIDATES_PARAM,
+    "language": LANGUAGE_PARAM,
+    "userLanguage": USER_LANGUAGE_PARAM,
+    "empty": {
+        "displayName": {
+            "en": "Empty Current Lyrics",
+            "zh": "清空当前歌词"
+        },
+        "description": {
+            "en": "Whether to empty the current lyrics before generating",
+            "zh": "是否在生成新歌词前清空当前已有歌词"
+        },
+        "defaultValue": False,
+        "widget": {
+            "type": WidgetType.Switch.value,
+        },
+    }
+}
 
 
 class LyricGenerationPlugin(TuneflowPlugin):
@@ -22,137 +88,26 @@ class LyricGenerationPlugin(TuneflowPlugin):
     def plugin_id() -> str:
         return 'gpt-lyrics-generate'
 
+    @staticmethod
+    def priority_class() -> str:
+        ''' The priority class of the jobs in the plugin service, see `fair_queue.PRIORITY_WEIGHTS` '''
+        return 'generate'
+
     @staticmethod
     def params(song: Song) -> Dict[str, ParamDescriptor]:
-        return {
-            "prompt": {
-                "displayName": {
-                    "en": "Prompt",
-                    "zh": "提示词"
-                },
-                "description": {
-                    "en": "Describe the styles, topics, and contents of lyrics you want to generate",
-                    "zh": "简短的描述你想要生成歌词的风格、主题、内容等"
-                },
-                "defaultValue": None,
-                "widget": {
-                    "type": WidgetType.TextArea.value,
-                    "config": {
-                        "placeholder": {
-                            "zh": "样例：有关梦想和希望的流行歌曲",
-                            "en": "e.g. a pop song about dreams and hope"
-                        },
-                        "maxLength": 300
-                    }
-                }
-            },
-            "temperature": {
-                "displayName": {
-                    "en": "Creativity",
-                    "zh": "创造力"
-                },
-                "defaultValue": 0.9,
-                "description": {
-                    "en": "The degree of randomness and creativity of generated lyrics",
-                    "zh": "该值越高，生成歌词的随机性、创造性越强"
-                },
-                "widget": {
-                    "type": WidgetType.Slider.value,
-                    "config": {
-                        "minValue": 0.0,
-                        "maxValue": 1.0,
-                        "step": 0.05
-                    }
-                }
-            },
-            "numLines": {
-                "displayName": {
-                    "en": "Max Nubmer of Lines",
-                    "zh": "乐句最大数量"
-                },
-                "defaultValue": 8,
-                "description": {
-                    "en": "The max number of lines to generate or continue",
-                    "zh": "生成或续写乐句的最大数量"
-                },
-                "widget": {
-                    "type": WidgetType.Slider.value,
-                    "config": {
-                        "minValue": 1,
-                        "maxValue": 64,
-                        "step": 1,
-                    }
-                }
-            },
-            "language": {
-                "displayName": {
-                    "en": "Writing Language",
-                    "zh": "写作语言"
-                },
-                "defaultValue": "auto",
-                "widget": {
-                    "type": WidgetType.Select.value,
-                    "config": {
-                        "placeholder": {
-                            "zh": "样例：有关梦想和希望的流行歌曲",
-                            "en": "e.g. a pop song about dreams and hope"
-                        },
-                        "options": [
-                            {
-                                "label": {
-                                    "en": "Auto",
-                                    "zh": "自动",
-                                },
-                                "value": "auto"
-                            },
-                            {
-                                "label": "English",
-                                "value": "en"
-                            },
-                            {
-                                "label": "中文",
-                                "value": "zh"
-                            }
-                        ]
-                    }
-                }
-            },
-            "userLanguage": {
-                "displayName": {
-                    "en": "User Language",
-                    "zh": "用户语言"
-                },
-                "defaultValue": None,
-                "injectFrom": InjectSource.Language.value,
-                "widget": {
-                    "type": WidgetType.NoWidget.value,
-                },
-                "hidden": True,
-                "optional": True
-            },
-            "empty": {
-                "displayName": {
-                    "en": "Empty Current Lyrics",
-                    "zh": "清空当前歌词"
-                },
-                "description": {
-                    "en": "Whether to empty the current lyrics before generating",
-                    "zh": "是否在生成新歌词前清空当前已有歌词"
-                },
-                "defaultValue": False,
-                "widget": {
-                    "type": WidgetType.Switch.value,
-                },
-            }
-        }
+        return _PARAMS
 
     @staticmethod
-    def run(song: Song, params: Dict[str, Any]):
+    @metrics.timed("context", plugin='gpt-lyrics-generate')
+    def _prepare(song: Song, params: Dict[str, Any]):
+        '''
+        Resolve the tick range and lyric context of the run.
+        Returns None if there is nothing to generate.
+        '''
         lang = params["language"]
         user_lang = params["userLanguage"]
         num_lines = params["numLines"]
         empty = params["empty"]
-        lang = get_writing_language(lang, user_lang)
         
         trigger: TuneflowPluginTriggerData = params["trigger"]
 
@@ -160,6 +115,7 @@ class LyricGenerationPlugin(TuneflowPlugin):
         end_tick: int = math.inf
 
         lyrics = Lyrics(song)
+        lang = get_writing_language(lang, user_lang, lyrics)
         # Whether to continue writing rather than generate from scratch
         from_scratch = len(lyrics) == 0 or empty
         
@@ -173,47 +129,84 @@ class LyricGenerationPlugin(TuneflowPlugin):
             track = song.get_track_by_id(track_id=track_id)
             if track is None:
                 raise Exception("Track not found")
-            visible_notes = sorted(
-                track.get_visible_notes(),
-                key=lambda note: note.get_start_tick()
-            )
-            if len(visible_notes) == 0:
-                return
+            note_span = TickIndex.note_span(track)
+            if note_span is None:
+                return None
             # Lyrics are generated within the range of visible notes
-            start_tick = visible_notes[0].get_start_tick()
-            end_tick = visible_notes[-1].get_end_tick()
+            start_tick, end_tick = note_span
             if not from_scratch:
                 start_tick = max(lyrics[len(lyrics)-1].get_end_tick(), start_tick)
         else:
             raise Exception("Trigger type not supported")
 
-        # Generate lyrics through OpenAI APIs
-        api = get_engine_api(
-            cfg=AIConfig(),
-            prompt=LyricPrompt(lang=lang)
-        )
-        
-        context_before = '' if from_scratch else '\n'.join([line.get_sentence() for line in lyrics])
-        response = api.generate(
-            user_demands=params["prompt"],
-            temperature=params["temperature"],
-            context_before=context_before,
-            num_lines=num_lines,
-        )
-
-        # Parse the response and arrange lyric lines
-        lines = split_lyrics(response)
+        context_before = ""
+        if not from_scratch:
+            context = get_engine_registry().get_context_cache().get(song)
+            context_before, _ = context.context(len(context), len(context))
+        return {
+            "lang": lang,
+            "lyrics": lyrics,
+            "empty": empty,
+            "num_lines": num_lines,
+            "start_tick": start_tick,
+            "end_tick": end_tick,
+            "num_candidates": params["numCandidates"],
+            # Whether near-duplicate requests of the plugin may be served from the similarity cache
+            "reuse_similar": get_engine_registry().get_config().get_similarity_enabled(LyricGenerationPlugin.plugin_id()),
+            "tick_span": end_tick - start_tick,
+            "request": {
+                "user_demands": params["prompt"],
+                "temperature": params["temperature"],
+                "context_before": context_before,
+                "num_lines": num_lines,
+            },
+        }
+
+    @staticmethod
+    @metrics.timed("placement", plugin='gpt-lyrics-generate')
+    def _apply(job: Dict[str, Any], lines: List[str]):
+        ''' Arrange the generated lyric lines '''
         if len(lines) == 0:
             raise Exception("No lyrics generated")
         
-        if empty:
-            lyrics.clear()
-
-        line_start_offset = start_tick
+        lyrics = job["lyrics"]
+        new_lines = []
+        line_start_offset = job["start_tick"]
         for i, line in enumerate(lines):
             line_duration = DEFAULT_WORD_TICKS * len(line)
-            if i >= num_lines or line_start_offset + line_duration > end_tick:
+            if i >= job["num_lines"] or line_start_offset + line_duration > job["end_tick"]:
                 break
-            lyrics.create_line_from_string(
-                line, line_start_offset, line_start_offset + line_duration)
+            new_lines.append((line, line_start_offset, line_start_offset + line_duration))
             line_start_offset += line_duration
+        # Empty the current lyrics and add the generated lines in one edit
+        replace_lines(lyrics, range(len(lyrics)) if job["empty"] else [], new_lines)
+
+    @staticmethod
+    @metrics.timed("plugin_run", metrics.DEFAULT_LATENCY_BUCKETS, plugin='gpt-lyrics-generate')
+    @ledger.scoped(plugin='gpt-lyrics-generate')
+    def run(song: Song, params: Dict[str, Any]):
+        job = LyricGenerationPlugin._prepare(song, params)
+        if job is None:
+            return
+        # Generate lyrics through OpenAI APIs
+        api = get_engine_registry().get_plugin_engine(LyricGenerationPlugin.plugin_id(), job["lang"])
+        ranked = api.generate_ranked_lines(
+            n=job["num_candidates"], tick_span=job["tick_span"], reuse_similar=job["reuse_similar"],
+                **job["request"])
+        lines = ranked[0][1]
+        LyricGenerationPlugin._apply(job, lines)
+
+    @staticmethod
+    @metrics.timed("plugin_run", metrics.DEFAULT_LATENCY_BUCKETS, plugin='gpt-lyrics-generate')
+    @ledger.scoped(plugin='gpt-lyrics-generate')
+    async def arun(song: Song, params: Dict[str, Any]):
+        ''' Coroutine version of `run` served by the async plugin service '''
+        job = LyricGenerationPlugin._prepare(song, params)
+        if job is None:
+            return
+        api = get_engine_registry().get_plugin_engine(LyricGenerationPlugin.plugin_id(), job["lang"])
+        ranked = await api.agenerate_ranked_lines(
+            n=job["num_candidates"], tick_span=job["tick_span"], reuse_similar=job["reuse_similar"],
+                **job["request"])
+        lines = ranked[0][1]
+        LyricGenerationPlugin._apply(job, lines)
@@ -1,12 +1,44 @@
-from tuneflow_py import TuneflowPlugin, ParamDescriptor, Song, Lyrics, WidgetType, TuneflowPluginTriggerData, InjectSource
+from tuneflow_py import TuneflowPlugin, ParamDescriptor, Song, Lyrics, WidgetType, TuneflowPluginTriggerData
 
-import math
 from typing import Dict, Any
 
-from ai_config import AIConfig
-from ai_api import get_engine_api
-from ai_prompt import LyricPrompt
-from utils import get_writing_language, split_lyrics
+import ledger
+import metrics
+from engine_registry import get_engine_registry
+from lyric_edit import replace_lines
+from plugin_params import LANGUAGE_PARAM, NUM_CANDIDATES_PARAM, TEMPERATURE_PARAM, USER_LANGUAGE_PARAM
+from utils import get_writing_language, split_indexed_lyrics
+
+# Parameter descriptors of the plugin, built once rather than on every `params` call
+_PARAMS: Dict[str, ParamDescriptor] = {
+    "prompt": {
+        "displayName": {
+            "en": "Prompt",
+            "zh": "提示词"
+        },
+        "description": {
+            "en": "Describe the styles, topics, and contents of lyrics you want to generate",
+            "zh": "简短的描述你想要生成乐句的风格、主题、内容等"
+        },
+        "defaultValue": "",
+        "widget": {
+            "type": WidgetType.TextArea.value,
+            "config": {
+                "placeholder": {
+                    "zh": "样例：这句话的主题是梦想和希望",
+                    "en": "e.g. write a lyric line about dreams and hope"
+                },
+                "maxLength": 300
+            }
+        },
+        "optional": True
+    },
+    "temperature": TEMPERATURE_PARAM,
+    "numCandidates": NUM_CANDIDATES_PARAM,
+    "language": LANGUAGE_PARAM,
+    "userLanguage": USER_LANGUAGE_PARAM,
+}
+
 
 class LyricLineCompletionPlugin(TuneflowPlugin):
     @staticmethod
@@ -17,137 +49,109 @@ class LyricLineCompletionPlugin(TuneflowPlugin):
     def plugin_id() -> str:
         return 'gpt-lyrics-line'
 
+    @staticmethod
+    def priority_class() -> str:
+        ''' The priority class of the jobs in the plugin service, see `fair_queue.PRIORITY_WEIGHTS` '''
+        return 'line'
+
     @staticmethod
     def params(song: Song) -> Dict[str, ParamDescriptor]:
-        return {
-            "prompt": {
-                "displayName": {
-                    "en": "Prompt",
-                    "zh": "提示词"
-                },
-                "description": {
-                    "en": "Describe the styles, topics, and contents of lyrics you want to generate",
-                    "zh": "简短的描述你想要生成乐句的风格、主题、内容等"
-                },
-                "defaultValue": "",
-                "widget": {
-                    "type": WidgetType.TextArea.value,
-                    "config": {
-                        "placeholder": {
-                            "zh": "样例：这句话的主题是梦想和希望",
-                            "en": "e.g. write a lyric line about dreams and hope"
-                        },
-                        "maxLength": 300
-                    }
-                },
-                "optional": True
-            },
-            "temperature": {
-                "displayName": {
-                    "en": "Creativity",
-                    "zh": "创造力"
-                },
-                "defaultValue": 0.9,
-                "description": {
-                    "en": "The degree of randomness and creativity of generated lyrics",
-                    "zh": "该值越高，生成歌词的随机性、创造性越强"
-                },
-                "widget": {
-                    "type": WidgetType.Slider.value,
-                    "config": {
-                        "minValue": 0.0,
-                        "maxValue": 1.0,
-                        "step": 0.05
-                    }
-                }
-            },
-            "language": {
-                "displayName": {
-                    "en": "Writing Language",
-                    "zh": "写作语言"
-                },
-                "defaultValue": "auto",
-                "widget": {
-                    "type": WidgetType.Select.value,
-                    "config": {
-                        "placeholder": {
-                            "zh": "样例：有关梦想和希望的流行歌曲",
-                            "en": "e.g. a pop song about dreams and hope"
-                        },
-                        "options": [
-                            {
-                                "label": {
-                                    "en": "Auto",
-                                    "zh": "自动",
-                                },
-                                "value": "auto"
-                            },
-                            {
-                                "label": "English",
-                                "value": "en"
-                            },
-                            {
-                                "label": "中文",
-                                "value": "zh"
-                            }
-                        ]
-                    }
-                }
-            },
-            "userLanguage": {
-                "displayName": {
-                    "en": "User Language",
-                    "zh": "用户语言"
-                },
-                "defaultValue": None,
-                "injectFrom": InjectSource.Language.value,
-                "widget": {
-                    "type": WidgetType.NoWidget.value,
-                },
-                "hidden": True,
-                "optional": True
-            },
-        }
+        return _PARAMS
     
     @staticmethod
-    def run(song: Song, params: Dict[str, Any]):
+    @metrics.timed("context", plugin='gpt-lyrics-line')
+    def _prepare(song: Song, params: Dict[str, Any]):
+        '''
+        Resolve the selected lyric lines and their context.
+        Multiple selected lines are rewritten together in one request.
+        '''
         lang = params["language"]
         user_lang = params["userLanguage"]
-        lang = get_writing_language(lang, user_lang)
         
         trigger: TuneflowPluginTriggerData = params["trigger"]
         lyrics = Lyrics(song)
+        lang = get_writing_language(lang, user_lang, lyrics)
         
-        # The context before and after the completed part
-        context_before = ""
-        context_after = ""
-        
-        # Rewrite the selected lyric line
-        line_index = trigger["entities"][0]["lyricsLineIndex"]
-        start_tick = lyrics[line_index].get_start_tick()
-        end_tick = lyrics[line_index].get_end_tick()
-        # Get the context before and after the selected line
-        context_before = "\n".join(lyrics[i].get_sentence() for i in range(line_index))
-        context_after = "\n".join(lyrics[i].get_sentence() for i in range(line_index + 1, len(lyrics)))
-        
-        # Complete lyrics through OpenAI APIs
-        api = get_engine_api(
-            cfg=AIConfig(),
-            prompt=LyricPrompt(lang=lang)
-        )
-
-        response = api.generate(
-            user_demands=params["prompt"],
-            temperature=params["temperature"],
-            context_before=context_before,
-            context_after=context_after,
-            num_lines=1,
-        )
+        # Rewrite the selected lyric lines, keeping their original tick slots
+        line_indices = sorted({entity["lyricsLineIndex"] for entity in trigger["entities"]})
+        slots = {
+            line_index: (lyrics[line_index].get_start_tick(), lyrics[line_index].get_end_tick())
+            for line_index in line_indices
+        }
+        first_index, last_index = line_indices[0], line_indices[-1]
+        # Get the context before and after the selected lines, spliced from the previous runs on the song
+        context = get_engine_registry().get_context_cache().get(song)
+        sentences = context.sentences
+        context_before, context_after = context.context(first_index, last_index + 1)
+        request = {
+            "user_demands": params["prompt"],
+            "temperature": params["temperature"],
+            "context_before": context_before,
+            "context_after": context_after,
+            "num_lines": len(line_indices),
+        }
+        if len(line_indices) > 1:
+            # Lines between the selected ones are listed as indexed context
+            request["rewrite_lines"] = [
+                (line_index, sentences[line_index], line_index in slots)
+                for line_index in range(first_index, last_index + 1)
+            ]
+        start_tick, end_tick = slots[first_index]
+        return {
+            "lang": lang,
+            "lyrics": lyrics,
+            "slots": slots,
+            "num_candidates": params["numCandidates"],
+            # Whether near-duplicate requests of the plugin may be served from the similarity cache
+            "reuse_similar": get_engine_registry().get_config().get_similarity_enabled(LyricLineCompletionPlugin.plugin_id()),
+            "tick_span": end_tick - start_tick,
+            "request": request,
+        }
 
-        # Parse the response and arrange lyric lines
-        lines = split_lyrics(response)
+    @staticmethod
+    @metrics.timed("placement", plugin='gpt-lyrics-line')
+    def _apply(job: Dict[str, Any], lines: Dict[int, str]):
+        ''' Replace the selected lyric lines with the generated ones, indexed by the original line indices '''
+        lines = {line_index: line for line_index, line in lines.items() if line_index in job["slots"]}
         if len(lines) < 1:
             raise Exception('No lyrics generated')
-        # Remove the original lyric lines and insert the new ones
-        lyrics.remove_line_at_index(line_index)
-        lyrics.create_line_from_string(lines[0], start_tick, end_tick)
+        # Replace the original lyric lines with the new ones in their tick slots
+        replace_lines(job["lyrics"], lines, [
+            (line, *job["slots"][line_index]) for line_index, line in lines.items()
+        ])
+
+    @staticmethod
+    @metrics.timed("plugin_run", metrics.DEFAULT_LATENCY_BUCKETS, plugin='gpt-lyrics-line')
+    @ledger.scoped(plugin='gpt-lyrics-line')
+    def run(song: Song, params: Dict[str, Any]):
+        job = LyricLineCompletionPlugin._prepare(song, params)
+        # Complete lyrics through OpenAI APIs
+        api = get_engine_registry().get_plugin_engine(LyricLineCompletionPlugin.plugin_id(), job["lang"])
+        if "rewrite_lines" in job["request"]:
+            content = api.generate(reuse_similar=job["reuse_similar"], **job["request"])
+            with metrics.span("parse", engine=api.engine):
+                lines = split_indexed_lyrics(content)
+        else:
+            ranked = api.generate_ranked_lines(
+                n=job["num_candidates"], tick_span=job["tick_span"], reuse_similar=job["reuse_similar"],
+                **job["request"])
+            lines = dict(zip(job["slots"], ranked[0][1]))
+        LyricLineCompletionPlugin._apply(job, lines)
+
+    @staticmethod
+    @metrics.timed("plugin_run", metrics.DEFAULT_LATENCY_BUCKETS, plugin='gpt-lyrics-line')
+    @ledger.scoped(plugin='gpt-lyrics-line')
+    async def arun(song: Song, params: Dict[str, Any]):
+        ''' Coroutine version of `run` served by the async plugin service '''
+        job = LyricLineCompletionPlugin._prepare(song, params)
+        api = get_engine_registry().get_plugin_engine(LyricLineCompletionPlugin.plugin_id(), job["lang"])
+        if "rewrite_lines" in job["request"]:
+            content = await api.agenerate(reuse_similar=job["reuse_similar"], **job["request"])
+            with metrics.span("parse", engine=api.engine):
+                lines = split_indexed_lyrics(content)
+        else:
+            ranked = await api.agenerate_ranked_lines(
+                n=job["num_candidates"], tick_span=job["tick_span"], reuse_similar=job["reuse_similar"],
+                **job["request"])
+            lines = dict(zip(job["slots"], ranked[0][1]))
+        LyricLineCompletionPlugin._apply(job, lines)
@@ -1,12 +1,64 @@
-from tuneflow_py import TuneflowPlugin, ParamDescriptor, Song, Lyrics, WidgetType, TuneflowPluginTriggerData, InjectSource
+from tuneflow_py import TuneflowPlugin, ParamDescriptor, Song, WidgetType, TuneflowPluginTriggerData
 
-import math
-from typing import Dict, Any
+from typing import Dict, Any, List
+
+import ledger
+import metrics
+from engine_registry import get_engine_registry
+from lyric_edit import replace_lines
+from plugin_params import LANGUAGE_PARAM, NUM_CANDIDATES_PARAM, TEMPERATURE_PARAM, USER_LANGUAGE_PARAM
+from tick_index import TickIndex
+from utils import get_writing_language, DEFAULT_LINE_TICKS
+
+# Parameter descriptors of the plugin, built once rather than on every `params` call
+_PARAMS: Dict[str, ParamDescriptor] = {
+    "prompt": {
+        "displayName": {
+            "en": "Prompt",
+            "zh": "提示词"
+        },
+        "description": {
+            "en": "Describe the styles, topics, and contents of lyrics you want to generate",
+            "zh": "简短的描述你想要生成段落的风格、主题、内容等"
+        },
+        "defaultValue": "",
+        "widget": {
+            "type": WidgetType.TextArea.value,
+            "config": {
+                "placeholder": {
+                    "zh": "样例：请在本段落描写梦想和希望",
+                    "en": "e.g. write a paragraph about dreams and hope"
+                },
+                "maxLength": 300
+            }
+        },
+        "optional": True
+    },
+    "temperature": TEMPERATURE_PARAM,
+    "numLines": {
+        "displayName": {
+            "en": "Estimated Number of Lines",
+            "zh": "预计乐句数量"
+        },
+        "defaultValue": 6,
+        "description": {
+            "en": "The estimated number of lines to generate",
+            "zh": "生成段落歌词的乐句大致数量"
+        },
+        "widget": {
+            "type": WidgetType.Slider.value,
+            "config": {
+                "minValue": 0,
+                "maxValue": 32,
+                "step": 1
+            }
+        }
+    },
+    "numCandidates": NUM_CANDIDATES_PARAM,
+    "language": LANGUAGE_PARAM,
+    "userLanguage": USER_LANGUAGE_PARAM,
+}
 
-from ai_config import AIConfig
-from ai_api import get_engine_api
-from ai_prompt import LyricPrompt
-from utils import get_writing_language, split_lyrics, DEFAULT_LINE_TICKS
 
 class LyricStructureCompletionPlugin(TuneflowPlugin):
     @staticmethod
@@ -17,127 +69,26 @@ class LyricStructureCompletionPlugin(TuneflowPlugin):
     def plugin_id() -> str:
         return 'gpt-lyrics-structure'
 
+    @staticmethod
+    def priority_class() -> str:
+        ''' The priority class of the jobs in the plugin service, see `fair_queue.PRIORITY_WEIGHTS` '''
+        return 'structure'
+
     @staticmethod
     def params(song: Song) -> Dict[str, ParamDescriptor]:
-        return {
-            "prompt": {
-                "displayName": {
-                    "en": "Prompt",
-                    "zh": "提示词"
-                },
-                "description": {
-                    "en": "Describe the styles, topics, and contents of lyrics you want to generate",
-                    "zh": "简短的描述你想要生成段落的风格、主题、内容等"
-                },
-                "defaultValue": "",
-                "widget": {
-                    "type": WidgetType.TextArea.value,
-                    "config": {
-                        "placeholder": {
-                            "zh": "样例：请在本段落描写梦想和希望",
-                            "en": "e.g. write a paragraph about dreams and hope"
-                        },
-                        "maxLength": 300
-                    }
-                },
-                "optional": True
-            },
-            "temperature": {
-                "displayName": {
-                    "en": "Creativity",
-                    "zh": "创造力"
-                },
-                "defaultValue": 0.9,
-                "description": {
-                    "en": "The degree of randomness and creativity of generated lyrics",
-                    "zh": "该值越高，生成歌词的随机性、创造性越强"
-                },
-                "widget": {
-                    "type": WidgetType.Slider.value,
-                    "config": {
-                        "minValue": 0.0,
-                        "maxValue": 1.0,
-                        "step": 0.05
-                    }
-                }
-            },
-            "numLines": {
-                "displayName": {
-                    "en": "Estimated Number of Lines",
-                    "zh": "预计乐句数量"
-                },
-                "defaultValue": 6,
-                "description": {
-                    "en": "The estimated number of lines to generate",
-                    "zh": "生成段落歌词的乐句大致数量"
-                },
-                "widget": {
-                    "type": WidgetType.Slider.value,
-                    "config": {
-                        "minValue": 0,
-                        "maxValue": 32,
-                        "step": 1
-                    }
-                }
-            },
-            "language": {
-                "displayName": {
-                    "en": "Writing Language",
-                    "zh": "写作语言"
-                },
-                "defaultValue": "auto",
-                "widget": {
-                    "type": WidgetType.Select.value,
-                    "config": {
-                        "placeholder": {
-                            "zh": "样例：有关梦想和希望的流行歌曲",
-                            "en": "e.g. a pop song about dreams and hope"
-                        },
-                        "options": [
-                            {
-                                "label": {
-                                    "en": "Auto",
-                                    "zh": "自动",
-                                },
-                                "value": "auto"
-                            },
-                            {
-                                "label": "English",
-                                "value": "en"
-                            },
-                            {
-                                "label": "中文",
-                                "value": "zh"
-                            }
-                        ]
-                    }
-                }
-            },
-            "userLanguage": {
-                "displayName": {
-                    "en": "User Language",
-                    "zh": "用户语言"
-                },
-                "defaultValue": None,
-                "injectFrom": InjectSource.Language.value,
-                "widget": {
-                    "type": WidgetType.NoWidget.value,
-                },
-                "hidden": True,
-                "optional": True
-            },
-        }
+        return _PARAMS
     
     @staticmethod
-    def run(song: Song, params: Dict[str, Any]):
+    @metrics.timed("context", plugin='gpt-lyrics-structure')
+    def _prepare(song: Song, params: Dict[str, Any]):
+        ''' Resolve the selected structure paragraph, the lines within it and their context '''
         lang = params["language"]
         user_lang = params["userLanguage"]
-        lang = get_writing_language(lang, user_lang)
         
         trigger: TuneflowPluginTriggerData = params["trigger"]
         structure_index = trigger["entities"][0]["lyricsStructureIndex"]
-        lyrics = Lyrics(song)
-        structures = song.get_structures()
+        index = TickIndex(song)
+        lang = get_writing_language(lang, user_lang, index.lyrics)
         
         # The context before and after the completed part
         context_before = ""
@@ -147,45 +98,77 @@ class LyricStructureCompletionPlugin(TuneflowPlugin):
         num_lines = params["numLines"]
 
         # Get the range of selected structure paragraph
-        start_tick = structures[structure_index].get_tick()
-        end_tick = song.get_last_tick() if structure_index == len(structures) - 1 else structures[structure_index + 1].get_tick()
+        start_tick, end_tick = index.structure_range(structure_index)
         
         # Find indices of lyric lines that lie within [start_tick, end_tick]
-        lyrics_lines = list(lyrics.get_lines())
-        indices_within_range = [i for i, line in enumerate(lyrics_lines) if start_tick <= line.get_start_tick() and line.get_end_tick() <= end_tick]
+        indices_within_range = index.lines_within(start_tick, end_tick)
         # Approximate the number of lines to generate
         num_lines = min(num_lines, int((end_tick - start_tick) / DEFAULT_LINE_TICKS))
 
-        # Find the last line before the range as context_before
-        context_before = '\n'.join([line.get_sentence() for line in lyrics_lines if line.get_end_tick() <= start_tick])
-        # Find the first line after the range as context_after
-        context_after = '\n'.join([line.get_sentence() for line in lyrics_lines if line.get_start_tick() >= end_tick])
-        
-        # Complete lyrics through OpenAI APIs
-        api = get_engine_api(
-            cfg=AIConfig(),
-            prompt=LyricPrompt(lang=lang)
-        )
-        
-        response = api.generate(
-            user_demands=params["prompt"],
-            temperature=params["temperature"],
-            context_before=context_before,
-            context_after=context_after,
-            num_lines=num_lines,
-        )
+        # The lines before the range are the context before, and the lines after it the context after
+        context = get_engine_registry().get_context_cache().get(song)
+        context_before, context_after = context.context(
+            index.lines_before(start_tick).stop, index.lines_after(end_tick).start)
+        return {
+            "lang": lang,
+            "lyrics": index.lyrics,
+            "num_lines": num_lines,
+            "start_tick": start_tick,
+            "end_tick": end_tick,
+            "indices_within_range": indices_within_range,
+            "num_candidates": params["numCandidates"],
+            # Whether near-duplicate requests of the plugin may be served from the similarity cache
+            "reuse_similar": get_engine_registry().get_config().get_similarity_enabled(LyricStructureCompletionPlugin.plugin_id()),
+            "tick_span": end_tick - start_tick,
+            "request": {
+                "user_demands": params["prompt"],
+                "temperature": params["temperature"],
+                "context_before": context_before,
+                "context_after": context_after,
+                "num_lines": num_lines,
+            },
+        }
 
-        # Parse the response and arrange lyric lines
-        lines = split_lyrics(response)
+    @staticmethod
+    @metrics.timed("placement", plugin='gpt-lyrics-structure')
+    def _apply(job: Dict[str, Any], lines: List[str]):
+        ''' Arrange the generated lyric lines within the paragraph '''
         if len(lines) < 1:
             raise Exception('No lyrics generated')
 
-        # Remove the original lyric lines within the paragraph
-        for line_index in reversed(sorted(indices_within_range)):
-            lyrics.remove_line_at_index(line_index)
-        # Insert the generated lyric lines
-        num_lines = min(num_lines, len(lines))
+        lyrics = job["lyrics"]
+        start_tick = job["start_tick"]
+        end_tick = job["end_tick"]
+        # Replace the original lyric lines within the paragraph with the generated ones
+        num_lines = min(job["num_lines"], len(lines))
         ticks_per_line = int((end_tick - start_tick) / num_lines)
-        for i in range(num_lines - 1):
-            lyrics.create_line_from_string(lines[i], start_tick + i * ticks_per_line, start_tick + (i + 1) * ticks_per_line)
-        lyrics.create_line_from_string(lines[-1], start_tick + (num_lines - 1) * ticks_per_line, start_tick + num_lines * ticks_per_line)
+        replace_lines(lyrics, job["indices_within_range"], [
+            (lines[i], start_tick + i * ticks_per_line, start_tick + (i + 1) * ticks_per_line)
+            for i in range(num_lines)
+        ])
+
+    @staticmethod
+    @metrics.timed("plugin_run", metrics.DEFAULT_LATENCY_BUCKETS, plugin='gpt-lyrics-structure')
+    @ledger.scoped(plugin='gpt-lyrics-structure')
+    def run(song: Song, params: Dict[str, Any]):
+        job = LyricStructureCompletionPlugin._prepare(song, params)
+        # Complete lyrics through OpenAI APIs
+        api = get_engine_registry().get_plugin_engine(LyricStructureCompletionPlugin.plugin_id(), job["lang"])
+        ranked = api.generate_ranked_lines(
+            n=job["num_candidates"], tick_span=job["tick_span"], reuse_similar=job["reuse_similar"],
+                **job["request"])
+        lines = ranked[0][1]
+        LyricStructureCompletionPlugin._apply(job, lines)
+
+    @staticmethod
+    @metrics.timed("plugin_run", metrics.DEFAULT_LATENCY_BUCKETS, plugin='gpt-lyrics-structure')
+    @ledger.scoped(plugin='gpt-lyrics-structure')
+    async def arun(song: Song, params: Dict[str, Any]):
+        ''' Coroutine version of `run` served by the async plugin service '''
+        job = LyricStructureCompletionPlugin._prepare(song, params)
+        api = get_engine_registry().get_plugin_engine(LyricStructureCompletionPlugin.plugin_id(), job["lang"])
+        ranked = await api.agenerate_ranked_lines(
+            n=job["num_candidates"], tick_span=job["tick_span"], reuse_similar=job["reuse_similar"],
+                **job["request"])
+        lines = ranked[0][1]
+        LyricStructureCompletionPlugin._apply(job, lines)
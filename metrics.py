@@ -0,0 +1,167 @@
+import bisect
+import contextlib
+import functools
+import inspect
+import threading
+import time
+from typing import Callable, Dict, Sequence, Tuple
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds (in seconds) of the buckets of local, CPU-bound phases
+DEFAULT_PHASE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# A metric name and its sorted label pairs
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Histogram:
+    '''
+    A thread-safe histogram with fixed bucket upper bounds.
+    Counts are kept per bucket (non-cumulative) along with the sum and the number of observations.
+    '''
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "buckets": list(self.buckets),
+                "counts": list(self.counts),
+                "sum": self.sum,
+                "count": self.count,
+            }
+
+
+class Counter:
+    ''' A thread-safe monotonic counter '''
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def increment(self, value: float = 1) -> None:
+        with self._lock:
+            self.value += value
+
+
+_HISTOGRAMS: Dict[MetricKey, Histogram] = {}
+_COUNTERS: Dict[MetricKey, Counter] = {}
+_GAUGES: Dict[MetricKey, float] = {}
+_METRICS_LOCK = threading.Lock()
+
+
+def _key(name: str, labels: Dict[str, str]) -> MetricKey:
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape_label_value(value: str) -> str:
+    ''' Escape a label value for the Prometheus text format, where `\\`, `"` and line breaks are escaped '''
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_key(key: MetricKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    name, labels = key
+    labels = labels + extra
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{_escape_label_value(value)}"' for label, value in labels) + "}"
+
+
+def get_histogram(name: str, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS, **labels) -> Histogram:
+    ''' Return the process-wide histogram registered under `name` and `labels`, creating it on first use. '''
+    key = _key(name, labels)
+    with _METRICS_LOCK:
+        if key not in _HISTOGRAMS:
+            _HISTOGRAMS[key] = Histogram(buckets)
+        return _HISTOGRAMS[key]
+
+
+def observe(name: str, value: float, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS, **labels) -> None:
+    get_histogram(name, buckets, **labels).observe(value)
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    key = _key(name, labels)
+    with _METRICS_LOCK:
+        if key not in _COUNTERS:
+            _COUNTERS[key] = Counter()
+        counter = _COUNTERS[key]
+    counter.increment(value)
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with _METRICS_LOCK:
+        _GAUGES[_key(name, labels)] = value
+
+
+@contextlib.contextmanager
+def span(name: str, buckets: Sequence[float] = DEFAULT_PHASE_BUCKETS, **labels):
+    ''' Observe the duration of the enclosed block in the `<name>_seconds` histogram '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(f"{name}_seconds", time.perf_counter() - start, buckets, **labels)
+
+
+def timed(name: str, buckets: Sequence[float] = DEFAULT_PHASE_BUCKETS, **labels) -> Callable:
+    ''' Decorate a function or coroutine function to observe its duration, see `span` '''
+    def decorator(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, buckets, **labels):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, buckets, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render_prometheus() -> str:
+    ''' Render all metrics in the Prometheus text exposition format '''
+    with _METRICS_LOCK:
+        histograms = sorted(_HISTOGRAMS.items())
+        counters = sorted(_COUNTERS.items())
+        gauges = sorted(_GAUGES.items())
+    lines = []
+    declared = set()
+
+    def declare(name: str, metric_type: str) -> None:
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {name} {metric_type}")
+
+    for key, histogram in histograms:
+        declare(key[0], "histogram")
+        snapshot = histogram.snapshot()
+        cumulative = 0
+        for bound, count in zip(snapshot["buckets"] + ["+Inf"], snapshot["counts"]):
+            cumulative += count
+            lines.append(f"{_format_key((key[0] + '_bucket', key[1]), (('le', str(bound)),))} {cumulative}")
+        lines.append(f"{_format_key((key[0] + '_sum', key[1]))} {snapshot['sum']}")
+        lines.append(f"{_format_key((key[0] + '_count', key[1]))} {snapshot['count']}")
+    for key, counter in counters:
+        declare(key[0], "counter")
+        lines.append(f"{_format_key(key)} {counter.value}")
+    for key, value in gauges:
+        declare(key[0], "gauge")
+        lines.append(f"{_format_key(key)} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,3 +1,17 @@
+import asyncio
+import hashlib
+import math
+import random
+import re
+import time
+from typing import Iterator, List, Optional
+
+import openai
+from openai.openai_object import OpenAIObject
+
+from token_budget import count_tokens
+from utils import LYRICS_END_TOKEN, LYRICS_START_TOKEN, split_lyrics
+
 _MOCK_RESPONSE = """
 [start]
 I feel the sun's last light fading away
@@ -20,3 +34,115 @@ My love for you will never cease, it's where I find peace
 My heart will never forget, the beauty of our sunset
 [end]
 """
+
+# Lyric lines the mock engine draws its payloads from, split the way the plugins split responses
+MOCK_LINES = split_lyrics(_MOCK_RESPONSE)
+# Number of lines requested by a lyric prompt in either language
+_NUM_LINES_PATTERN = re.compile(r'around (\d+) lines|在(\d+)行左右')
+# Lines selected for rewriting in a rewrite prompt, see `LyricPrompt.format_rewrite_lines`
+_REWRITE_LINE_PATTERN = re.compile(r'^\[(\d+)\] \(\*\)', re.M)
+# Supported latency distributions, parameterized by their mean
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+
+class MockBackend:
+    '''
+    An offline stand-in of the OpenAI Chat API for load tests and benchmarks, with no network or API key.
+    Payloads are deterministic per prompt: `[start]...[end]` lyrics sized to the requested number of lines,
+    or indexed lines answering rewrite prompts. Latency, error rate and streaming chunking are configurable.
+
+    Args:
+        latency (float): The mean latency (in seconds) before the response or its first chunk.
+        distribution (str): The latency distribution, one of `LATENCY_DISTRIBUTIONS`.
+        error_rate (float): The probability of a request failing with a rate limit or an unavailable server.
+        chunk_size (int): The number of characters per streamed chunk.
+        chunk_interval (float): The delay (in seconds) between streamed chunks.
+        seed (int): The seed of latencies and errors, random if not given.
+    '''
+
+    def __init__(self, latency: float = 0.5, distribution: str = "constant", error_rate: float = 0.0,
+                 chunk_size: int = 4, chunk_interval: float = 0.01, seed: Optional[int] = None) -> None:
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Invalid latency distribution: {distribution}")
+        self.latency = max(latency, 0.0)
+        self.distribution = distribution
+        self.error_rate = error_rate
+        self.chunk_size = max(chunk_size, 1)
+        self.chunk_interval = max(chunk_interval, 0.0)
+        self._random = random.Random(seed)
+
+    def sample_latency(self) -> float:
+        if self.latency == 0 or self.distribution == "constant":
+            return self.latency
+        if self.distribution == "uniform":
+            return self._random.uniform(0, 2 * self.latency)
+        if self.distribution == "exponential":
+            return self._random.expovariate(1 / self.latency)
+        # Lognormal with sigma 0.5 and the configured mean, a long tail like real completion latencies
+        return self._random.lognormvariate(math.log(self.latency) - 0.125, 0.5)
+
+    def maybe_fail(self) -> None:
+        if self.error_rate <= 0 or self._random.random() >= self.error_rate:
+            return
+        if self._random.random() < 0.5:
+            raise openai.error.RateLimitError("Mock rate limit", http_status=429, headers={"retry-after": "0.1"})
+        raise openai.error.ServiceUnavailableError("Mock server unavailable", http_status=503)
+
+    def render(self, prompt: str, choice: int = 0) -> str:
+        ''' The deterministic lyrics answering `prompt`, varied by the index of the choice '''
+        seed = int(hashlib.md5(f"{choice}:{prompt}".encode("utf-8")).hexdigest()[:8], 16)
+        rewrite_indices = [int(index) for index in _REWRITE_LINE_PATTERN.findall(prompt)]
+        if rewrite_indices:
+            lines = [f"[{index}] {MOCK_LINES[(seed + index) % len(MOCK_LINES)]}" for index in rewrite_indices]
+        else:
+            match = _NUM_LINES_PATTERN.search(prompt)
+            num_lines = int(match.group(1) or match.group(2)) if match else 4
+            lines = [MOCK_LINES[(seed + i) % len(MOCK_LINES)] for i in range(num_lines)]
+        return "\n".join([LYRICS_START_TOKEN] + lines + [LYRICS_END_TOKEN])
+
+    def create(self, messages: List[dict], n: int = 1) -> OpenAIObject:
+        ''' A Chat API response of `n` choices '''
+        prompt = messages[-1]["content"]
+        contents = [self.render(prompt, choice) for choice in range(n)]
+        return OpenAIObject.construct_from({
+            "choices": [
+                {"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                for i, content in enumerate(contents)
+            ],
+            "usage": {
+                "prompt_tokens": sum(count_tokens(message["content"]) for message in messages),
+                "completion_tokens": sum(count_tokens(content) for content in contents),
+            },
+        })
+
+    def chunks(self, messages: List[dict]) -> Iterator[OpenAIObject]:
+        ''' The chunks of a streamed Chat API response, without delays '''
+        content = self.render(messages[-1]["content"])
+        for i in range(0, len(content), self.chunk_size):
+            yield OpenAIObject.construct_from({
+                "choices": [{"index": 0, "delta": {"content": content[i:i + self.chunk_size]}, "finish_reason": None}],
+            })
+
+    def request(self, messages: List[dict], stream: bool = False, n: int = 1):
+        time.sleep(self.sample_latency())
+        self.maybe_fail()
+        if not stream:
+            return self.create(messages, n)
+        return self._stream(messages)
+
+    def _stream(self, messages: List[dict]):
+        for chunk in self.chunks(messages):
+            yield chunk
+            time.sleep(self.chunk_interval)
+
+    async def arequest(self, messages: List[dict], stream: bool = False, n: int = 1):
+        await asyncio.sleep(self.sample_latency())
+        self.maybe_fail()
+        if not stream:
+            return self.create(messages, n)
+        return self._astream(messages)
+
+    async def _astream(self, messages: List[dict]):
+        for chunk in self.chunks(messages):
+            yield chunk
+            await asyncio.sleep(self.chunk_interval)
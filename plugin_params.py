@@ -0,0 +1,94 @@
+from tuneflow_py import InjectSource, ParamDescriptor, WidgetType
+
+# Parameter descriptors shared by the lyric plugins
+
+TEMPERATURE_PARAM: ParamDescriptor = {
+    "displayName": {
+        "en": "Creativity",
+        "zh": "创造力"
+    },
+    "defaultValue": 0.9,
+    "description": {
+        "en": "The degree of randomness and creativity of generated lyrics",
+        "zh": "该值越高，生成歌词的随机性、创造性越强"
+    },
+    "widget": {
+        "type": WidgetType.Slider.value,
+        "config": {
+            "minValue": 0.0,
+            "maxValue": 1.0,
+            "step": 0.05
+        }
+    }
+}
+
+
+NUM_CANDIDATES_PARAM: ParamDescriptor = {
+    "displayName": {
+        "en": "Number of Candidates",
+        "zh": "候选数量"
+    },
+    "defaultValue": 1,
+    "description": {
+        "en": "The number of candidates generated in one request, the best one is kept",
+        "zh": "单次请求生成的候选数量，保留其中最优的结果"
+    },
+    "widget": {
+        "type": WidgetType.Slider.value,
+        "config": {
+            "minValue": 1,
+            "maxValue": 5,
+            "step": 1
+        }
+    }
+}
+
+
+LANGUAGE_PARAM: ParamDescriptor = {
+    "displayName": {
+        "en": "Writing Language",
+        "zh": "写作语言"
+    },
+    "defaultValue": "auto",
+    "widget": {
+        "type": WidgetType.Select.value,
+        "config": {
+            "placeholder": {
+                "zh": "样例：有关梦想和希望的流行歌曲",
+                "en": "e.g. a pop song about dreams and hope"
+            },
+            "options": [
+                {
+                    "label": {
+                        "en": "Auto",
+                        "zh": "自动",
+                    },
+                    "value": "auto"
+                },
+                {
+                    "label": "English",
+                    "value": "en"
+                },
+                {
+                    "label": "中文",
+                    "value": "zh"
+                }
+            ]
+        }
+    }
+}
+
+
+USER_LANGUAGE_PARAM: ParamDescriptor = {
+    "displayName": {
+        "en": "User Language",
+        "zh": "用户语言"
+    },
+    "defaultValue": None,
+    "injectFrom": InjectSource.Language.value,
+    "widget": {
+        "type": WidgetType.NoWidget.value,
+    },
+    "hidden": True,
+    "optional": True
+}
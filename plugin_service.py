@@ -0,0 +1,145 @@
+from tuneflow_py import TuneflowPlugin, Song
+from fastapi import BackgroundTasks, FastAPI, Request, Response
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
+from msgpack import unpackb, packb
+from nanoid import generate as generate_nanoid
+
+import traceback
+from typing import List, Optional, Type
+from urllib.parse import urljoin
+
+import ledger
+import metrics
+from ai_cache import get_response_cache_stats
+from engine_registry import get_engine_registry
+from fair_queue import DEFAULT_PRIORITY_CLASS, get_fair_scheduler
+from rate_limit import get_upstream_schedulers
+from similarity_cache import get_similarity_cache_stats
+from singleflight import get_single_flight
+
+
+def get_user_key(request: Request) -> str:
+    ''' The user or session whose fair share a job counts against '''
+    return (
+        request.headers.get("x-session-id")
+        or request.headers.get("x-user-id")
+        or (request.client.host if request.client else "anonymous")
+    )
+
+
+def install_async_jobs_route(app: FastAPI, plugin_class_list: List[Type[TuneflowPlugin]], path_prefix: str = '/',
+                             config: Optional[dict] = None):
+    '''
+    Serve plugin jobs through the plugins' `arun` coroutines.
+    The route takes precedence over the thread-pool based `jobs` route registered by the tuneflow Runner,
+    so one worker can keep many lyric requests in flight while waiting on the engine.
+    Jobs are admitted by the fair scheduler, keyed on the user and the priority class of the plugin.
+    The route keeps the dependencies (e.g. the auth handler) of the Runner's route, and `config`,
+    the config passed to `Runner.start`, is honored the same way for its async job store and exception handler.
+    '''
+    if not path_prefix.endswith('/'):
+        path_prefix += '/'
+    run_plugin_path = urljoin(path_prefix, 'jobs')
+    plugin_classes = {
+        (plugin_class.provider_id(), plugin_class.plugin_id()): plugin_class
+        for plugin_class in plugin_class_list
+    }
+    async_config = config["async"] if config and "async" in config else None
+    exception_handler = config["exception"]["handler"] if config and "exception" in config and "handler" in config["exception"] else None
+    runner_route = next((
+        route for route in app.router.routes
+        if isinstance(route, APIRoute) and route.path == run_plugin_path and "POST" in route.methods
+    ), None)
+    dependencies = list(runner_route.dependencies) if runner_route is not None else []
+
+    async def run_plugin_task(plugin_class: Type[TuneflowPlugin], song: Song, params, user: str):
+        priority_class = getattr(plugin_class, "priority_class", lambda: DEFAULT_PRIORITY_CLASS)()
+        scheduler = get_fair_scheduler(get_engine_registry().get_config())
+        try:
+            async with scheduler.slot(user, priority_class):
+                with ledger.usage_scope(user=user):
+                    await plugin_class.arun(song, params)
+        except Exception as error:
+            print(traceback.format_exc())
+            if exception_handler is not None:
+                exception_handler(error)
+            return {
+                "status": "ERROR"
+            }
+        return {
+            "status": "OK",
+            "song": song.serialize_to_bytestring()
+        }
+
+    async def run_plugin_async_task(plugin_class: Type[TuneflowPlugin], song: Song, params, user: str, job_id: str):
+        result = await run_plugin_task(plugin_class, song, params, user)
+        result["jobId"] = job_id
+        async_config["store"]["uploader"](job_id, packb(result))
+
+    async def handle_run_plugin(request: Request, background_tasks: BackgroundTasks):
+        decoded_data = unpackb(await request.body())
+        params = decoded_data["params"]
+        plugin_key = (decoded_data["providerId"], decoded_data["pluginId"])
+        if plugin_key not in plugin_classes:
+            raise Exception(f"Cannot find plugin by id {plugin_key[0]} {plugin_key[1]}")
+        plugin_class = plugin_classes[plugin_key]
+        song = Song.deserialize_from_bytestring(decoded_data["song"])
+        user = get_user_key(request)
+        if async_config:
+            job_id = generate_nanoid()
+            background_tasks.add_task(run_plugin_async_task, plugin_class, song, params, user, job_id)
+            result = {
+                "status": "ACCEPTED",
+                "jobId": job_id,
+                "resultUrl": async_config["store"]["resultUrlResolver"](job_id)
+            }
+        else:
+            result = await run_plugin_task(plugin_class, song, params, user)
+        return Response(packb(result), headers={"Content-Type": "application/octet-stream"})
+
+    app.add_api_route(run_plugin_path, handle_run_plugin, methods=["POST"], dependencies=dependencies)
+    # Move the route ahead of the Runner's route of the same path
+    app.router.routes.insert(0, app.router.routes.pop())
+    return app
+
+
+def _collect_gauges() -> None:
+    ''' Copy the counters of the process-wide caches, single-flight table and schedulers into metric gauges '''
+    for name, value in get_response_cache_stats().items():
+        metrics.set_gauge(f"response_cache_{name}", value)
+    for name, value in get_similarity_cache_stats().items():
+        metrics.set_gauge(f"similarity_cache_{name}", value)
+    single_flight = get_single_flight().stats()
+    for name in ("in_flight", "waiters", "coalesced"):
+        metrics.set_gauge(f"single_flight_{name}", single_flight[name])
+    for key, scheduler in get_upstream_schedulers().items():
+        upstream = scheduler.stats()
+        for name in ("calls", "retries", "failures", "throttled_seconds"):
+            metrics.set_gauge(f"upstream_{name}", upstream[name], upstream=key)
+        metrics.set_gauge("upstream_circuit_open", int(upstream["circuit"] != "closed"), upstream=key)
+    try:
+        cfg = get_engine_registry().get_config()
+    except Exception as error:
+        # An invalid config, e.g. missing credentials, is when the other gauges are needed the most
+        print(f"Skipped the gauges of the invalid config: {error}")
+        metrics.set_gauge("config_valid", 0)
+        return
+    metrics.set_gauge("config_valid", 1)
+    for name, value in get_engine_registry().get_context_cache().stats().items():
+        metrics.set_gauge(f"context_cache_{name}", value)
+    jobs = get_fair_scheduler(cfg).stats()
+    metrics.set_gauge("jobs_running", jobs["running"])
+    for priority_class, queued in jobs["queued"].items():
+        metrics.set_gauge("jobs_queued", queued, priority_class=priority_class)
+
+
+def install_metrics_route(app: FastAPI, path: str = '/metrics'):
+    '''
+    Serve the phase latency histograms, token counters and service gauges in the Prometheus text format.
+    '''
+    async def handle_metrics():
+        _collect_gauges()
+        return PlainTextResponse(metrics.render_prometheus())
+
+    app.add_api_route(path, handle_metrics, methods=["GET"])
@@ -0,0 +1,56 @@
+from typing import List, Optional, Tuple
+
+from utils import DEFAULT_WORD_TICKS
+
+# Weights of the line count, line length and duplicate scores of a candidate
+LINE_COUNT_WEIGHT = 0.5
+LINE_LENGTH_WEIGHT = 0.3
+DUPLICATE_WEIGHT = 0.2
+
+
+def line_count_score(lines: List[str], num_lines: int) -> float:
+    ''' How close the number of lines is to the requested number, in [0, 1] '''
+    if num_lines <= 0:
+        return 1.0
+    return max(0.0, 1.0 - abs(len(lines) - num_lines) / num_lines)
+
+
+def line_length_score(lines: List[str], num_lines: int, tick_span: Optional[float]) -> float:
+    '''
+    How well the line durations fit the available tick span, in [0, 1].
+    Each line is expected to take an even share of the span, and is placed with `DEFAULT_WORD_TICKS` per character.
+    '''
+    if not lines or tick_span is None or tick_span == float("inf") or tick_span <= 0:
+        return 1.0
+    expected_ticks = tick_span / max(num_lines, 1)
+    fits = []
+    for line in lines:
+        line_ticks = DEFAULT_WORD_TICKS * len(line)
+        fits.append(min(line_ticks, expected_ticks) / max(line_ticks, expected_ticks))
+    return sum(fits) / len(fits)
+
+
+def duplicate_score(lines: List[str]) -> float:
+    ''' One minus the rate of repeated lines, in [0, 1] '''
+    if not lines:
+        return 0.0
+    unique_lines = {line.lower() for line in lines}
+    return len(unique_lines) / len(lines)
+
+
+def score_candidate(lines: List[str], num_lines: int, tick_span: Optional[float] = None) -> float:
+    ''' Score a candidate locally, without extra API calls '''
+    if not lines:
+        return 0.0
+    return (
+        LINE_COUNT_WEIGHT * line_count_score(lines, num_lines)
+        + LINE_LENGTH_WEIGHT * line_length_score(lines, num_lines, tick_span)
+        + DUPLICATE_WEIGHT * duplicate_score(lines)
+    )
+
+
+def rank_candidates(candidates: List[List[str]], num_lines: int, tick_span: Optional[float] = None) -> List[Tuple[float, List[str]]]:
+    ''' Return the (score, lines) pairs of the candidates from the best to the worst '''
+    scored = [(score_candidate(lines, num_lines, tick_span), lines) for lines in candidates]
+    # Stable sort keeps the engine's order among candidates of equal scores
+    return sorted(scored, key=lambda item: item[0], reverse=True)
@@ -0,0 +1,409 @@
+import asyncio
+import functools
+import inspect
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+# Delays (in seconds) of the jittered exponential backoff
+BACKOFF_BASE_DELAY = 0.5
+BACKOFF_MAX_DELAY = 30.0
+# Stands for the first chunk of a stream that ended without any
+_NO_CHUNK = object()
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> Tuple[type, ...]:
+    '''
+    Errors worth retrying: rate limits, server-side failures and transient network errors.
+    The OpenAI client is imported on the first failure rather than with this module.
+    '''
+    import openai
+    return (
+        openai.error.RateLimitError,
+        openai.error.APIError,
+        openai.error.ServiceUnavailableError,
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.TryAgain,
+    )
+
+
+async def _afirst(chunks) -> Any:
+    ''' The first chunk of an async stream, like `next(chunks, _NO_CHUNK)` '''
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return _NO_CHUNK
+
+
+class CircuitOpenError(Exception):
+    ''' Raised without calling the upstream while the circuit breaker is open '''
+
+
+class TokenBucket:
+    '''
+    A thread-safe token bucket refilled continuously at `rate_per_minute`.
+    Acquisitions reserve their tokens at once and may drive the bucket into debt,
+    so that waiting callers are served in arrival order rather than racing for the refill.
+    '''
+
+    def __init__(self, rate_per_minute: float) -> None:
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        ''' Reserve `amount` tokens and return the seconds to wait until they are available '''
+        # A request larger than the bucket would never fit, so it only waits for a full bucket
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+class CircuitBreaker:
+    '''
+    Opens after `failure_threshold` consecutive upstream failures and rejects calls for `cooldown` seconds.
+    Once the cooldown is over, a single trial call is let through: its success closes the circuit,
+    and its failure opens the circuit for another cooldown.
+    A trial that ends without an outcome, e.g. cancelled by hedging, releases its slot for the next trial.
+    '''
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def before_call(self) -> bool:
+        ''' Admit a call or raise CircuitOpenError, returns whether the call is the trial of a half-open circuit '''
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "open" or self.trial:
+                raise CircuitOpenError("Upstream circuit is open after repeated failures, try again later")
+            self.trial = True
+            return True
+
+    def end_trial(self) -> None:
+        ''' Release the trial slot once the trial call is over, whether or not its outcome was recorded '''
+        with self._lock:
+            self.trial = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    ''' The delay (in seconds) requested by the `Retry-After` header of an OpenAI error, if any '''
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def is_rate_limited(error: Exception) -> bool:
+    ''' Whether the upstream rejected the call for exceeding the quota rather than failing it '''
+    import openai
+    return isinstance(error, openai.error.RateLimitError) or getattr(error, "http_status", None) == 429
+
+
+def is_retryable(error: Exception) -> bool:
+    if not isinstance(error, retryable_errors()):
+        return False
+    # An exhausted quota is reported as a rate limit, but retrying cannot help
+    if getattr(error, "code", None) == "insufficient_quota":
+        return False
+    # Client errors other than rate limits are not transient
+    status = getattr(error, "http_status", None)
+    return status is None or status == 429 or status >= 500
+
+
+class UpstreamScheduler:
+    '''
+    Schedules upstream calls within the requests-per-minute and tokens-per-minute quotas.
+    Each call waits on both token buckets, with the tokens seeded from its estimated prompt and completion tokens.
+    Retryable failures are retried with jittered exponential backoff, honoring `Retry-After`,
+    and sustained failures other than rate limits trip a circuit breaker that fails fast instead of adding to the burst.
+
+    Args:
+        rpm (int): Requests per minute, no limit if 0.
+        tpm (int): Tokens per minute, no limit if 0.
+        max_retries (int): The maximum number of retries of a call.
+        breaker (CircuitBreaker): The circuit breaker of the upstream.
+    '''
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, max_retries: int = 5, breaker: Optional[CircuitBreaker] = None) -> None:
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
+        # Set by `Retry-After` so that every caller backs off, not only the one that was rejected
+        self.blocked_until = 0.0
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _admit(self, tokens: int) -> Tuple[float, bool]:
+        '''
+        Reserve the quota of a call and return the seconds to wait before sending it,
+        and whether the call is the trial of the circuit breaker
+        '''
+        trial = self.breaker.before_call()
+        wait = max(0.0, self.blocked_until - time.monotonic())
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens))
+        with self._lock:
+            self.calls += 1
+            self.throttled_seconds += wait
+        return wait, trial
+
+    def _record_failure(self, error: Exception, trial: bool = False) -> bool:
+        ''' Record a failed attempt with the circuit breaker, and return whether it is worth retrying '''
+        if not is_retryable(error):
+            # Invalid requests say nothing about the health of the upstream,
+            # but a trial has to end with an outcome, or the circuit would never close again
+            if trial:
+                self.breaker.record_failure()
+            return False
+        # Rate limits are waited out after `Retry-After`: the upstream is healthy, and processes sharing the quota
+        # would otherwise open the circuit and fail every call for the whole cooldown
+        if not is_rate_limited(error):
+            self.breaker.record_failure()
+        with self._lock:
+            self.failures += 1
+        return True
+
+    def _backoff(self, error: Exception, attempt: int, trial: bool = False) -> Optional[float]:
+        ''' Record a failed attempt and return the delay before the next one, or None to give up '''
+        if not self._record_failure(error, trial) or attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(BACKOFF_MAX_DELAY, BACKOFF_BASE_DELAY * 2 ** attempt))
+        requested = retry_after(error)
+        if requested is not None:
+            delay = max(delay, requested)
+            with self._lock:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + requested)
+        with self._lock:
+            self.retries += 1
+        return delay
+
+    def _end_stream(self, error: Optional[BaseException], trial: bool) -> None:
+        '''
+        Record the outcome of a streamed call once its stream ends: a success if it ran out or was closed,
+        a failure if it raised, and none if it was interrupted, e.g. cancelled
+        '''
+        try:
+            if error is None:
+                self.breaker.record_success()
+            elif isinstance(error, Exception):
+                self._record_failure(error, trial)
+        finally:
+            if trial:
+                self.breaker.end_trial()
+
+    def call(self, fn: Callable[[], Any], tokens: int = 0) -> Any:
+        '''
+        Call `fn` within the quotas, retrying on transient failures.
+        A streamed response is returned as a `Stream` once its first chunk arrived, so that failures before
+        the first chunk are retried, and the outcome of the call is recorded when the stream ends.
+        '''
+        attempt = 0
+        while True:
+            wait, trial = self._admit(tokens)
+            streaming = False
+            try:
+                time.sleep(wait)
+                result = fn()
+                if inspect.isgenerator(result):
+                    result = Stream(self, result, next(result, _NO_CHUNK), trial)
+                    streaming = True
+            except Exception as error:
+                delay = self._backoff(error, attempt, trial)
+                if delay is None:
+                    raise
+            else:
+                if not streaming:
+                    self.breaker.record_success()
+                return result
+            finally:
+                # The stream ends the trial once it is over
+                if trial and not streaming:
+                    self.breaker.end_trial()
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, fn: Callable[[], Awaitable[Any]], tokens: int = 0) -> Any:
+        ''' Coroutine version of `call`, where `fn` returns a new awaitable on every attempt '''
+        attempt = 0
+        while True:
+            wait, trial = self._admit(tokens)
+            streaming = False
+            try:
+                await asyncio.sleep(wait)
+                result = await fn()
+                if inspect.isasyncgen(result):
+                    result = AsyncStream(self, result, await _afirst(result), trial)
+                    streaming = True
+            except Exception as error:
+                delay = self._backoff(error, attempt, trial)
+                if delay is None:
+                    raise
+            else:
+                if not streaming:
+                    self.breaker.record_success()
+                return result
+            finally:
+                # Also reached when the call is cancelled, which `except Exception` does not catch.
+                # The stream ends the trial once it is over
+                if trial and not streaming:
+                    self.breaker.end_trial()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "throttled_seconds": self.throttled_seconds,
+                "circuit": self.breaker.state,
+            }
+
+
+
+class Stream:
+    '''
+    The chunks of a streamed response sent through an `UpstreamScheduler`,
+    which record the outcome of the call with the scheduler once the stream ends.
+    Failures in the middle of the stream are not retried, as the caller already consumed the chunks before them.
+    '''
+
+    def __init__(self, scheduler: UpstreamScheduler, chunks, first: Any, trial: bool) -> None:
+        self.scheduler = scheduler
+        self.chunks = chunks
+        self.trial = trial
+        self._first = first
+        self._ended = False
+
+    def _end(self, error: Optional[BaseException] = None) -> None:
+        if not self._ended:
+            self._ended = True
+            self.scheduler._end_stream(error, self.trial)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Any:
+        if self._first is not _NO_CHUNK:
+            first, self._first = self._first, _NO_CHUNK
+            return first
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            self._end()
+            raise
+        except BaseException as error:
+            self._end(error)
+            raise
+
+    def close(self) -> None:
+        ''' Close the stream, e.g. once enough chunks arrived, which ends the call successfully '''
+        try:
+            self.chunks.close()
+        finally:
+            self._end()
+
+
+class AsyncStream(Stream):
+    ''' Async version of `Stream` '''
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        if self._first is not _NO_CHUNK:
+            first, self._first = self._first, _NO_CHUNK
+            return first
+        try:
+            return await self.chunks.__anext__()
+        except StopAsyncIteration:
+            self._end()
+            raise
+        except BaseException as error:
+            self._end(error)
+            raise
+
+    async def aclose(self) -> None:
+        try:
+            await self.chunks.aclose()
+        finally:
+            self._end()
+
+
+_SCHEDULERS: Dict[str, UpstreamScheduler] = {}
+_SCHEDULERS_LOCK = threading.Lock()
+
+
+def get_upstream_scheduler(cfg, backend=None) -> UpstreamScheduler:
+    '''
+    Return the process-wide upstream scheduler of the organization of `cfg` (an AIConfig).
+    OpenAI enforces the quotas per organization, so engines of the same organization share a scheduler.
+    Other servers of `backend` (a backends.Backend) get a scheduler each, limited by their own quotas.
+    '''
+    if backend is None or backend.is_openai:
+        key = cfg.get_organization_id()
+        rpm, tpm = cfg.get_rate_limit_rpm(), cfg.get_rate_limit_tpm()
+    else:
+        key = f"backend:{backend.name}"
+        rpm, tpm = backend.rpm, backend.tpm
+    with _SCHEDULERS_LOCK:
+        if key not in _SCHEDULERS:
+            _SCHEDULERS[key] = UpstreamScheduler(
+                rpm=rpm,
+                tpm=tpm,
+                max_retries=cfg.get_max_retries(),
+                breaker=CircuitBreaker(cfg.get_breaker_threshold(), cfg.get_breaker_cooldown()),
+            )
+        return _SCHEDULERS[key]
+
+
+def get_upstream_schedulers() -> Dict[str, UpstreamScheduler]:
+    ''' The process-wide upstream schedulers by organization or backend '''
+    with _SCHEDULERS_LOCK:
+        return dict(_SCHEDULERS)
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+import metrics
+
+# A Mersenne prime larger than the 32-bit shingle hashes, the modulus of the MinHash permutations
+_MERSENNE_PRIME = (1 << 61) - 1
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    '''
+    Normalize a request text for similarity: unify the Unicode forms and the case,
+    spell out "&", and drop punctuation and repeated whitespace.
+    '''
+    text = unicodedata.normalize("NFKC", text or "").lower().replace("&", " and ")
+    text = "".join(" " if unicodedata.category(char)[0] in "PSZC" else char for char in text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def shingles(text: str, ngram: int = 3) -> FrozenSet[int]:
+    ''' Hash the character n-grams of a normalized text, texts shorter than `ngram` are a single shingle '''
+    if not text:
+        return frozenset()
+    if len(text) <= ngram:
+        return frozenset((zlib.crc32(text.encode("utf-8")),))
+    return frozenset(zlib.crc32(text[i:i + ngram].encode("utf-8")) for i in range(len(text) - ngram + 1))
+
+
+def jaccard(a: FrozenSet[int], b: FrozenSet[int]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class SimilarityQuery:
+    '''
+    A request prepared for the similarity cache: the key of the fields that must match exactly,
+    and the shingles and MinHash bands of the text that only needs to be similar.
+    '''
+
+    def __init__(self, partition: str, shingles: FrozenSet[int], bands: Tuple[Tuple[int, ...], ...]) -> None:
+        self.partition = partition
+        self.shingles = shingles
+        self.bands = bands
+
+
+class SimilarityCache:
+    '''
+    An in-process cache of engine responses served to near-duplicate requests,
+    e.g. "a pop song about dreams and hope" and "pop song about dreams & hope" with the same lyric context.
+    Requests are indexed locally by MinHash signatures of the character n-grams of their normalized text,
+    split into locality-sensitive bands, and a cached response is served if the Jaccard similarity
+    of the n-grams reaches the threshold. No embedding API is involved.
+    Reusing a response only makes sense for requests that expect a deterministic answer,
+    so requests above `max_temperature` are never looked up.
+
+    Args:
+        threshold (float): The minimum Jaccard similarity of the n-grams of a near-duplicate request.
+        max_temperature (float): Requests with a higher temperature bypass the cache.
+        max_size (int): The maximum number of entries kept in memory.
+        ttl (float): Seconds before an entry expires. 0 or negative values keep entries forever.
+        ngram (int): The number of characters per n-gram.
+        num_perm (int): The number of MinHash permutations.
+        bands (int): The number of bands the signature is split into, each of `num_perm // bands` rows.
+            More bands find candidates of lower similarity at the cost of more candidates to check.
+    '''
+
+    def __init__(self, threshold: float = 0.8, max_temperature: float = 0.3, max_size: int = 1024, ttl: float = 600,
+                 ngram: int = 3, num_perm: int = 64, bands: int = 16) -> None:
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm ({num_perm}) is not a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.max_temperature = max_temperature
+        self.max_size = max_size
+        self.ttl = ttl
+        self.ngram = ngram
+        self.rows = num_perm // bands
+        generator = random.Random(num_perm)
+        self._permutations = [
+            (generator.randrange(1, _MERSENNE_PRIME), generator.randrange(0, _MERSENNE_PRIME)) for _ in range(num_perm)]
+        # Entry id -> (query, value, created), and the ids of the entries in each band bucket
+        self._entries: "OrderedDict[int, Tuple[SimilarityQuery, str, float]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self.lookup_seconds = 0.0
+
+    @staticmethod
+    def make_partition(engine: str, **fields) -> str:
+        ''' Hash the engine and the request fields that must match exactly into a partition key '''
+        payload = json.dumps([engine, fields], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def should_bypass(self, temperature: float) -> bool:
+        return temperature > self.max_temperature
+
+    def _signature(self, hashes: FrozenSet[int]) -> List[int]:
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self._permutations]
+
+    def make_query(self, partition: str, text: str) -> Optional[SimilarityQuery]:
+        ''' Prepare the text of a request in a partition, None if nothing is left of it after the normalization '''
+        hashes = shingles(normalize_text(text), self.ngram)
+        if not hashes:
+            return None
+        signature = self._signature(hashes)
+        bands = tuple(tuple(signature[i:i + self.rows]) for i in range(0, len(signature), self.rows))
+        return SimilarityQuery(partition, hashes, bands)
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _candidates(self, query: SimilarityQuery) -> Set[int]:
+        candidates: Set[int] = set()
+        for i, band in enumerate(query.bands):
+            candidates |= self._buckets.get((query.partition, i, band), set())
+        return candidates
+
+    def _remove(self, entry_id: int) -> None:
+        query, _, _ = self._entries.pop(entry_id)
+        for i, band in enumerate(query.bands):
+            bucket = self._buckets.get((query.partition, i, band))
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[(query.partition, i, band)]
+
+    def get(self, query: SimilarityQuery) -> Tuple[Optional[str], float]:
+        ''' Return the cached response of the most similar request above the threshold and its similarity '''
+        with self._lock:
+            best_id, best_similarity = None, self.threshold
+            for entry_id in self._candidates(query):
+                entry_query, _, created = self._entries[entry_id]
+                if self._expired(created):
+                    self._remove(entry_id)
+                    continue
+                similarity = jaccard(query.shingles, entry_query.shingles)
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None:
+                return None, 0.0
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][1], best_similarity
+
+    def lookup(self, partition: str, text: str) -> Tuple[Optional[SimilarityQuery], Optional[str]]:
+        '''
+        Prepare the text of a request and look it up, accounting the time of both in the lookup cost.
+        Returns the query to store the fresh response under and the cached response, the query is None for an empty text.
+        '''
+        start_time = time.perf_counter()
+        query = self.make_query(partition, text)
+        value, similarity = self.get(query) if query is not None else (None, 0.0)
+        elapsed = time.perf_counter() - start_time
+        with self._lock:
+            self.lookup_seconds += elapsed
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.observe("similarity_cache_lookup_seconds", elapsed, metrics.DEFAULT_PHASE_BUCKETS)
+        if value is not None:
+            metrics.observe("similarity_cache_hit_similarity", similarity, (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0))
+        return query, value
+
+    def set(self, query: SimilarityQuery, value: str) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (query, value, time.time())
+            for i, band in enumerate(query.bands):
+                self._buckets.setdefault((query.partition, i, band), set()).add(entry_id)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypasses += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        ''' Hit/miss counters and the total seconds spent on lookups, to weigh the lookups against fresh completions '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "lookup_seconds": self.lookup_seconds,
+                "mean_lookup_seconds": self.lookup_seconds / lookups if lookups else 0.0,
+            }
+
+
+_SIMILARITY_CACHE: Optional[SimilarityCache] = None
+_SIMILARITY_CACHE_LOCK = threading.Lock()
+
+
+def get_similarity_cache(cfg) -> Optional[SimilarityCache]:
+    '''
+    Return the process-wide similarity cache configured by `cfg` (an AIConfig),
+    or None if no plugin opted in.
+    '''
+    global _SIMILARITY_CACHE
+    if not cfg.get_similarity_plugins():
+        return None
+    with _SIMILARITY_CACHE_LOCK:
+        if _SIMILARITY_CACHE is None:
+            _SIMILARITY_CACHE = SimilarityCache(
+                threshold=cfg.get_similarity_threshold(),
+                max_temperature=cfg.get_similarity_max_temperature(),
+                max_size=cfg.get_similarity_max_size(),
+                ttl=cfg.get_cache_ttl(),
+            )
+        return _SIMILARITY_CACHE
+
+
+def get_similarity_cache_stats() -> Dict[str, Any]:
+    ''' Counters of the process-wide similarity cache, empty if it has not been created. '''
+    return _SIMILARITY_CACHE.stats() if _SIMILARITY_CACHE is not None else {}
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List
+
+
+class _LeaderCancelled(Exception):
+    ''' Set on a shared call whose leader was cancelled, so that its waiters retry the call '''
+
+
+class _Call:
+    ''' An upstream call in flight and the number of requests waiting on it '''
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.waiters = 0
+        self.event = threading.Event()
+        self.future = None
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Coalesces concurrent identical calls into one.
+    The first caller of a key runs the call, and callers arriving while it is in flight
+    wait on it and share its result or exception. Works for threads (`do`) and coroutines (`ado`).
+    '''
+
+    def __init__(self) -> None:
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[tuple, _Call] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        # Futures are bound to their event loop, so calls are only shared within a loop
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        while True:
+            with self._lock:
+                call = self._async_calls.get(flight_key)
+                leader = call is None
+                if leader:
+                    call = self._async_calls[flight_key] = _Call()
+                    call.future = loop.create_future()
+                else:
+                    call.waiters += 1
+                    self.coalesced += 1
+            if leader:
+                break
+            try:
+                # Shielded so that a cancelled waiter does not cancel the shared call
+                return await asyncio.shield(call.future)
+            except _LeaderCancelled:
+                # The cancellation of the leader is not theirs, so the waiters retry,
+                # one of them as the leader of a new call and the others waiting on it
+                continue
+        try:
+            result = await fn()
+            call.future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            call.future.set_exception(_LeaderCancelled())
+            if call.waiters == 0:
+                call.future.exception()
+            raise
+        except BaseException as error:
+            call.future.set_exception(error)
+            if call.waiters == 0:
+                # Mark the exception as retrieved when nobody else waits on it
+                call.future.exception()
+            raise
+        finally:
+            with self._lock:
+                del self._async_calls[flight_key]
+
+    def in_flight(self) -> List[Dict[str, Any]]:
+        ''' The calls in flight with their waiter counts, for observability '''
+        now = time.time()
+        with self._lock:
+            calls = [(key, call) for key, call in self._calls.items()]
+            calls += [(key, call) for (_, key), call in self._async_calls.items()]
+        return [
+            {"key": key, "waiters": call.waiters, "age": now - call.started}
+            for key, call in calls
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        calls = self.in_flight()
+        return {
+            "in_flight": len(calls),
+            "waiters": sum(call["waiters"] for call in calls),
+            "coalesced": self.coalesced,
+            "calls": calls,
+        }
+
+
+_SINGLE_FLIGHT = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    ''' Return the process-wide single-flight table of engine calls '''
+    return _SINGLE_FLIGHT
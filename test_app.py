@@ -1,11 +1,38 @@
+import asyncio
+
 from lyric_line_completion import LyricLineCompletionPlugin
+from lyric_structure_completion import LyricStructureCompletionPlugin
 from lyric_generation import LyricGenerationPlugin
+from plugin_service import install_async_jobs_route, install_metrics_route
+from engine_registry import get_engine_registry
 from tuneflow_devkit import Runner
 from pathlib import Path
-import uvicorn
 
-app = Runner(plugin_class_list=[LyricGenerationPlugin, LyricLineCompletionPlugin], bundle_file_path=str(Path(__file__).parent.joinpath(
-    'bundle.json').absolute())).start(path_prefix='/plugin-service/lyrics_writer')
+PATH_PREFIX = '/plugin-service/lyrics_writer'
+PLUGIN_CLASS_LIST = [LyricGenerationPlugin, LyricLineCompletionPlugin, LyricStructureCompletionPlugin]
+# The auth, async and exception config of the Runner, also honored by the async jobs route
+RUNNER_CONFIG = None
+
+app = Runner(plugin_class_list=PLUGIN_CLASS_LIST, bundle_file_path=str(Path(__file__).parent.joinpath(
+    'bundle.json').absolute())).start(path_prefix=PATH_PREFIX, config=RUNNER_CONFIG)
+# Serve plugin jobs on the event loop through the plugins' `arun` coroutines
+install_async_jobs_route(app, PLUGIN_CLASS_LIST, path_prefix=PATH_PREFIX, config=RUNNER_CONFIG)
+# Expose the phase timings and token usage for scraping
+install_metrics_route(app)
+
+
+@app.on_event("startup")
+async def warm_up_engines():
+    # Build engines and open pooled connections in the background, so that the service accepts requests
+    # right away instead of waiting on the OpenAI client to load
+    app.state.warm_up = asyncio.ensure_future(get_engine_registry().awarm_up())
+
+
+@app.on_event("shutdown")
+async def close_engines():
+    app.state.warm_up.cancel()
+    await get_engine_registry().aclose()
 
 if __name__ == '__main__':
+    import uvicorn
     uvicorn.run(app)
@@ -0,0 +1,23 @@
+import json
+
+from ai_api import get_engine_api
+from ai_config import AIConfig
+from ai_prompt import LyricPrompt
+
+
+def test_openai_credentials_are_only_sent_to_openai(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-secret")
+    monkeypatch.setenv("OPENAI_API_ORGANIZATION_ID", "org-secret")
+    monkeypatch.setenv("OPENAI_API_BACKENDS", json.dumps({
+        "local": {"api_base": "http://127.0.0.1:8000/v1", "model": "llama"},
+        "hosted": {"api_base": "https://hosted.invalid/v1", "model": "llama", "api_key": "hosted-key"},
+    }))
+    cfg = AIConfig()
+    prompt = LyricPrompt(lang="en")
+
+    openai_api = get_engine_api(cfg, prompt, engine="gpt-3.5-turbo")
+    assert (openai_api.api_key, openai_api.organization) == ("sk-secret", "org-secret")
+    local_api = get_engine_api(cfg, prompt, engine="local")
+    assert (local_api.api_key, local_api.organization) == ("none", None)
+    hosted_api = get_engine_api(cfg, prompt, engine="hosted")
+    assert (hosted_api.api_key, hosted_api.organization) == ("hosted-key", None)
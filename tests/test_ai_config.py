@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from ai_config import AIConfig
+from backends import get_backend
+
+LOCAL_BACKENDS = json.dumps({"local": {"api_base": "http://127.0.0.1:8000/v1", "model": "llama", "mode": "chat"}})
+
+
+@pytest.fixture(autouse=True)
+def no_credentials(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.delenv("OPENAI_API_ORGANIZATION_ID", raising=False)
+    monkeypatch.setenv("OPENAI_API_BACKENDS", LOCAL_BACKENDS)
+
+
+def test_offline_engines_require_no_credentials(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_ENGINE", "mock")
+    monkeypatch.setenv("OPENAI_API_PLUGIN_ENGINES", json.dumps({"gpt-lyrics-line": "local"}))
+    monkeypatch.setenv("OPENAI_API_HEDGE_ENGINE", "local")
+    AIConfig()
+
+
+@pytest.mark.parametrize("variable, value", [
+    ("OPENAI_API_PLUGIN_ENGINES", json.dumps({"gpt-lyrics-line": "gpt-3.5-turbo"})),
+    ("OPENAI_API_HEDGE_ENGINE", "gpt-3.5-turbo"),
+])
+def test_openai_engines_of_plugins_and_hedging_require_credentials(monkeypatch, variable, value):
+    monkeypatch.setenv("OPENAI_API_ENGINE", "local")
+    monkeypatch.setenv(variable, value)
+    with pytest.raises(Exception, match="OPENAI_API_KEY is not set"):
+        AIConfig()
+
+
+def test_only_openai_backends_are_openai(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_ENGINE", "mock")
+    cfg = AIConfig()
+    assert get_backend(cfg, "gpt-3.5-turbo").is_openai
+    assert not get_backend(cfg, "mock").is_openai
+    assert not get_backend(cfg, "local").is_openai
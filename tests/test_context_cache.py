@@ -0,0 +1,46 @@
+from typing import List
+
+from tuneflow_py import Lyrics, Song, TrackType
+
+from context_cache import ContextCache, LyricContext
+from context_compaction import ContextCompactor
+
+
+def make_song(sentences: List[str], track: bool = False) -> Song:
+    song = Song()
+    if track:
+        song.create_track(type=TrackType.MIDI_TRACK)
+    lyrics = Lyrics(song)
+    for i, sentence in enumerate(sentences):
+        lyrics.create_line_from_string(sentence, i * 2000, i * 2000 + 1800)
+    return song
+
+
+def test_songs_without_tracks_do_not_share_an_entry():
+    cache = ContextCache(ContextCompactor(), max_songs=8)
+    first = make_song(["first song", "la la la"])
+    second = make_song(["second song", "na na na"])
+
+    assert cache.get(first).sentences == ["first song", "la la la"]
+    assert cache.get(second).sentences == ["second song", "na na na"]
+    # Both are kept, rather than the second one replacing or being spliced from the first
+    assert cache.get(first).sentences == ["first song", "la la la"]
+    assert cache.get(second).sentences == ["second song", "na na na"]
+    assert cache.stats() == {"hits": 2, "updates": 0, "misses": 2, "size": 2, "max_size": 8}
+
+
+def test_edited_song_is_spliced_from_its_previous_version():
+    compactor = ContextCompactor(max_tokens=64, keep_lines=2, section_lines=2)
+    cache = ContextCache(compactor)
+    lines = [f"line {i}" for i in range(12)]
+    song = make_song(lines, track=True)
+    cache.get(song).context(6, 7)
+
+    lines[6] = "a brand new line"
+    edited = make_song(lines, track=True)
+    edited._proto.tracks[0].uuid = song._proto.tracks[0].uuid
+    context = cache.get(edited)
+    assert cache.stats()["updates"] == 1
+    fresh = LyricContext(compactor, lines)
+    for before_end, after_start in [(6, 7), (0, 12), (3, 9), (12, 12)]:
+        assert context.context(before_end, after_start) == fresh.context(before_end, after_start)
@@ -0,0 +1,70 @@
+import json
+import threading
+import time
+
+import openai
+import requests
+from openai import api_requestor
+
+from engine_registry import EngineRegistry
+
+
+def chat_response() -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "application/json"
+    response._content = json.dumps({
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "la la la"}, "finish_reason": "stop"}],
+    }).encode("utf-8")
+    return response
+
+
+def test_shared_session_outlives_the_openai_session_lifetime(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_ENGINE", "local")
+    monkeypatch.setenv("OPENAI_API_BACKENDS", json.dumps(
+        {"local": {"api_base": "http://local.invalid/v1", "model": "llama", "mode": "chat"}}))
+    registry = EngineRegistry()
+    engine = registry.get_engine("en")
+    session = registry.get_session()
+    requests_sent, closes = [], []
+    monkeypatch.setattr(session, "request", lambda *args, **kwargs: requests_sent.append(args) or chat_response())
+    monkeypatch.setattr(session, "close", lambda: closes.append(session))
+    prompts = [{"role": "user", "content": "a song about the sea"}]
+
+    assert engine._get_content(engine._request(prompts, temperature=0, max_tokens=16)) == "la la la"
+    # Long after the openai client would have closed and replaced the session of this thread
+    now = time.time() + api_requestor.MAX_SESSION_LIFETIME_SECS * 2
+    monkeypatch.setattr(time, "time", lambda: now)
+    assert engine._get_content(engine._request(prompts, temperature=0, max_tokens=16)) == "la la la"
+
+    assert len(requests_sent) == 2
+    assert closes == []
+    assert openai.requestssession is None
+
+
+def test_engines_are_built_outside_the_lock(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_ENGINE", "mock")
+    import ai_api
+    registry = EngineRegistry()
+    build = ai_api.get_engine_api
+    lock_free = []
+
+    def take_lock():
+        acquired = registry._lock.acquire(timeout=1)
+        if acquired:
+            registry._lock.release()
+        lock_free.append(acquired)
+
+    def get_engine_api(**kwargs):
+        # Another thread, e.g. a request on the event loop while `awarm_up` builds engines, can take the lock
+        thread = threading.Thread(target=take_lock)
+        thread.start()
+        thread.join()
+        return build(**kwargs)
+
+    monkeypatch.setattr(ai_api, "get_engine_api", get_engine_api)
+    engine = registry.get_engine("en")
+    assert lock_free == [True]
+    assert registry.get_engine("en") is engine
+    assert engine.session_factory == registry.get_session
@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+from hedging import HEDGE_MIN_SAMPLES, HedgePolicy, ahedge
+from rate_limit import CircuitBreaker, UpstreamScheduler
+
+
+def half_open_scheduler() -> UpstreamScheduler:
+    scheduler = UpstreamScheduler(breaker=CircuitBreaker(failure_threshold=1, cooldown=30))
+    # Opened long enough ago for the cooldown to be over
+    scheduler.breaker.opened_at = time.monotonic() - 60
+    assert scheduler.breaker.state == "half_open"
+    return scheduler
+
+
+def test_cancelled_hedged_trial_does_not_wedge_the_breaker():
+    primary = half_open_scheduler()
+    backup = UpstreamScheduler()
+
+    async def run():
+        # The primary is the trial call of its breaker, and loses to the backup
+        outcome = await ahedge(
+            lambda: primary.acall(lambda: asyncio.sleep(10, "primary")),
+            lambda: backup.acall(lambda: asyncio.sleep(0, "backup")),
+            0.01,
+        )
+        assert outcome.backup_won and outcome.result == "backup"
+        assert not primary.breaker.trial
+        # The next call is let through as a new trial, and its success closes the circuit
+        return await primary.acall(lambda: asyncio.sleep(0, "next"))
+
+    assert asyncio.run(run()) == "next"
+    assert primary.breaker.state == "closed"
+
+
+def test_non_retryable_trial_failure_reopens_the_breaker():
+    scheduler = half_open_scheduler()
+
+    def invalid():
+        raise ValueError("invalid request")
+
+    try:
+        scheduler.call(invalid)
+    except ValueError:
+        pass
+    assert scheduler.breaker.state == "open"
+    assert not scheduler.breaker.trial
+
+
+def test_hedged_engine_call_keeps_the_breaker_usable(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_ENGINE", "mock")
+    monkeypatch.setenv("OPENAI_API_BACKENDS", '{"mock-backup": {"mode": "mock", "api_base": "http://backup.invalid/v1"}}')
+    monkeypatch.setenv("OPENAI_API_CACHE_ENABLED", "false")
+    monkeypatch.setenv("OPENAI_API_STREAM", "false")
+    monkeypatch.setenv("OPENAI_API_MOCK_CHUNK_INTERVAL", "0")
+    from ai_api import get_engine_api
+    from ai_config import AIConfig
+    from ai_prompt import LyricPrompt
+
+    cfg = AIConfig()
+    prompt = LyricPrompt(lang="en")
+    api = get_engine_api(cfg, prompt)
+    api.hedge_engine = get_engine_api(cfg, prompt, engine="mock-backup")
+    assert api.scheduler is not api.hedge_engine.scheduler
+    api.mock.latency = 10
+    api.hedge_engine.mock.latency = 0
+    monkeypatch.setattr(api.hedge, "deadline", lambda kind: 0.01)
+    breaker = api.scheduler.breaker
+    monkeypatch.setattr(breaker, "opened_at", time.monotonic() - breaker.cooldown - 1)
+
+    async def run():
+        # The trial call of the half-open breaker is slow, and cancelled once the hedge engine wins
+        await api.agenerate("a pop song about dreams and hope", 0.5, num_lines=2)
+        assert not breaker.trial
+        api.mock.latency = 0
+        await api.agenerate("a rock song about cars", 0.5, num_lines=2)
+
+    asyncio.run(run())
+    assert breaker.state == "closed"
+
+
+def test_hedge_outcome_only_reports_completed_latencies():
+    async def run():
+        return await ahedge(lambda: asyncio.sleep(10, "primary"), lambda: asyncio.sleep(0.02, "backup"), 0.01)
+
+    outcome = asyncio.run(run())
+    assert outcome.backup_won and outcome.result == "backup"
+    # The primary was cancelled, so its latency is unknown rather than the time it ran for
+    assert outcome.primary_seconds is None
+    assert outcome.latencies == [outcome.backup_seconds]
+    assert 0.02 <= outcome.backup_seconds < 1
+
+
+def test_hedged_engine_call_observes_only_completed_latencies(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_ENGINE", "mock")
+    monkeypatch.setenv("OPENAI_API_BACKENDS", '{"mock-backup": {"mode": "mock", "api_base": "http://backup.invalid/v1"}}')
+    monkeypatch.setenv("OPENAI_API_CACHE_ENABLED", "false")
+    monkeypatch.setenv("OPENAI_API_STREAM", "false")
+    monkeypatch.setenv("OPENAI_API_MOCK_CHUNK_INTERVAL", "0")
+    from ai_api import get_engine_api
+    from ai_config import AIConfig
+    from ai_prompt import LyricPrompt
+
+    cfg = AIConfig()
+    prompt = LyricPrompt(lang="en")
+    api = get_engine_api(cfg, prompt)
+    api.hedge_engine = get_engine_api(cfg, prompt, engine="mock-backup")
+    api.mock.latency = 10
+    api.hedge_engine.mock.latency = 0
+    monkeypatch.setattr(api.hedge, "deadline", lambda kind: 0.05)
+
+    asyncio.run(api.agenerate("a pop song about dreams and hope", 0.5, num_lines=2))
+    latencies = [latency for history in api.hedge._latencies.values() for latency in history]
+    # Only the hedge completed, the cancelled primary is not observed at the 0.05 s it was cut short at
+    assert len(latencies) == 1
+    assert latencies[0] < 0.05
+
+
+def test_hedge_deadline_is_the_latency_percentile():
+    policy = HedgePolicy(percentile=90, min_delay=0.5)
+    for latency in range(1, HEDGE_MIN_SAMPLES):
+        policy.observe("lines", float(latency))
+    # Not hedged until enough latencies are known
+    assert policy.deadline("lines") is None
+    policy.observe("lines", float(HEDGE_MIN_SAMPLES))
+    assert policy.deadline("lines") == 18.0
+    # Kinds of calls are timed separately, and the deadline is never below the minimum delay
+    for _ in range(HEDGE_MIN_SAMPLES):
+        policy.observe("song", 0.1)
+    assert policy.deadline("song") == 0.5
+    assert HedgePolicy(percentile=0).deadline("lines") is None
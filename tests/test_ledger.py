@@ -0,0 +1,46 @@
+import sqlite3
+import time
+
+import pytest
+
+import ledger
+from ledger import UsageLedger
+
+
+def count_rows(path) -> int:
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT COUNT(*) FROM usage").fetchone()[0]
+
+
+def test_buffered_usage_is_flushed_on_shutdown(tmp_path):
+    path = str(tmp_path / "usage.sqlite3")
+    usage = UsageLedger(path, flush_interval=60, batch_size=100)
+    with ledger.usage_scope(plugin="gpt-lyrics-line", user="alice"):
+        usage.record("gpt-3.5-turbo", 1000, 500, lines=4)
+        usage.record("gpt-3.5-turbo", 200, 0, hedge=True)
+    # Buffered until the interval elapses or the batch is full
+    assert count_rows(path) == 0
+    usage.close()
+    assert count_rows(path) == 2
+    assert not usage._writer.is_alive()
+
+    reopened = UsageLedger(path)
+    assert reopened.top_spenders(by="user") == [{
+        "user": "alice", "cost": pytest.approx(ledger.estimate_cost("gpt-3.5-turbo", 1200, 500)),
+        "prompt_tokens": 1200, "completion_tokens": 500, "calls": 2,
+    }]
+    assert reopened.tokens_per_line() == {"gpt-lyrics-line": {"prompt_tokens": 250, "completion_tokens": 125, "lines": 4}}
+    assert reopened.hedge_spend()["gpt-3.5-turbo"]["prompt_tokens"] == 200
+    reopened.close()
+
+
+def test_full_batch_is_written_before_the_interval(tmp_path):
+    path = str(tmp_path / "usage.sqlite3")
+    usage = UsageLedger(path, flush_interval=60, batch_size=3)
+    for _ in range(3):
+        usage.record("mock", 10, 10, plugin="gpt-lyrics-generate", user="bob")
+    deadline = time.monotonic() + 5
+    while count_rows(path) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert count_rows(path) == 3
+    usage.close()
@@ -0,0 +1,24 @@
+from fastapi import FastAPI
+from starlette.testclient import TestClient
+
+import metrics
+import plugin_service
+from engine_registry import EngineRegistry
+
+
+def test_label_values_are_escaped():
+    metrics.set_gauge("test_escaped", 1, upstream='C:\\quota "org"\nnext')
+    assert 'test_escaped{upstream="C:\\\\quota \\"org\\"\\nnext"} 1' in metrics.render_prometheus().split("\n")
+
+
+def test_metrics_are_served_when_the_config_is_invalid(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_ENGINE", "gpt-3.5-turbo")
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setattr(plugin_service, "get_engine_registry", lambda: EngineRegistry())
+    app = FastAPI()
+    plugin_service.install_metrics_route(app)
+
+    response = TestClient(app).get("/metrics")
+    assert response.status_code == 200
+    assert "config_valid 0" in response.text
+    assert "single_flight_in_flight" in response.text
@@ -0,0 +1,89 @@
+from pathlib import Path
+
+from fastapi import Header, HTTPException
+from msgpack import packb, unpackb
+from starlette.testclient import TestClient
+from tuneflow_devkit import Runner
+from tuneflow_py import Song
+
+from lyric_generation import LyricGenerationPlugin
+from lyric_line_completion import LyricLineCompletionPlugin
+from lyric_structure_completion import LyricStructureCompletionPlugin
+from plugin_service import install_async_jobs_route
+
+PATH_PREFIX = '/plugin-service/lyrics_writer'
+PLUGIN_CLASS_LIST = [LyricGenerationPlugin, LyricLineCompletionPlugin, LyricStructureCompletionPlugin]
+BUNDLE_FILE_PATH = str(Path(__file__).parent.parent.joinpath('bundle.json'))
+
+
+class EchoPlugin:
+    runs = []
+
+    @staticmethod
+    def provider_id():
+        return "andantei"
+
+    @staticmethod
+    def plugin_id():
+        return "echo"
+
+    @staticmethod
+    async def arun(song, params):
+        if params.get("fail"):
+            raise ValueError("failed")
+        EchoPlugin.runs.append(params)
+
+
+def authorize(authorization: str = Header(None)):
+    if authorization != "Bearer token":
+        raise HTTPException(status_code=401)
+
+
+def make_client(monkeypatch, config) -> TestClient:
+    monkeypatch.setenv("OPENAI_API_ENGINE", "mock")
+    app = Runner(plugin_class_list=PLUGIN_CLASS_LIST, bundle_file_path=BUNDLE_FILE_PATH).start(
+        path_prefix=PATH_PREFIX, config=config)
+    install_async_jobs_route(app, [EchoPlugin], path_prefix=PATH_PREFIX, config=config)
+    return TestClient(app)
+
+
+def post_job(client: TestClient, params, headers=None):
+    body = packb({
+        "providerId": "andantei",
+        "pluginId": "echo",
+        "params": params,
+        "song": Song().serialize_to_bytestring(),
+    })
+    return client.post(f'{PATH_PREFIX}/jobs', content=body, headers=headers or {})
+
+
+def test_async_jobs_route_keeps_the_runner_auth(monkeypatch):
+    EchoPlugin.runs.clear()
+    errors = []
+    client = make_client(monkeypatch, {"auth": {"handler": authorize}, "exception": {"handler": errors.append}})
+
+    assert post_job(client, {"n": 1}).status_code == 401
+    assert EchoPlugin.runs == []
+
+    response = post_job(client, {"n": 2}, headers={"Authorization": "Bearer token"})
+    assert response.status_code == 200
+    assert unpackb(response.content)["status"] == "OK"
+    assert EchoPlugin.runs == [{"n": 2}]
+
+    response = post_job(client, {"fail": True}, headers={"Authorization": "Bearer token"})
+    assert unpackb(response.content) == {"status": "ERROR"}
+    assert [str(error) for error in errors] == ["failed"]
+
+
+def test_async_jobs_route_uploads_results_to_the_async_store(monkeypatch):
+    uploads = {}
+    client = make_client(monkeypatch, {"async": {"store": {
+        "uploader": uploads.__setitem__,
+        "resultUrlResolver": lambda job_id: f"https://store.invalid/{job_id}",
+    }}})
+
+    accepted = unpackb(post_job(client, {"n": 3}).content)
+    assert accepted["status"] == "ACCEPTED"
+    assert accepted["resultUrl"] == f"https://store.invalid/{accepted['jobId']}"
+    result = unpackb(uploads[accepted["jobId"]])
+    assert result["status"] == "OK" and result["jobId"] == accepted["jobId"]
@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+from rate_limit import CircuitBreaker, UpstreamScheduler
+
+
+def half_open_scheduler() -> UpstreamScheduler:
+    scheduler = UpstreamScheduler(max_retries=1, breaker=CircuitBreaker(failure_threshold=1, cooldown=30))
+    scheduler.breaker.opened_at = time.monotonic() - 60
+    assert scheduler.breaker.state == "half_open"
+    return scheduler
+
+
+def unavailable() -> Exception:
+    return openai.error.ServiceUnavailableError("unavailable", http_status=503)
+
+
+def failing_stream(chunks):
+    yield from chunks
+    raise unavailable()
+
+
+async def afailing_stream(chunks):
+    for chunk in chunks:
+        yield chunk
+    raise unavailable()
+
+
+def test_stream_failure_reaches_the_breaker():
+    scheduler = half_open_scheduler()
+    chunks = scheduler.call(lambda: failing_stream(["la", "la"]))
+    # Receiving the first chunk does not decide the trial
+    assert scheduler.breaker.trial
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        list(chunks)
+    assert scheduler.breaker.state == "open"
+    assert not scheduler.breaker.trial
+    assert scheduler.stats()["failures"] == 1
+
+
+def test_async_stream_failure_reaches_the_breaker():
+    scheduler = half_open_scheduler()
+
+    async def run():
+        chunks = await scheduler.acall(lambda: asyncio.sleep(0, afailing_stream(["la", "la"])))
+        assert scheduler.breaker.trial
+        with pytest.raises(openai.error.ServiceUnavailableError):
+            async for _ in chunks:
+                pass
+        await chunks.aclose()
+
+    asyncio.run(run())
+    assert scheduler.breaker.state == "open"
+    assert not scheduler.breaker.trial
+
+
+def test_stream_failure_before_the_first_chunk_is_retried(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    scheduler = UpstreamScheduler(max_retries=1)
+    streams = iter([failing_stream([]), iter(["la", "la"])])
+    assert list(scheduler.call(lambda: next(streams))) == ["la", "la"]
+    assert scheduler.stats()["retries"] == 1
+
+
+def test_closed_stream_closes_the_circuit():
+    scheduler = half_open_scheduler()
+    chunks = scheduler.call(lambda: failing_stream(["la", "la"]))
+    # Enough chunks arrived, so the stream is closed before the failure
+    assert next(chunks) == "la"
+    chunks.close()
+    assert scheduler.breaker.state == "closed"
+    assert not scheduler.breaker.trial
+
+
+def test_rate_limits_wait_out_retry_after_without_opening_the_circuit(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    scheduler = UpstreamScheduler(max_retries=5, breaker=CircuitBreaker(failure_threshold=2, cooldown=30))
+    responses = iter([openai.error.RateLimitError("slow down", http_status=429, headers={"retry-after": "2"})] * 4)
+
+    def complete():
+        error = next(responses, None)
+        if error is not None:
+            raise error
+        return "lyrics"
+
+    assert scheduler.call(complete) == "lyrics"
+    assert scheduler.breaker.state == "closed"
+    assert scheduler.stats()["retries"] == 4
+    # Every retry waited at least as long as requested
+    assert sum(sleeps) >= 4 * 2
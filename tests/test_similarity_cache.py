@@ -0,0 +1,37 @@
+import time
+
+from similarity_cache import SimilarityCache, normalize_text
+
+
+def test_near_duplicate_requests_are_served_from_the_cache():
+    cache = SimilarityCache(threshold=0.8)
+    partition = SimilarityCache.make_partition("gpt-3.5-turbo", lang="en", num_lines=4)
+    query, cached = cache.lookup(partition, "A pop song about dreams and hope")
+    assert cached is None
+    cache.set(query, "la la la")
+
+    assert normalize_text("pop song about dreams & hope!") == "pop song about dreams and hope"
+    _, cached = cache.lookup(partition, "a pop song about dreams & hope!")
+    assert cached == "la la la"
+    # Different requests and other partitions miss
+    assert cache.lookup(partition, "a sad ballad about the rain")[1] is None
+    other = SimilarityCache.make_partition("gpt-3.5-turbo", lang="en", num_lines=8)
+    assert cache.lookup(other, "A pop song about dreams and hope")[1] is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 3
+
+
+def test_evicted_and_expired_entries_are_not_served(monkeypatch):
+    cache = SimilarityCache(max_size=1)
+    partition = SimilarityCache.make_partition("mock")
+    cache.set(cache.make_query(partition, "a song about the sea"), "sea")
+    cache.set(cache.make_query(partition, "a song about the mountains"), "mountains")
+    assert cache.lookup(partition, "a song about the sea")[1] is None
+    assert cache.lookup(partition, "a song about the mountains")[1] == "mountains"
+    assert cache.stats()["evictions"] == 1
+
+    expiring = SimilarityCache(ttl=600)
+    expiring.set(expiring.make_query(partition, "a song about the sea"), "sea")
+    now = time.time() + 601
+    monkeypatch.setattr(time, "time", lambda: now)
+    assert expiring.lookup(partition, "a song about the sea")[1] is None
+    assert expiring.stats()["size"] == 0
@@ -0,0 +1,28 @@
+import asyncio
+
+from singleflight import SingleFlight
+
+
+def test_waiters_retry_when_the_leader_is_cancelled():
+    flight = SingleFlight()
+    calls = []
+
+    async def complete():
+        calls.append(len(calls))
+        await asyncio.sleep(0.05)
+        return "lyrics"
+
+    async def run():
+        leader = asyncio.create_task(flight.ado("key", complete))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(flight.ado("key", complete)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*waiters)
+        assert leader.cancelled()
+        return results
+
+    # One of the waiters took over the call, and the others shared its result
+    assert asyncio.run(run()) == ["lyrics"] * 3
+    assert len(calls) == 2
+    assert flight.in_flight() == []
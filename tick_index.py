@@ -0,0 +1,80 @@
+import bisect
+from typing import Dict, List, Optional, Tuple
+
+from tuneflow_py import Clip, LyricLine, Lyrics, Song, Track
+
+
+class TickIndex:
+    '''
+    Sorted tick arrays of the lyric lines and structures of a song, built once per plugin run
+    and queried with bisect instead of scanning every line.
+    Lyric lines are kept sorted by their start ticks by `tuneflow_py.Lyrics`, and are assumed not to overlap,
+    so their end ticks are sorted too and only computed for the lines near the queried ticks.
+
+    Args:
+        song (Song): The song to index.
+    '''
+
+    def __init__(self, song: Song) -> None:
+        self.song = song
+        self.lyrics = Lyrics(song)
+        self._line_protos = self.lyrics._proto.lines
+        self.line_starts = [LyricLine._get_start_tick(proto) for proto in self._line_protos]
+        self._line_ends: Dict[int, int] = {}
+        self.structure_ticks = [structure.get_tick() for structure in song.get_structures()]
+
+    def line_end(self, index: int) -> int:
+        if index not in self._line_ends:
+            self._line_ends[index] = LyricLine._get_end_tick(self._line_protos[index])
+        return self._line_ends[index]
+
+    def lines_within(self, start_tick: int, end_tick: int) -> List[int]:
+        ''' Indices of the lines that lie within [start_tick, end_tick] '''
+        lo = bisect.bisect_left(self.line_starts, start_tick)
+        hi = bisect.bisect_right(self.line_starts, end_tick)
+        return [i for i in range(lo, hi) if self.line_end(i) <= end_tick]
+
+    def lines_before(self, tick: int) -> range:
+        ''' Indices of the lines that end at or before `tick` '''
+        hi = bisect.bisect_right(self.line_starts, tick)
+        # Only the lines starting right before `tick` may still be playing at `tick`
+        while hi > 0 and self.line_end(hi - 1) > tick:
+            hi -= 1
+        return range(hi)
+
+    def lines_after(self, tick: int) -> range:
+        ''' Indices of the lines that start at or after `tick` '''
+        return range(bisect.bisect_left(self.line_starts, tick), len(self.line_starts))
+
+    def structure_range(self, index: int) -> Tuple[int, int]:
+        ''' The tick range of a structure, which ends at the next structure or at the end of the song '''
+        start_tick = self.structure_ticks[index]
+        if index == len(self.structure_ticks) - 1:
+            return start_tick, self.song.get_last_tick()
+        return start_tick, self.structure_ticks[index + 1]
+
+    @staticmethod
+    def note_span(track: Track) -> Optional[Tuple[int, int]]:
+        '''
+        The start tick of the first visible note of the track and the end tick of the last one, None if there are none.
+        Notes are kept sorted within each clip, so only the ends of the visible range of each clip are looked at
+        rather than sorting all notes of the track.
+        '''
+        span = None
+        for clip in track.get_clips():
+            notes = Clip._get_notes_in_range(
+                raw_notes=clip._proto.notes, start_tick=clip.get_clip_start_tick(), end_tick=clip.get_clip_end_tick())
+            if len(notes) == 0:
+                continue
+            first, last = notes[0], notes[-1]
+            if span is None:
+                span = (first.start_tick, last.start_tick, last.end_tick)
+                continue
+            # The last note is the one that starts last, the latest clip wins ties like a stable sort
+            start_tick, last_start_tick, end_tick = span
+            if last.start_tick >= last_start_tick:
+                last_start_tick, end_tick = last.start_tick, last.end_tick
+            span = (min(start_tick, first.start_tick), last_start_tick, end_tick)
+        if span is None:
+            return None
+        return span[0], span[2]
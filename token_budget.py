@@ -0,0 +1,102 @@
+import math
+import threading
+from typing import Dict, List, Optional
+
+from utils import contains_chinese
+
+try:
+    import tiktoken
+except ImportError:
+    # tiktoken is optional, token counts are approximated without it
+    tiktoken = None
+
+# The tokenizer of gpt-3.5-turbo
+TIKTOKEN_ENCODING = "cl100k_base"
+
+# Initial estimates of completion tokens per lyric line before any history is recorded.
+# Chinese lines take more tokens as most characters are encoded into one or more tokens.
+DEFAULT_TOKENS_PER_LINE = {
+    "en": 14,
+    "zh": 24,
+}
+# Tokens of the [start] and [end] markers and the surrounding line breaks
+BUDGET_OVERHEAD_TOKENS = 16
+# Headroom over the expected number of tokens so that budgets rarely cut off the [end] marker
+BUDGET_SAFETY_FACTOR = 2.0
+# Weight of the latest observation in the moving average of tokens per line
+HISTORY_SMOOTHING = 0.2
+
+
+_ENCODING = None
+
+
+def _get_encoding():
+    global _ENCODING
+    if _ENCODING is None:
+        _ENCODING = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    return _ENCODING
+
+
+def count_tokens(text: str) -> int:
+    '''
+    Count the tokens of the given text locally, without calling the API.
+    Uses tiktoken if installed, otherwise approximates: English text averages about 4 characters per token,
+    while a Chinese character takes about 1.5 tokens.
+    '''
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_get_encoding().encode(text))
+    if contains_chinese(text):
+        return math.ceil(len(text) * 1.5)
+    return math.ceil(len(text) / 4)
+
+
+class TokenBudget:
+    '''
+    Estimates `max_tokens` of a request from the number of requested lines and the writing language.
+    The tokens-per-line estimates are updated with an exponential moving average of generated lyrics,
+    and the configured maximum tokens stay a hard ceiling of every budget.
+
+    Args:
+        ceiling (int): The maximum number of tokens of any request.
+    '''
+
+    def __init__(self, ceiling: int) -> None:
+        self.ceiling = ceiling
+        self.tokens_per_line: Dict[str, float] = dict(DEFAULT_TOKENS_PER_LINE)
+        self._lock = threading.Lock()
+
+    def estimate(self, num_lines: int, lang: str = "en") -> int:
+        ''' Estimate `max_tokens` of a request for `num_lines` lines of lyrics in `lang` '''
+        with self._lock:
+            tokens_per_line = self.tokens_per_line.get(lang, DEFAULT_TOKENS_PER_LINE["en"])
+        budget = BUDGET_OVERHEAD_TOKENS + max(num_lines, 1) * tokens_per_line * BUDGET_SAFETY_FACTOR
+        return min(self.ceiling, math.ceil(budget))
+
+    def record(self, lines: List[str], lang: str = "en", completion_tokens: Optional[int] = None) -> None:
+        '''
+        Record the generated lines to update the tokens-per-line history.
+        The completion tokens are counted locally if not reported by the API.
+        '''
+        if not lines:
+            return
+        if completion_tokens is None:
+            completion_tokens = sum(count_tokens(line) for line in lines) + len(lines)
+        observed = completion_tokens / len(lines)
+        with self._lock:
+            previous = self.tokens_per_line.get(lang, DEFAULT_TOKENS_PER_LINE["en"])
+            self.tokens_per_line[lang] = (1 - HISTORY_SMOOTHING) * previous + HISTORY_SMOOTHING * observed
+
+
+_TOKEN_BUDGETS: Dict[int, TokenBudget] = {}
+_TOKEN_BUDGETS_LOCK = threading.Lock()
+
+
+def get_token_budget(cfg) -> TokenBudget:
+    ''' Return the process-wide token budget estimator capped by the max tokens of `cfg` (an AIConfig) '''
+    ceiling = cfg.get_openai_max_tokens()
+    with _TOKEN_BUDGETS_LOCK:
+        if ceiling not in _TOKEN_BUDGETS:
+            _TOKEN_BUDGETS[ceiling] = TokenBudget(ceiling)
+        return _TOKEN_BUDGETS[ceiling]
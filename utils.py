@@ -1,19 +1,51 @@
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional
+import functools
 import re
 
+# Chinese characters, both simplified and traditional, and Latin words, matched by C-level regex scans
+CHINESE_CHAR_PATTERN = re.compile(r'[\u4e00-\u9fff\u3400-\u4dbf]')
+LATIN_WORD_PATTERN = re.compile(r'[A-Za-z]+')
+# Number of lines sampled evenly across the lyrics to detect their language
+LANGUAGE_SAMPLE_LINES = 64
+
 def contains_chinese(text):
     '''
     Determine whether the given text contains Chinese characters.
     Detects both simplified and traditional Chinese characters.
     '''
-    for char in text:
-        if '\u4e00' <= char <= '\u9fff' or '\u3400' <= char <= '\u4dbf':
-            return True
-    return False
+    return CHINESE_CHAR_PATTERN.search(text) is not None
+
+@functools.lru_cache(maxsize=1024)
+def detect_language(text: str) -> Optional[str]:
+    '''
+    Detect whether the text is mostly written in Chinese or English, None if it has neither.
+    A Chinese character is weighed against an English word, as both usually make up one syllable of a lyric.
+    '''
+    chinese = len(CHINESE_CHAR_PATTERN.findall(text))
+    latin = len(LATIN_WORD_PATTERN.findall(text))
+    if chinese == 0 and latin == 0:
+        return None
+    return 'zh' if chinese >= latin else 'en'
+
+def detect_lyrics_language(lyrics) -> Optional[str]:
+    '''
+    Detect the language of existing lyrics (a `tuneflow_py.Lyrics`) from lines sampled evenly across the song.
+    Detection is cached by the sampled text, so repeated runs on the same revision of a song skip the scan.
+    '''
+    num_lines = len(lyrics)
+    if num_lines == 0:
+        return None
+    step = max(1, num_lines // LANGUAGE_SAMPLE_LINES)
+    return detect_language('\n'.join(lyrics[i].get_sentence() for i in range(0, num_lines, step)))
 
 SUPPORTED_LANGUAGES = ['en', 'zh']
 
-def get_writing_language(selected_lang: str, user_lang: str):
+def get_writing_language(selected_lang: str, user_lang: str, lyrics=None):
+    # `auto` follows the language of the existing lyrics if any, otherwise the locale of the user
+    if selected_lang == 'auto' and lyrics is not None:
+        detected_lang = detect_lyrics_language(lyrics)
+        if detected_lang in SUPPORTED_LANGUAGES:
+            return detected_lang
     # extract the first part of the locale if it's divided by a dash, other wise keep it as is
     if selected_lang == 'auto':
         user_lang = user_lang.split(
@@ -29,6 +61,52 @@ STRUCTURE_NAMES = ['chorus', 'verse', 'intro', 'bridge', 'outro']
 DEFAULT_WORD_TICKS = 200
 DEFAULT_LINE_TICKS = 2000
 DEFAULT_ERROR_MESSAGE = '[error]'
+LYRICS_START_TOKEN = '[start]'
+LYRICS_END_TOKEN = '[end]'
+# A lyric line between delimiters, matched in one pass instead of splitting into an intermediate list
+LINE_PATTERN = re.compile(r'[^\n,.!?，。！？]+')
+# The end of the last complete line in a partial response
+LAST_DELIMITER_PATTERN = re.compile(r'.*[\n,.!?，。！？]', re.S)
+LYRICS_START_PATTERN = re.compile(re.escape(LYRICS_START_TOKEN), re.I)
+LYRICS_END_PATTERN = re.compile(re.escape(LYRICS_END_TOKEN), re.I)
+# A structural label on its own, such as "Verse 1", "[Chorus]" or "Pre-Chorus:",
+# rather than a lyric line that merely contains a structure name
+STRUCTURE_LINE_PATTERN = re.compile(
+    r'^[\[(*#\s]*(?:(?:pre|post)[-\s]?)?(?:' + '|'.join(STRUCTURE_NAMES) + r')(?:\s*(?:\d+|one|two|three|four|five))?[\])*:：\s]*$', re.I)
+# A rewritten line that begins with the index of the original line, e.g. "[3] new lyrics"
+INDEXED_LINE_PATTERN = re.compile(r'^\s*\[(\d+)\]\s*(?:\(\*\)\s*)?(.*?)\s*$')
+
+
+def is_structure_line(line: str) -> bool:
+    ''' Whether the line is a structural label and should be removed from the lyrics '''
+    return STRUCTURE_LINE_PATTERN.match(line) is not None
+
+
+def _lyrics_body(lyrics: str) -> str:
+    ''' The text between the [start] and [end] tokens of a response '''
+    if DEFAULT_ERROR_MESSAGE in lyrics:
+        raise ValueError('Lyrics generation failed')
+    start = LYRICS_START_PATTERN.search(lyrics)
+    end = LYRICS_END_PATTERN.search(lyrics, start.end()) if start else None
+    if end is None:
+        raise ValueError('Lyrics generation failed')
+    return lyrics[start.end():end.start()]
+
+
+def iter_lines(text: str) -> Iterator[str]:
+    ''' Yield the stripped lyric lines of the text, skipping empty lines and structural labels '''
+    for match in LINE_PATTERN.finditer(text):
+        line = match.group().strip()
+        if line and not is_structure_line(line):
+            yield line
+
+
+def iter_lyrics(lyrics: str) -> Iterator[str]:
+    '''
+    Generator version of `split_lyrics` that yields lines one by one without intermediate lists.
+    The response is validated eagerly, so a failed generation raises before the first line.
+    '''
+    return iter_lines(_lyrics_body(lyrics))
 
 
 def split_lyrics(lyrics: str) -> List[str]:
@@ -37,20 +115,88 @@ def split_lyrics(lyrics: str) -> List[str]:
     The output may include structural labels and non-lyrical content,
     which should be removed to ensure only the desired lyrics are retained.
     '''
-    if DEFAULT_ERROR_MESSAGE in lyrics:
-        raise ValueError('Lyrics generation failed')
-    start_index = lyrics.lower().find('[start]')
-    end_index = lyrics.lower().find('[end]')
-    if start_index < 0 or end_index < 0:
-        raise ValueError('Lyrics generation failed')
-    lyrics = lyrics[start_index + len('[start]'):end_index]
-    
-    pattern = r'[\n,.,!,?，。！？]'
-    # Split the lyrics into lines and remove leading/trailing spaces
-    lines = [line.strip() for line in re.split(pattern, lyrics) if line.strip()]
-    
-    # Remove lines that contain structure names
-    lines = [line for line in lines if not any(
-        structure in line.lower() for structure in STRUCTURE_NAMES)]
+    return list(iter_lyrics(lyrics))
+
 
+def split_indexed_lyrics(lyrics: str) -> Dict[int, str]:
+    '''
+    Post-process the API responses of rewriting multiple lines in one request.
+    Each line of the response begins with the index of the original line, and is mapped from that index.
+    '''
+    lines = {}
+    for line in _lyrics_body(lyrics).split('\n'):
+        match = INDEXED_LINE_PATTERN.match(line)
+        if match is None or not match.group(2) or is_structure_line(match.group(2)):
+            continue
+        lines[int(match.group(1))] = match.group(2)
     return lines
+
+
+def join_lyrics(lines: Iterable[str]) -> str:
+    ''' The inverse of `split_lyrics`, wrapping lyric lines with the [start] and [end] tokens '''
+    return '\n'.join([LYRICS_START_TOKEN] + list(lines) + [LYRICS_END_TOKEN])
+
+
+class LyricStreamParser:
+    '''
+    A streaming version of `split_lyrics` that consumes the response chunk by chunk.
+    Complete lines are emitted as soon as their delimiter arrives, and the parser is marked `done`
+    once the [end] token appears or `num_lines` lines are complete, so the caller can stop the upstream request early.
+
+    Args:
+        num_lines (int): The number of lines after which parsing stops. No limit if None.
+    '''
+
+    def __init__(self, num_lines: Optional[int] = None) -> None:
+        self.num_lines = num_lines
+        self.lines: List[str] = []
+        self.done = False
+        self._started = False
+        self._buffer = ''
+
+    def feed(self, chunk: str) -> List[str]:
+        ''' Consume a chunk of the response and return the lines it completed '''
+        if self.done or not chunk:
+            return []
+        self._buffer += chunk
+        if DEFAULT_ERROR_MESSAGE in self._buffer:
+            raise ValueError('Lyrics generation failed')
+        if not self._started:
+            start = LYRICS_START_PATTERN.search(self._buffer)
+            if start is None:
+                # Keep just enough text to match the [start] token across chunks
+                self._buffer = self._buffer[-(len(LYRICS_START_TOKEN) - 1):]
+                return []
+            self._started = True
+            self._buffer = self._buffer[start.end():]
+
+        end = LYRICS_END_PATTERN.search(self._buffer)
+        if end is not None:
+            complete = self._buffer[:end.start()]
+            self._buffer = ''
+            self.done = True
+        else:
+            # The text after the last delimiter is an incomplete line until its delimiter arrives
+            last = LAST_DELIMITER_PATTERN.match(self._buffer)
+            if last is None:
+                return []
+            complete = self._buffer[:last.end()]
+            self._buffer = self._buffer[last.end():]
+        return self._accept(iter_lines(complete))
+
+    def _accept(self, lines: Iterator[str]) -> List[str]:
+        accepted = []
+        for line in lines:
+            if self.num_lines is not None and len(self.lines) >= self.num_lines:
+                break
+            self.lines.append(line)
+            accepted.append(line)
+        if self.num_lines is not None and len(self.lines) >= self.num_lines:
+            self.done = True
+        return accepted
+
+    def close(self) -> List[str]:
+        ''' Finish parsing at the end of the stream and return all lines '''
+        if not self.done:
+            raise ValueError('Lyrics generation failed')
+        return self.lines